@@ -0,0 +1,3 @@
+# Offline benchmarks for cosmebot.
+#
+# Run them from the project root, e.g. `python -m bench.parsers`.
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+'''
+Measures how many fetches URL canonicalization saves on the link graph
+recorded in the fixtures.
+
+Every link followed from the fixture pages is collected twice: as the
+per-rule link extractors request it (Scrapy's canonicalization only), and
+as the routing spider requests it (`cosmebot.urls.canonical_url`). The
+number of distinct URLs in each set is the number of fetches a crawl of
+that graph needs.
+
+Usage:
+    python -m bench.canonical
+'''
+
+import argparse
+import sys
+
+from scrapy.spiders import CrawlSpider
+
+from bench.common import load_fixtures, make_response, make_spider
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.parse_args(argv)
+
+    spiders = {}
+    before, after = set(), set()
+    for fixture in load_fixtures():
+        if fixture['spider'] not in spiders:
+            spiders[fixture['spider']] = make_spider(fixture['spider'])
+        spider = spiders[fixture['spider']]
+        start_url = fixture['url']
+        before.add(start_url)
+        after.add(start_url)
+
+        page_before = set(r.url for r in
+                          CrawlSpider._requests_to_follow(spider, make_response(fixture)))
+        page_after = set(r.url for r in spider._requests_to_follow(make_response(fixture)))
+        before |= page_before
+        after |= page_after
+        print('{0:<24} {1:>4} -> {2:>4} distinct requests'
+              .format(fixture['file'], len(page_before), len(page_after)))
+
+    print('{0:<24} {1:>4} -> {2:>4} fetches ({3:.0%} fewer)'
+          .format('total', len(before), len(after), 1.0 - len(after) / float(len(before))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
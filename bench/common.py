@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+'''
+Helpers shared by the benchmark scripts: fixture loading, timing,
+peak memory measurement and baseline comparison.
+'''
+
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+from scrapy.crawler import Crawler
+from scrapy.http import HtmlResponse
+from scrapy.utils.project import get_project_settings
+
+from cosmebot.spiders.atcosme import AtcosmeSpider, AtcosmeTagSpider
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures')
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+
+SPIDERS = {
+    AtcosmeSpider.name: AtcosmeSpider,
+    AtcosmeTagSpider.name: AtcosmeTagSpider,
+}
+
+
+def load_fixtures(fixtures_dir=FIXTURES_DIR):
+    '''
+    Reads `manifest.json` and returns its entries with the page body
+    loaded into `body`.
+    '''
+    with open(os.path.join(fixtures_dir, 'manifest.json')) as f:
+        fixtures = json.load(f)
+    for fixture in fixtures:
+        with open(os.path.join(fixtures_dir, fixture['file']), 'rb') as f:
+            fixture['body'] = f.read()
+    return fixtures
+
+
+def make_response(fixture):
+    '''
+    Wraps a fixture in a fresh `HtmlResponse`, so that no parsed selector
+    is carried over between runs.
+    '''
+    return HtmlResponse(fixture['url'], body=fixture['body'], encoding='utf-8')
+
+
+def make_spider(name, **kwargs):
+    '''
+    Instantiates a spider bound to a crawler with the project settings,
+    the same way `scrapy crawl` does, but without starting an engine.
+    '''
+    spidercls = SPIDERS[name]
+    crawler = Crawler(spidercls, get_project_settings())
+    return spidercls.from_crawler(crawler, **kwargs)
+
+
+def timed(func, *args, **kwargs):
+    '''
+    Calls `func` and returns a tuple of (elapsed seconds, result).
+    '''
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def peak_rss_mb():
+    '''
+    Peak resident set size of the current process, in megabytes.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # ru_maxrss is in bytes on OS X, kilobytes elsewhere
+        return peak / 1024.0 / 1024.0
+    return peak / 1024.0
+
+
+def _run_and_send(conn, func, args):
+    try:
+        conn.send((None, func(*args)))
+    except Exception as e:
+        conn.send((repr(e), None))
+    conn.close()
+
+
+def run_isolated(func, *args):
+    '''
+    Runs `func(*args)` in a child process and returns its result.
+    Used so that each benchmark gets its own peak memory figure.
+    '''
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_run_and_send,
+                                      args=(child_conn, func, args))
+    process.start()
+    error, result = parent_conn.recv()
+    process.join()
+    if error:
+        raise RuntimeError(error)
+    return result
+
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    '''
+    Merges `results` into the baseline file, so that each benchmark script
+    only overwrites its own entries.
+    '''
+    baseline = load_baseline(path)
+    baseline.update(results)
+    with open(path, 'w') as f:
+        f.write(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+
+
+def compare(name, metrics, baseline, tolerance, higher_is_better=()):
+    '''
+    Compares `metrics` against the stored baseline for `name`.
+    Returns a list of human readable regressions; a metric regresses when
+    it is more than `tolerance` (a fraction) worse than its baseline value.
+    A metric without a baseline value is reported too, so that a missing
+    or outdated baseline fails rather than passing unchecked.
+    '''
+    regressions = []
+    stored = baseline.get(name, {})
+    for key, value in sorted(metrics.items()):
+        if not stored.get(key):
+            regressions.append('{0} {1}: no baseline, record one with --save-baseline'
+                               .format(name, key))
+            continue
+        ratio = value / float(stored[key])
+        if key in higher_is_better:
+            regressed = ratio < 1.0 - tolerance
+        else:
+            regressed = ratio > 1.0 + tolerance
+        if regressed:
+            regressions.append('{0} {1}: {2:.2f} (baseline {3:.2f}, {4:+.1%})'
+                               .format(name, key, value, stored[key], ratio - 1.0))
+    return regressions
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+'''
+End-to-end crawl throughput against the local mock cosme.net.
+
+Starts `bench.mocksite`, then runs `scrapy crawl` for `atcosme` and
+`atcosme-tag` through it, once per CONCURRENT_REQUESTS value, each in a
+fresh working directory, with no download delay and only the JSON lines
+exports as pipeline. Reports pages/s, items/s by type, peak RSS (from the
+memusage extension) and exporter output bytes/s.
+
+Usage:
+    python -m bench.crawl [--concurrency N ...] [--size N] [--latency SECONDS]
+'''
+
+import argparse
+import glob
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import mocksite
+from bench.common import BENCH_DIR
+
+
+SPIDER_ARGS = {
+    'atcosme': [],
+    'atcosme-tag': ['-a', 'tag_type=access'],
+}
+
+STAT_RE = r"'{0}': (\d+)"
+
+# Dict settings cannot be given with -s on Scrapy 1.0
+SETTINGS_MODULE = '''from cosmebot.settings import *
+
+ITEM_PIPELINES = {'cosmebot.pipelines.MultiJsonLinesItemPipeline': 300}
+'''
+
+
+def _stat(log, name):
+    match = re.search(STAT_RE.format(re.escape(name)), log)
+    return int(match.group(1)) if match else 0
+
+
+def _count_lines(path):
+    with open(path, 'rb') as f:
+        return sum(1 for _ in f)
+
+
+def crawl_environment(workdir, proxy):
+    '''
+    Environment to run Scrapy commands in `workdir` with the bench settings,
+    through the mock site at `proxy`.
+    '''
+    # The project is found through PYTHONPATH, as the crawl does not run in
+    # the project directory
+    pythonpath = ([workdir, os.path.dirname(BENCH_DIR)] +
+                  os.environ.get('PYTHONPATH', '').split(os.pathsep))
+    with open(os.path.join(workdir, 'bench_settings.py'), 'w') as f:
+        f.write(SETTINGS_MODULE)
+    env = dict(os.environ, http_proxy=proxy, SCRAPY_SETTINGS_MODULE='bench_settings',
+               PYTHONPATH=os.pathsep.join(p for p in pythonpath if p))
+    env.pop('no_proxy', None)
+    return env
+
+
+def crawl_settings(concurrency, **settings):
+    '''
+    `-s` options for a crawl at `concurrency` without delays, plus `settings`.
+    '''
+    settings = dict({
+        'CONCURRENT_REQUESTS': concurrency,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': concurrency,
+        'DOWNLOAD_DELAY': 0,
+        'ADAPTIVE_THROTTLE_ENABLED': 0,
+        'AUTOTHROTTLE_ENABLED': 0,
+        'ROBOTSTXT_OBEY': 0,
+        'LOG_LEVEL': 'INFO',
+    }, **settings)
+    options = []
+    for name, value in sorted(settings.items()):
+        options += ['-s', '{0}={1}'.format(name, value)]
+    return options
+
+
+def crawl(spider, proxy, concurrency, duration):
+    '''
+    Runs one crawl and returns its metrics.
+    '''
+    workdir = tempfile.mkdtemp(prefix='bench-crawl-')
+    env = crawl_environment(workdir, proxy)
+    command = ([sys.executable, '-m', 'scrapy.cmdline', 'crawl', spider] + SPIDER_ARGS[spider] +
+               crawl_settings(concurrency, CLOSESPIDER_TIMEOUT=duration, MEMUSAGE_ENABLED=1))
+
+    try:
+        start = time.time()
+        process = subprocess.Popen(command, cwd=workdir, env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        log = process.communicate()[0].decode('utf-8', 'replace')
+        elapsed = time.time() - start
+        # Errors creating the crawler do not make `scrapy crawl` fail
+        if process.returncode or 'Spider closed' not in log:
+            raise RuntimeError('crawl failed:\n' + log[-2000:])
+
+        items = {}
+        output_bytes = 0
+        for path in glob.glob(os.path.join(workdir, '*.json')):
+            items[os.path.basename(path)[:-len('.json')]] = _count_lines(path)
+            output_bytes += os.path.getsize(path)
+    finally:
+        shutil.rmtree(workdir)
+
+    return {
+        'elapsed': elapsed,
+        'pages_per_sec': _stat(log, 'response_received_count') / elapsed,
+        'items_per_sec': dict((what, count / elapsed) for what, count in items.items()),
+        'peak_rss_mb': _stat(log, 'memusage/max') / 1024.0 / 1024.0,
+        'output_bytes_per_sec': output_bytes / elapsed,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--concurrency', type=int, action='append',
+                        help='CONCURRENT_REQUESTS value(s) to run with')
+    parser.add_argument('--spider', action='append', choices=sorted(SPIDER_ARGS),
+                        help='only run the given spider(s)')
+    parser.add_argument('--size', type=int, default=2000,
+                        help='number of products and of users of the mock site')
+    parser.add_argument('--tag-pages', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='average response latency of the mock site, in seconds')
+    parser.add_argument('--duration', type=int, default=30,
+                        help='seconds after which each crawl is closed')
+    args = parser.parse_args(argv)
+
+    server = mocksite.start(args.size, args.latency, args.tag_pages)
+    proxy = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+    for spider in args.spider or sorted(SPIDER_ARGS):
+        for concurrency in args.concurrency or [1, 4, 16, 64]:
+            metrics = crawl(spider, proxy, concurrency, args.duration)
+            print('{0:<12} concurrency {1:>3} {2[pages_per_sec]:>8.1f} pages/s'
+                  ' {2[peak_rss_mb]:>7.1f} MB peak {3:>8.1f} KB/s exported  {4}'
+                  .format(spider, concurrency, metrics,
+                          metrics['output_bytes_per_sec'] / 1024.0,
+                          ' '.join('{0} {1:.1f}/s'.format(what, rate) for what, rate
+                                   in sorted(metrics['items_per_sec'].items()) if rate)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks the request dupefilters on synthetic cosme.net URLs.
+
+Reports lookups/sec and memory per URL for Scrapy's in-memory
+RFPDupeFilter and for the disk-backed BloomDupeFilter. Each filter runs
+in its own process, and its memory is the growth of the peak RSS while
+the URLs were added.
+
+Usage:
+    python -m bench.dupefilter [--urls N] [--error-rate P]
+'''
+
+import argparse
+import sys
+
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy.http import Request
+from scrapy.utils.request import request_fingerprint
+
+from bench.common import timed, peak_rss_mb, run_isolated
+from cosmebot.dupefilters import BloomDupeFilter
+
+
+URL_TEMPLATES = (
+    'http://www.cosme.net/product/product_id/{0}/top',
+    'http://www.cosme.net/product/product_id/{0}/beautists/page/{1}',
+    'http://my.cosme.net/open_top/show/user_id/{0}',
+    'http://my.cosme.net/open/entry/reviewlist/list/page/{1}/srt/0/sad/0/dst/1/user_id/{0}',
+    'http://www.cosme.net/brand/brand_id/{0}/products/page-{1}',
+)
+
+
+def fingerprints(n):
+    '''
+    Yields `n` distinct request fingerprints. Fingerprinting is done up
+    front, so that only the filter itself is timed.
+    '''
+    for i in range(n):
+        template = URL_TEMPLATES[i % len(URL_TEMPLATES)]
+        yield request_fingerprint(Request(template.format(i, i % 50)))
+
+
+def _bench(name, n, capacity, error_rate):
+    fps = list(fingerprints(n))
+    before = peak_rss_mb()
+    if name == 'rfp':
+        dupefilter = RFPDupeFilter()
+        seen = dupefilter.fingerprints
+
+        def add(fp):
+            if fp in seen:
+                return True
+            seen.add(fp)
+            return False
+        bytes_on_disk = 0
+    else:
+        dupefilter = BloomDupeFilter(capacity=capacity, error_rate=error_rate)
+        add = dupefilter.filter.add
+        bytes_on_disk = dupefilter.filter.nbytes
+
+    def run():
+        return sum(1 for fp in fps if add(fp))
+
+    elapsed, false_positives = timed(run)
+    # Lookups of already seen keys
+    lookup_elapsed, _ = timed(run)
+    grown = peak_rss_mb() - before
+    dupefilter.close('finished')
+    return {
+        'inserts_per_sec': n / elapsed,
+        'lookups_per_sec': n / lookup_elapsed,
+        'rss_bytes_per_url': grown * 1024 * 1024 / n,
+        'disk_bytes_per_url': bytes_on_disk / float(n),
+        'false_positives': false_positives,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--urls', type=int, default=1000000,
+                        help='number of distinct URLs to add')
+    parser.add_argument('--error-rate', type=float, default=0.0001,
+                        help='false positive rate of the Bloom filter')
+    args = parser.parse_args(argv)
+
+    for name in ('rfp', 'bloom'):
+        result = run_isolated(_bench, name, args.urls, args.urls, args.error_rate)
+        print('{0:<6} {1[inserts_per_sec]:>10.0f} inserts/s {1[lookups_per_sec]:>10.0f} lookups/s'
+              ' {1[rss_bytes_per_url]:>7.1f} B/url RSS {1[disk_bytes_per_url]:>5.2f} B/url on disk'
+              ' {1[false_positives]:>6} false positives'.format(name, result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
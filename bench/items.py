@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+'''
+Memory taken by scraped items, with and without COMPACT_ITEMS.
+
+The product, review and user fixtures are parsed `--repeat` times by the
+spider callbacks and all the items are kept, as when pipelines hold many
+items in flight. For each item type this reports the bytes retained per
+item (the item, its values and everything they reference, strings shared
+between items counted once), and the RSS growth of the process, for the
+regular and for the compact item classes. Compact items are checked to
+hold the same values as regular ones.
+
+Usage:
+    python -m bench.items [--repeat N]
+'''
+
+import argparse
+import gc
+import sys
+from collections import defaultdict
+
+from scrapy.http import Request
+
+from bench.common import load_fixtures, make_response, make_spider, peak_rss_mb, run_isolated
+from cosmebot.items import COMPACT_ITEM_CLASSES
+from cosmebot.pipelines import item_type
+
+
+CALLBACKS = ('parse_product', 'parse_reviews', 'parse_user')
+
+
+def retained_bytes(objects):
+    '''
+    Total size of `objects` and of all the objects they reference, each
+    counted once. Classes are left out.
+    '''
+    seen = set()
+    stack = list(objects)
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return total
+
+
+def _parse(compact, fixtures, repeat):
+    spider = make_spider('atcosme')
+    if compact:
+        spider.item_classes = COMPACT_ITEM_CLASSES
+    items = defaultdict(list)
+    start_rss = peak_rss_mb()
+    for _ in range(repeat):
+        for fixture in fixtures:
+            callback = getattr(spider, fixture['callback'])
+            for result in callback(make_response(fixture)) or ():
+                if not isinstance(result, Request):
+                    items[item_type(result)].append(result)
+    rss_mb = peak_rss_mb() - start_rss
+
+    gc.collect()
+    return {
+        'bytes_per_item': dict((what, retained_bytes(found) / float(len(found)))
+                               for what, found in items.items()),
+        'counts': dict((what, len(found)) for what, found in items.items()),
+        'rss_mb': rss_mb,
+        # From the first pass, to compare the values of both modes
+        'values': dict((what, [dict(item) for item in found[:len(found) // repeat]])
+                       for what, found in items.items()),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=2000,
+                        help='number of passes over the fixtures')
+    args = parser.parse_args(argv)
+
+    fixtures = [f for f in load_fixtures() if f.get('callback') in CALLBACKS]
+    regular = run_isolated(_parse, False, fixtures, args.repeat)
+    compact = run_isolated(_parse, True, fixtures, args.repeat)
+    if compact['values'] != regular['values']:
+        print('MISMATCH: compact items hold different values')
+        return 1
+
+    for what in sorted(regular['counts']):
+        before = regular['bytes_per_item'][what]
+        after = compact['bytes_per_item'][what]
+        print('items.{0:<10} {1:>8} items {2:>8.0f} bytes/item regular'
+              ' {3:>8.0f} bytes/item compact  {4:+.1%}'
+              .format(what, regular['counts'][what], before, after, after / before - 1.0))
+    print('RSS growth {0:.1f} MB regular, {1:.1f} MB compact'
+          .format(regular['rss_mb'], compact['rss_mb']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks link extraction: CrawlSpider running one LxmlLinkExtractor per
+rule versus the single-pass RoutingLinkExtractor.
+
+Both paths are run over every fixture; the script fails if they do not
+yield the same requests (compared by canonical URL, since routed requests
+are canonicalized), and otherwise reports the CPU time per page and the
+time saved by routing.
+
+Usage:
+    python -m bench.links [--repeat N] [--save-baseline]
+'''
+
+import argparse
+import sys
+
+from scrapy.spiders import CrawlSpider
+
+from bench.common import (load_fixtures, make_response, make_spider, timed,
+                          load_baseline, save_baseline, compare)
+from cosmebot.urls import canonical_url
+
+
+def _per_rule(spider, response):
+    return list(CrawlSpider._requests_to_follow(spider, response))
+
+
+def _routed(spider, response):
+    return list(spider._requests_to_follow(response))
+
+
+def _signature(requests):
+    return sorted(set((canonical_url(r.url), r.meta['rule']) for r in requests))
+
+
+def _time(extract, spider, fixture, repeat):
+    def run():
+        for _ in range(repeat):
+            extract(spider, make_response(fixture))
+    elapsed, _ = timed(run)
+    return elapsed / repeat * 1000.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='number of passes over each fixture')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed slowdown against the baseline (fraction)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline')
+    args = parser.parse_args(argv)
+
+    spiders = {}
+    results = {}
+    for fixture in load_fixtures():
+        if fixture['spider'] not in spiders:
+            spiders[fixture['spider']] = make_spider(fixture['spider'])
+        spider = spiders[fixture['spider']]
+
+        expected = _signature(_per_rule(spider, make_response(fixture)))
+        actual = _signature(_routed(spider, make_response(fixture)))
+        if expected != actual:
+            print('MISMATCH {0}: per-rule {1} requests, routed {2}'
+                  .format(fixture['file'], len(expected), len(actual)))
+            return 1
+
+        per_rule = _time(_per_rule, spider, fixture, args.repeat)
+        routed = _time(_routed, spider, fixture, args.repeat)
+        name = 'links.{0}'.format(fixture['file'])
+        results[name] = {'routed_ms_per_page': routed}
+        print('{0:<40} {1:>4} links  per-rule {2:>7.3f} ms  routed {3:>7.3f} ms'
+              '  saved {4:>7.3f} ms/page ({5:.0%})'
+              .format(name, len(actual), per_rule, routed, per_rule - routed,
+                      1.0 - routed / per_rule))
+
+    if args.save_baseline:
+        save_baseline(results)
+        return 0
+
+    baseline = load_baseline()
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        regressions += compare(name, metrics, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
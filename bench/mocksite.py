@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+'''
+A synthetic cosme.net, served by a local HTTP proxy.
+
+Pages are the HTML fixtures, with the product, user and brand ids in their
+links remapped to a graph of `--size` products and users and `--size / 20`
+brands, so that every page links to other pages of the graph, in the
+markup the spiders expect. References of a page to itself (a user page to
+the user's reviews, ...) keep pointing to the page's own id. Tag pages get
+a pager over `--tag-pages` pages.
+
+Point a crawl at it with the `http_proxy` environment variable: requests
+for www.cosme.net and my.cosme.net then reach this server, which answers
+them after `--latency` seconds on average. Used by `bench.crawl`.
+
+Usage:
+    python -m bench.mocksite [--port PORT] [--size N] [--latency SECONDS]
+'''
+
+import argparse
+import os
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+
+from six.moves import BaseHTTPServer, socketserver
+
+from bench.common import FIXTURES_DIR
+
+
+PRODUCT_BASE = 10084858
+USER_BASE = 1359201
+BRAND_BASE = 493
+
+# Page shapes: URL pattern => fixture used as a template
+PAGES = (
+    (re.compile(r'^http://www\.cosme\.net/product/product_id/\d+/top$'), 'product.html'),
+    (re.compile(r'^http://www\.cosme\.net/product/product_id/\d+/beautists(/page/\d+)?$'),
+     'beautists.html'),
+    (re.compile(r'^http://my\.cosme\.net/open_entry_reviewlist/list/user_id/\d+/dst/1$'),
+     'reviews.html'),
+    (re.compile(r'^http://my\.cosme\.net/open/entry/reviewlist/list/page/\d+'
+                r'/srt/0/sad/0/dst/1/user_id/\d+$'), 'reviews.html'),
+    (re.compile(r'^http://my\.cosme\.net/open_top/show/user_id/\d+$'), 'user.html'),
+    (re.compile(r'^http://www\.cosme\.net/brand/brand_id/\d+/top$'), 'brand.html'),
+    (re.compile(r'^http://www\.cosme\.net/brand/brand_id/\d+/products(/page-\d+)?$'),
+     'brand_products.html'),
+    (re.compile(r'^http://www\.cosme\.net/tags/(page/\d+/)?search/\d+$'), 'tags.html'),
+)
+
+ID_RE = re.compile(r'(product_id|user_id|brand_id)/(\d+)')
+PAGER_RE = re.compile(r'<div class="pager">.*?</div>', re.S)
+TAG_PAGE_RE = re.compile(r'tags/(?:page/(\d+)/)?search/(\d+)')
+
+
+class MockSite(object):
+    '''
+    Renders the pages of the synthetic graph.
+    '''
+    def __init__(self, size=1000, tag_pages=50):
+        self.counts = {
+            'product_id': (PRODUCT_BASE, size),
+            'user_id': (USER_BASE, size),
+            'brand_id': (BRAND_BASE, max(1, size // 20)),
+        }
+        self.tag_pages = tag_pages
+        self.templates = {}
+        for _, name in PAGES:
+            with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+                self.templates[name] = f.read().decode('utf-8')
+
+    def _remap(self, url):
+        # The fixtures use the first id of each kind for the page itself
+        own_ids = dict(ID_RE.findall(url))
+
+        def replace(match):
+            kind, id = match.groups()
+            if kind in own_ids and int(id) == self.counts[kind][0]:
+                return '{0}/{1}'.format(kind, own_ids[kind])
+            base, count = self.counts[kind]
+            h = zlib.crc32('{0} {1} {2}'.format(url, kind, id).encode('utf-8')) & 0xffffffff
+            return '{0}/{1}'.format(kind, base + h % count)
+        return replace
+
+    def _tag_pager(self, url):
+        match = TAG_PAGE_RE.search(url)
+        page = int(match.group(1) or 1)
+        last = min(self.tag_pages, page + 4)
+        return '<div class="pager">\n{0}\n</div>'.format('\n'.join(
+            '<a href="http://www.cosme.net/tags/page/{0}/search/{1}#result">{0}</a>'
+            .format(n, match.group(2)) for n in range(max(1, page - 4), last + 1)))
+
+    def _top(self):
+        links = []
+        for kind, path in (('product_id', 'http://www.cosme.net/product/product_id/{0}/top'),
+                           ('brand_id', 'http://www.cosme.net/brand/brand_id/{0}/top'),
+                           ('user_id', 'http://my.cosme.net/open_top/show/user_id/{0}')):
+            base, count = self.counts[kind]
+            links += [path.format(base + n) for n in range(min(count, 20))]
+        return (u'<!DOCTYPE html>\n<html lang="ja">\n<head><meta charset="utf-8">'
+                u'<title>@cosme</title></head>\n<body>\n<ul>\n{0}\n</ul>\n</body>\n</html>\n'
+                .format(u'\n'.join(u'<li><a href="{0}">{0}</a></li>'.format(link)
+                                   for link in links)))
+
+    def render(self, url):
+        '''
+        Returns the body of the page at `url`, or None if there is none.
+        '''
+        if url in ('http://www.cosme.net/', 'http://www.cosme.net'):
+            return self._top().encode('utf-8')
+        for pattern, name in PAGES:
+            if pattern.match(url):
+                break
+        else:
+            return None
+
+        body = ID_RE.sub(self._remap(url), self.templates[name])
+        if name == 'tags.html':
+            body = PAGER_RE.sub(self._tag_pager(url), body)
+        return body.encode('utf-8')
+
+
+class MockServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, site, latency=0.0, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), MockHandler)
+        self.site = site
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency * random.uniform(0.5, 1.5))
+        # As a proxy, the request line holds the absolute URL
+        body = server.site.render(self.path.split('#')[0])
+        if body is None:
+            self._reply(404, b'', 'text/plain')
+        else:
+            self._reply(200, body, 'text/html; charset=utf-8')
+
+    def _reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start(size=1000, latency=0.0, tag_pages=50, port=0):
+    '''
+    Starts a mock site server in a thread and returns it; its address is
+    `server.server_address`.
+    '''
+    server = MockServer(MockSite(size, tag_pages), latency, port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--size', type=int, default=1000,
+                        help='number of products and of users')
+    parser.add_argument('--tag-pages', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='average response latency in seconds')
+    args = parser.parse_args(argv)
+
+    server = start(args.size, args.latency, args.tag_pages, args.port)
+    print('Serving a mock cosme.net on http_proxy=http://127.0.0.1:{0}'
+          .format(server.server_address[1]))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
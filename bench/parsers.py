@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks each spider callback over the saved HTML fixtures.
+
+For every callback listed in `fixtures/manifest.json` this reports
+pages/sec, items/sec and the peak RSS of a process that only ran that
+callback, and compares the numbers against `baseline.json`.
+
+With `--fields`, each callback also runs with that field selection (the
+`fields` spider argument), and the speedup over extracting all the fields
+is reported.
+
+Usage:
+    python -m bench.parsers                   # compare with the baseline
+    python -m bench.parsers --save-baseline   # record a new baseline
+    python -m bench.parsers --fields 'review:user_id,product_id,rating'
+'''
+
+import argparse
+import sys
+from collections import defaultdict
+
+from scrapy.http import Request
+
+from bench.common import (load_fixtures, make_response, make_spider, timed,
+                          peak_rss_mb, run_isolated, load_baseline,
+                          save_baseline, compare)
+
+
+def _consume(callback, fixtures, repeat):
+    items = 0
+    for _ in range(repeat):
+        for fixture in fixtures:
+            for result in callback(make_response(fixture)) or ():
+                if not isinstance(result, Request):
+                    items += 1
+    return items
+
+
+def bench_callback(spider_name, callback_name, fixtures, repeat, fields=None):
+    spider = make_spider(spider_name, fields=fields)
+    callback = getattr(spider, callback_name)
+
+    # Warm up lxml and the selector caches before timing
+    _consume(callback, fixtures, 1)
+
+    elapsed, items = timed(_consume, callback, fixtures, repeat)
+    pages = len(fixtures) * repeat
+    return {
+        'pages_per_sec': pages / elapsed,
+        'items_per_sec': items / elapsed,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='number of passes over the fixtures per callback')
+    parser.add_argument('--callback', action='append',
+                        help='only benchmark the given callback(s)')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed slowdown against the baseline (fraction)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--fields',
+                        help='also run with this field selection, e.g.'
+                             ' "review:user_id,product_id,rating;product:product_id"')
+    args = parser.parse_args(argv)
+
+    groups = defaultdict(list)
+    for fixture in load_fixtures():
+        if fixture.get('callback'):
+            groups[(fixture['spider'], fixture['callback'])].append(fixture)
+
+    results = {}
+    for (spider_name, callback_name), fixtures in sorted(groups.items()):
+        if args.callback and callback_name not in args.callback:
+            continue
+        name = 'parsers.{0}.{1}'.format(spider_name, callback_name)
+        results[name] = run_isolated(bench_callback, spider_name, callback_name,
+                                     fixtures, args.repeat)
+        print('{0:<40} {1[pages_per_sec]:>10.1f} pages/s {1[items_per_sec]:>10.1f} items/s'
+              ' {1[peak_rss_mb]:>8.1f} MB peak'.format(name, results[name]))
+        if args.fields:
+            projected = run_isolated(bench_callback, spider_name, callback_name,
+                                     fixtures, args.repeat, args.fields)
+            print('{0:<40} {1[pages_per_sec]:>10.1f} pages/s {1[items_per_sec]:>10.1f} items/s'
+                  ' {1[peak_rss_mb]:>8.1f} MB peak  x{2:.2f} with --fields'
+                  .format('', projected,
+                          projected['pages_per_sec'] / results[name]['pages_per_sec']))
+
+    if args.save_baseline:
+        save_baseline(results)
+        return 0
+
+    baseline = load_baseline()
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        regressions += compare(name, metrics, baseline, args.tolerance,
+                               higher_is_better=('pages_per_sec', 'items_per_sec'))
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
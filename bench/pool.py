@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+'''
+Measures how parsing throughput scales with the number of worker
+processes used with PARSE_PROCESSES.
+
+Every fixture with a callback is parsed `--repeat` times by
+`cosmebot.workers.parse` (callback and link routing, as done for a crawl),
+in pools of 1, 2, 4, ... processes up to the number of CPUs. The results
+of the first run are checked against parsing in this process.
+
+Usage:
+    python -m bench.pool [--repeat N] [--processes N ...]
+'''
+
+import argparse
+import multiprocessing
+import sys
+
+from scrapy.utils.project import get_project_settings
+
+from bench.common import SPIDERS, load_fixtures, timed
+from cosmebot import workers
+
+
+HEADERS = {'Content-Type': 'text/html; charset=utf-8'}
+
+
+def _tasks(fixtures):
+    tasks = []
+    for fixture in fixtures:
+        spidercls = SPIDERS[fixture['spider']]
+        rules = spidercls()._rules
+        rule = [n for n, r in enumerate(rules)
+                if r.callback and r.callback.__name__ == fixture['callback']][0]
+        tasks.append((fixture['spider'], (rule, fixture['url'], HEADERS,
+                                          fixture['body'], True)))
+    return tasks
+
+
+def _parse(args):
+    return workers.parse(*args)
+
+
+def _without_timings(results):
+    return [(ok, value[:2] if ok else value) for ok, value in results]
+
+
+def _run(spidercls, tasks, processes, repeat):
+    pool = multiprocessing.Pool(processes, workers.init_worker,
+                                (spidercls, {}, get_project_settings()))
+    try:
+        pool.map(_parse, tasks)  # start up and warm up the workers
+        elapsed, results = timed(pool.map, _parse, tasks * repeat,
+                                 max(1, len(tasks) * repeat // (processes * 4)))
+    finally:
+        pool.terminate()
+    return elapsed, results[:len(tasks)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=100,
+                        help='number of passes over the fixtures')
+    parser.add_argument('--processes', type=int, action='append',
+                        help='pool size(s) to measure')
+    args = parser.parse_args(argv)
+
+    sizes = args.processes or [n for n in (1, 2, 4, 8, 16, 32)
+                               if n <= multiprocessing.cpu_count()]
+    tasks = {}
+    for spider_name, task in _tasks(f for f in load_fixtures() if f.get('callback')):
+        tasks.setdefault(spider_name, []).append(task)
+
+    for spider_name, spider_tasks in sorted(tasks.items()):
+        spidercls = SPIDERS[spider_name]
+        workers.init_worker(spidercls, {}, get_project_settings())
+        expected = _without_timings(workers.parse(*task) for task in spider_tasks)
+
+        single = None
+        for processes in sizes:
+            elapsed, results = _run(spidercls, spider_tasks, processes, args.repeat)
+            if _without_timings(results) != expected:
+                print('MISMATCH {0}: pool of {1} parsed differently'
+                      .format(spider_name, processes))
+                return 1
+            rate = len(spider_tasks) * args.repeat / elapsed
+            single = single or rate
+            print('{0:<12} {1:>3} processes {2:>10.1f} pages/s  x{3:.2f}'
+                  .format(spider_name, processes, rate, rate / single))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+'''
+Throughput of sharded crawls (`scrapy shard`) against the local mock
+cosme.net.
+
+Starts `bench.mocksite`, crawls all of it with `atcosme` in one process
+(`scrapy crawl`), then with `scrapy shard` and 2, 4, ... processes, each
+crawl in a fresh working directory. Reports the time taken and pages/s,
+and checks that the merged outputs of each sharded crawl hold the same
+items as the single process crawl.
+
+Usage:
+    python -m bench.shard [--shards N ...] [--size N] [--latency SECONDS]
+'''
+
+import argparse
+import glob
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import mocksite
+from bench.crawl import _stat, crawl_environment, crawl_settings
+from cosmebot.pipelines import MultiJsonLinesItemPipeline
+
+
+def _outputs(workdir):
+    outputs = {}
+    for what in MultiJsonLinesItemPipeline.save_types:
+        with open(os.path.join(workdir, what + '.json'), 'rb') as f:
+            outputs[what] = sorted(f)
+    return outputs
+
+
+def crawl(proxy, concurrency, shards):
+    '''
+    Crawls the whole mock site, in one process if `shards` is 0; returns
+    the time taken, the number of pages and the outputs.
+    '''
+    workdir = tempfile.mkdtemp(prefix='bench-shard-')
+    env = crawl_environment(workdir, proxy)
+    if shards:
+        command = ['shard', 'atcosme', '-n', str(shards)]
+    else:
+        command = ['crawl', 'atcosme', '-s', 'LOG_FILE=crawl.log']
+    command = ([sys.executable, '-m', 'scrapy.cmdline'] + command +
+               crawl_settings(concurrency))
+
+    try:
+        start = time.time()
+        process = subprocess.Popen(command, cwd=workdir, env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0].decode('utf-8', 'replace')
+        elapsed = time.time() - start
+        logs = glob.glob(os.path.join(workdir, 'crawl.log'))
+        logs += glob.glob(os.path.join(workdir, 'shards', 'shard-*', 'crawl.log'))
+        pages = 0
+        for path in logs:
+            with open(path, 'rb') as f:
+                log = f.read().decode('utf-8', 'replace')
+            if 'Spider closed (finished)' not in log:
+                raise RuntimeError('crawl failed:\n' + output[-1000:] + log[-2000:])
+            pages += _stat(log, 'response_received_count')
+        if process.returncode or not logs:
+            raise RuntimeError('crawl failed:\n' + output[-2000:])
+        outputs = _outputs(workdir)
+    finally:
+        shutil.rmtree(workdir)
+    return elapsed, pages, outputs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--shards', type=int, action='append',
+                        help='number(s) of processes to crawl with')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='CONCURRENT_REQUESTS of each process')
+    parser.add_argument('--size', type=int, default=200,
+                        help='number of products and of users of the mock site')
+    parser.add_argument('--tag-pages', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='average response latency of the mock site, in seconds')
+    args = parser.parse_args(argv)
+
+    server = mocksite.start(args.size, args.latency, args.tag_pages)
+    proxy = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+    elapsed, pages, expected = crawl(proxy, args.concurrency, 0)
+    single = pages / elapsed
+    print('atcosme        1 process  {0:>7.1f}s {1:>6} pages {2:>8.1f} pages/s  {3}'
+          .format(elapsed, pages, single, ' '.join(
+              '{0} {1}'.format(what, len(lines)) for what, lines in sorted(expected.items()))))
+
+    sizes = args.shards or [n for n in (2, 4, 8, 16) if n <= multiprocessing.cpu_count()]
+    for shards in sizes:
+        elapsed, pages, outputs = crawl(proxy, args.concurrency, shards)
+        if outputs != expected:
+            print('MISMATCH: the outputs of {0} shards differ from one process'.format(shards))
+            return 1
+        rate = pages / elapsed
+        print('atcosme shard {0:>3} processes {1:>5.1f}s {2:>6} pages {3:>8.1f} pages/s  x{4:.2f}'
+              .format(shards, elapsed, pages, rate, rate / single))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+'''
+Equivalence check and benchmark for `AtcosmeSpider._parse_review_tag_list`.
+
+The single-pass implementation is compared with the original selector
+based grouping (kept below as the reference) on every review of the
+review-list fixtures, plus a few hand-written edge cases. The script exits
+non-zero on the first difference.
+
+Usage:
+    python -m bench.tag_list [--repeat N]
+'''
+
+import argparse
+import sys
+
+from scrapy.http import HtmlResponse
+from scrapy.selector import Selector
+
+from bench.common import load_fixtures, make_response, make_spider, timed
+from cosmebot.items import Review
+from cosmebot.selectors import root
+from cosmebot.spiders.atcosme import REVIEW_SECS
+
+
+EDGE_CASES = [
+    # Values nested in links, with and without surrounding whitespace
+    u'<dl><dt>効果</dt><dd><a>保湿</a></dd><dd>\n  <a>ツヤ</a></dd></dl>',
+    # <dd>s before the first <dt> and a <dt> without any <dd>
+    u'<dl><dd>x</dd><dt>色</dt><dt>効果</dt><dd><span><b>発色</b></span></dd></dl>',
+    # Comments inside <dd>
+    u'<dl><dt>購入場所</dt><dd><!-- ad --><a>ネット</a></dd></dl>',
+    # Groups continuing across several <dl>s, unknown keys and empty <dd>s
+    u'<dl><dt>商品情報</dt><dd>限定品</dd></dl><dl><dd>プチプラ</dd><dt>他</dt>'
+    u'<dd>a</dd><dt>関連ワード</dt><dd></dd><dd><a></a>tail</dd></dl>',
+    # Key text after a child element
+    u'<dl><dt><span></span>色</dt><dd>赤</dd></dl>',
+]
+
+_tag_mappings = {
+    u'購入場所': 'purchase_location',
+    u'効果': 'effects',
+    u'色': 'colors',
+    u'商品情報': 'product_tags',
+    u'関連ワード': 'related_words',
+}
+
+
+def reference_parse_review_tag_list(response, review):
+    '''
+    The original implementation, which serializes every <dt>/<dd> to test
+    its tag name and runs one XPath per <dd>.
+    '''
+    def _group_dds(tags):
+        dt = None
+        dds = []
+        for tag in tags:
+            if tag.extract().startswith('<dt>'):
+                if dt and dds:
+                    yield dt, dds
+                dt = tag
+                dds = []
+            elif tag.extract().startswith('<dd>'):
+                dds.append(tag)
+        if dt and dds:
+            yield dt, dds
+
+    children = response.css('div.tag-list > dl > dt,div.tag-list > dl > dd')
+    for dt, dds in _group_dds(children):
+        key = dt.xpath('./text()').extract_first()
+        values = [dd.xpath('./descendant-or-self::*/text()').extract_first()
+                  for dd in dds]
+        if key in _tag_mappings:
+            review[_tag_mappings[key]] = values
+
+
+def _edge_case_responses():
+    for i, html in enumerate(EDGE_CASES):
+        body = (u'<html><body><div class="review-sec"><div class="tag-list">{0}'
+                u'</div></div></body></html>').format(html)
+        yield HtmlResponse('http://my.cosme.net/edge/{0}'.format(i),
+                           body=body.encode('utf-8'), encoding='utf-8')
+
+
+def check(spider, responses):
+    reviews = 0
+    for response in responses:
+        divs = Selector(response).css('div.review-sec')
+        for div, element in zip(divs, REVIEW_SECS(root(response))):
+            expected, actual = Review(), Review()
+            reference_parse_review_tag_list(div, expected)
+            spider._parse_review_tag_list(element, actual)
+            if dict(expected) != dict(actual):
+                print('MISMATCH {0}\n  expected {1!r}\n  actual   {2!r}'
+                      .format(response.url, dict(expected), dict(actual)))
+                return None
+            reviews += 1
+    return reviews
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=500,
+                        help='number of passes over the review fixtures')
+    args = parser.parse_args(argv)
+
+    spider = make_spider('atcosme')
+    fixtures = [f for f in load_fixtures() if f['callback'] == 'parse_reviews']
+    responses = [make_response(f) for f in fixtures] + list(_edge_case_responses())
+
+    reviews = check(spider, responses)
+    if reviews is None:
+        return 1
+    print('{0} reviews identical'.format(reviews))
+
+    divs = [div for response in responses
+            for div in Selector(response).css('div.review-sec')]
+    elements = [element for response in responses
+                for element in REVIEW_SECS(root(response))]
+
+    def run_reference():
+        for _ in range(args.repeat):
+            for div in divs:
+                reference_parse_review_tag_list(div, Review())
+
+    def run_single_pass():
+        for _ in range(args.repeat):
+            for element in elements:
+                spider._parse_review_tag_list(element, Review())
+
+    reference, _ = timed(run_reference)
+    single_pass, _ = timed(run_single_pass)
+    calls = float(args.repeat * len(elements))
+    print('reference   {0:>8.1f} us/review'.format(reference / calls * 1e6))
+    print('single pass {0:>8.1f} us/review ({1:.1f}x)'
+          .format(single_pass / calls * 1e6, reference / single_pass))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
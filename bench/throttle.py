@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+'''
+Drives one ThrottleController per host against local mock servers that
+inject latency and errors.
+
+Two servers stand in for www.cosme.net and my.cosme.net, each with its own
+base latency, capacity and error rate. Latency grows with the number of
+requests in flight, requests beyond the capacity get a 429, and a share of
+the others a 503. A client per host keeps `concurrency` requests in flight
+spaced by `delay`, as a Scrapy download slot does, and reports the
+controller's state every second.
+
+Before that, it checks `AdaptiveThrottleMiddleware` itself on a steady
+host: after one very fast response (a 304, say) and one from the HTTP
+cache, the slot's concurrency must climb back to its ceiling.
+
+Usage:
+    python -m bench.throttle [--duration SECONDS]
+'''
+
+import argparse
+import random
+import sys
+import threading
+import time
+
+from scrapy.core.downloader import Slot
+from scrapy.http import Request, Response
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.request import urlopen
+
+from cosmebot.middlewares import AdaptiveThrottleMiddleware, ThrottleController
+
+
+HOSTS = {
+    # name: (base latency in seconds, capacity, error rate)
+    'www.cosme.net': (0.05, 4, 0.01),
+    'my.cosme.net': (0.3, 2, 0.05),
+}
+
+
+class MockServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency, capacity, error_rate):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), MockHandler)
+        self.latency = latency
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            in_flight = server.in_flight
+        try:
+            if in_flight > server.capacity:
+                self._reply(429, b'')
+                return
+            time.sleep(server.latency * (1 + float(in_flight) / server.capacity) *
+                       random.uniform(0.8, 1.2))
+            if random.random() < server.error_rate:
+                self._reply(503, b'')
+            else:
+                self._reply(200, b'<html><body>ok</body></html>')
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Client(object):
+    '''
+    Issues requests to one server following its controller's delay and
+    concurrency.
+    '''
+    def __init__(self, url, controller):
+        self.url = url
+        self.controller = controller
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.responses = 0
+        self.errors = 0
+
+    def _fetch(self):
+        start = time.time()
+        try:
+            urlopen(self.url, timeout=10).read()
+            error = False
+        except Exception:
+            # HTTP errors (429, 503) as well as timeouts
+            error = True
+        latency = time.time() - start
+        with self.lock:
+            self.in_flight -= 1
+            if error:
+                self.errors += 1
+                self.controller.on_error()
+            else:
+                self.responses += 1
+                self.controller.on_success(latency)
+
+    def run(self, until):
+        while time.time() < until:
+            with self.lock:
+                can_start = self.in_flight < self.controller.concurrency
+                if can_start:
+                    self.in_flight += 1
+                delay = self.controller.delay
+            if can_start:
+                thread = threading.Thread(target=self._fetch)
+                thread.daemon = True
+                thread.start()
+                time.sleep(delay)
+            else:
+                time.sleep(0.01)
+
+
+class _Engine(object):
+    # The part of the engine the middleware uses: the download slots
+    def __init__(self, slots):
+        self.downloader = type('Downloader', (object,), {'slots': slots})()
+
+
+def check_middleware(responses=400, latency=0.2):
+    '''
+    Feeds `responses` responses of a steady host through the middleware,
+    with a fast one and a cached one early on; returns the concurrency of
+    the slot at its peak and at the end.
+    '''
+    crawler = get_crawler(Spider, {'ADAPTIVE_THROTTLE_ENABLED': True,
+                                   'ADAPTIVE_THROTTLE_MAX_CONCURRENCY': 8})
+    spider = crawler._create_spider('throttle')
+    slot = Slot(1, 1.0, crawler.settings)
+    crawler.engine = _Engine({'www.cosme.net': slot})
+    crawler.stats.open_spider(spider)
+    middleware = AdaptiveThrottleMiddleware.from_crawler(crawler)
+
+    peak = 0
+    for n in range(responses):
+        request = Request('http://www.cosme.net/product/product_id/{0}/top'.format(n),
+                          meta={'download_slot': 'www.cosme.net'})
+        flags = []
+        if n == 200:
+            flags = ['cached']
+        elif n == 100:
+            request.meta['download_latency'] = 0.001
+        else:
+            request.meta['download_latency'] = latency * random.uniform(0.9, 1.1)
+        response = Response(request.url, status=200, flags=flags, request=request)
+        middleware.process_response(request, response, spider)
+        if n < 100:
+            peak = max(peak, slot.concurrency)
+    return peak, slot.concurrency
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='seconds to run for')
+    parser.add_argument('--start-delay', type=float, default=1.0,
+                        help='initial delay, as DOWNLOAD_DELAY')
+    args = parser.parse_args(argv)
+
+    peak, concurrency = check_middleware()
+    print('middleware     concurrency {0} before a fast and a cached response,'
+          ' {1} at the end'.format(peak, concurrency))
+    if concurrency < peak:
+        print('FAILED: concurrency did not recover')
+        return 1
+
+    clients = {}
+    for host, (latency, capacity, error_rate) in sorted(HOSTS.items()):
+        server = MockServer(latency, capacity, error_rate)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+        clients[host] = Client(url, ThrottleController(args.start_delay, 1))
+
+    until = time.time() + args.duration
+    for client in clients.values():
+        thread = threading.Thread(target=client.run, args=(until,))
+        thread.daemon = True
+        thread.start()
+
+    while time.time() < until:
+        time.sleep(1)
+        for host, client in sorted(clients.items()):
+            controller = client.controller
+            print('{0:<14} delay {1:>6.3f}s  concurrency {2}  latency {3:>6.3f}s'
+                  '  responses {4:>5}  errors {5:>4}'
+                  .format(host, controller.delay, controller.concurrency,
+                          controller.latency or 0, client.responses, client.errors))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
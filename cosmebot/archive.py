@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+'''
+Archive of the responses downloaded by a crawl, to parse them again later
+without the network (see the `reparse` command).
+
+Bodies are zlib compressed and stored once per SHA-1 digest; each URL
+keeps the digest of its last response, along with the crawl rule that
+requested it, or START_RULE for start pages.
+'''
+
+import hashlib
+import sqlite3
+import time
+import zlib
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse
+
+from cosmebot.writers import BackgroundWriter
+
+
+# Rule of the responses to start requests, parsed by `parse_start_url`
+START_RULE = -1
+
+
+class ResponseArchive(object):
+    commit_every = 100
+
+    def __init__(self, path, readonly=False):
+        # Written from a writer thread, closed from the reactor thread
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        if readonly:
+            return
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS bodies (digest TEXT PRIMARY KEY, body BLOB)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            ' url TEXT PRIMARY KEY,'
+            ' spider TEXT,'
+            ' rule INTEGER,'
+            ' content_type TEXT,'
+            ' digest TEXT,'
+            ' fetched_at REAL)')
+        self.pending = 0
+
+    def add(self, spider, rule, url, content_type, body, fetched_at=None):
+        digest = hashlib.sha1(body).hexdigest()
+        if self.connection.execute('SELECT 1 FROM bodies WHERE digest = ?',
+                                   (digest,)).fetchone() is None:
+            self.connection.execute('INSERT INTO bodies VALUES (?, ?)',
+                                    (digest, sqlite3.Binary(zlib.compress(body))))
+        self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                                (url, spider, rule, content_type, digest,
+                                 fetched_at or time.time()))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def write(self, responses):
+        '''
+        Adds a batch of (spider, rule, URL, content type, body, fetched at)
+        tuples in one transaction.
+        '''
+        for response in responses:
+            self.add(*response)
+        self.commit()
+
+    def ids(self, spider):
+        '''
+        Returns the row ids of the responses archived by `spider` for its
+        crawl rules and its start requests. Responses archived without a
+        rule by older versions are left out.
+        '''
+        return [row[0] for row in self.connection.execute(
+            'SELECT rowid FROM responses WHERE spider = ? AND rule IS NOT NULL'
+            ' ORDER BY rowid', (spider,))]
+
+    def get(self, id):
+        '''
+        Returns the rule index (START_RULE for a start page) and the
+        `HtmlResponse` archived as `id`.
+        '''
+        url, rule, content_type, body = self.connection.execute(
+            'SELECT url, rule, content_type, body FROM responses'
+            ' JOIN bodies ON bodies.digest = responses.digest'
+            ' WHERE responses.rowid = ?', (id,)).fetchone()
+        headers = {'Content-Type': content_type} if content_type else {}
+        return rule, HtmlResponse(url, headers=headers, body=zlib.decompress(bytes(body)))
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class ArchiveWriter(BackgroundWriter):
+    '''
+    `BackgroundWriter` whose batches of responses are compressed and
+    written to a `ResponseArchive`, one transaction per batch.
+    '''
+    def _write_batch(self, batch):
+        self.file.write(batch)
+
+
+class ResponseArchiveMiddleware(object):
+    '''
+    Downloader middleware adding every successful HTML response to a
+    `ResponseArchive` (ARCHIVE_PATH), the responses to requests made
+    without a crawl rule as start pages. Enable with ARCHIVE_ENABLED.
+
+    Responses are compressed and written from a thread, in batches of
+    ARCHIVE_BATCH_SIZE. Downloader middlewares can't make a response wait,
+    so batches are queued even beyond ARCHIVE_MAX_PENDING_BATCHES, and a
+    warning is logged when the writer thread falls that far behind.
+    '''
+    def __init__(self, path, batch_size=100, max_batches=16):
+        self.writer = ArchiveWriter(ResponseArchive(path), batch_size, max_batches)
+        self.behind = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ARCHIVE_ENABLED'):
+            raise NotConfigured
+        middleware = cls(settings.get('ARCHIVE_PATH', 'archive.db'),
+                         settings.getint('ARCHIVE_BATCH_SIZE', 100),
+                         settings.getint('ARCHIVE_MAX_PENDING_BATCHES', 16))
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def spider_closed(self, spider):
+        self.writer.close()
+
+    def process_response(self, request, response, spider):
+        if response.status == 200 and isinstance(response, HtmlResponse):
+            content_type = response.headers.get('Content-Type')
+            if isinstance(content_type, bytes):
+                content_type = content_type.decode('latin-1')
+            self.writer.write((spider.name, request.meta.get('rule', START_RULE),
+                               response.url, content_type, response.body, time.time()))
+            full = self.writer.full()
+            if full and not self.behind:
+                spider.logger.warning('The archive writer is %d batches behind',
+                                      self.writer.max_batches)
+            self.behind = full
+        return response
@@ -0,0 +1,2 @@
+# This package contains the project's Scrapy commands, found through the
+# COMMANDS_MODULE setting
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import multiprocessing
+import time
+from collections import defaultdict
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.conf import arglist_to_dict
+
+from cosmebot.archive import ResponseArchive
+from cosmebot.pipelines import MultiJsonLinesItemPipeline
+from cosmebot.workers import init_process, init_worker, make_item, reparse
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(ScrapyCommand):
+    '''
+    Runs the callbacks of a spider over the responses archived by
+    ResponseArchiveMiddleware, in a pool of processes, and exports the
+    items as `scrapy crawl` would, with MultiJsonLinesItemPipeline.
+    '''
+    requires_project = True
+
+    def syntax(self):
+        return '[options] <spider>'
+
+    def short_desc(self):
+        return 'Parse the archived responses of a spider again, without crawling'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option('-a', dest='spargs', action='append', default=[],
+                          metavar='NAME=VALUE', help='set spider argument (may be repeated)')
+        parser.add_option('--archive', metavar='PATH',
+                          help='response archive (default: ARCHIVE_PATH)')
+        parser.add_option('--processes', type='int', metavar='N',
+                          help='number of worker processes (default: one per CPU)')
+
+    def process_options(self, args, opts):
+        ScrapyCommand.process_options(self, args, opts)
+        try:
+            opts.spargs = arglist_to_dict(opts.spargs)
+        except ValueError:
+            raise UsageError('Invalid -a value, use -a NAME=VALUE', print_help=False)
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        spidercls = self.crawler_process.spider_loader.load(args[0])
+        path = opts.archive or self.settings.get('ARCHIVE_PATH', 'archive.db')
+
+        archive = ResponseArchive(path, readonly=True)
+        ids = archive.ids(spidercls.name)
+        archive.close()
+
+        spider = spidercls(**opts.spargs)
+        spider._configure(self.settings)
+        pipeline = MultiJsonLinesItemPipeline(self.settings)
+        pipeline.spider_opened(spider)
+        pool = multiprocessing.Pool(opts.processes, init_process,
+                                    (init_worker, (spidercls, opts.spargs, self.settings, path)))
+        counts = defaultdict(int)
+        start = time.time()
+        try:
+            for items in pool.imap(reparse, ids, chunksize=16):
+                for what, fields in items:
+                    if what in pipeline.save_types:
+                        # Directly, as there is no reactor to wait on
+                        pipeline._export(what, make_item(what, fields))
+                    counts[what] += 1
+        finally:
+            pool.terminate()
+            pipeline.spider_closed(spider)
+
+        elapsed = time.time() - start
+        logger.info('Parsed %(responses)d responses in %(elapsed).1fs'
+                    ' (%(rate).1f responses/s): %(items)s',
+                    {'responses': len(ids), 'elapsed': elapsed,
+                     'rate': len(ids) / elapsed if elapsed else 0,
+                     'items': ', '.join('{0} {1}'.format(count, what)
+                                        for what, count in sorted(counts.items()))})
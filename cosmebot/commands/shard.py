@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.conf import arglist_to_dict, closest_scrapy_cfg
+
+from cosmebot.pipelines import MultiJsonLinesItemPipeline
+from cosmebot.sharding import Frontier
+from cosmebot.writers import read_lines
+
+
+logger = logging.getLogger(__name__)
+
+
+def shard_outputs(directory, what):
+    '''
+    The JSON lines outputs of type `what` written in `directory`: the
+    `<what>.json` file, or its segments.
+    '''
+    paths = glob.glob(os.path.join(directory, what + '.json'))
+    return paths + sorted(glob.glob(os.path.join(directory, what + '-[0-9]*.json*')))
+
+
+def merge_outputs(directories, what, path):
+    '''
+    Concatenates the outputs of type `what` of the shards in `directories`
+    into the JSON lines file `path`, and returns the number of items.
+    '''
+    count = 0
+    with open(path, 'wb') as out:
+        for directory in directories:
+            for shard_path in shard_outputs(directory, what):
+                for line in read_lines(shard_path):
+                    out.write(line)
+                    count += 1
+    return count
+
+
+class Command(ScrapyCommand):
+    '''
+    Crawls with a spider in several processes, each crawling a shard of
+    the site (see cosmebot.sharding), in `<dir>/shard-00`, `<dir>/shard-01`,
+    ..., then merges the JSON lines outputs of the shards into `<type>.json`
+    files in the current directory. Other outputs (SQLite, changelog,
+    swatches, ...) are left in the directory of each shard.
+    '''
+    requires_project = True
+
+    def syntax(self):
+        return '[options] <spider>'
+
+    def short_desc(self):
+        return 'Crawl with a spider in several processes, each crawling a part of the site'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option('-a', dest='spargs', action='append', default=[],
+                          metavar='NAME=VALUE', help='set spider argument (may be repeated)')
+        parser.add_option('-n', '--shards', type='int', metavar='N',
+                          help='number of processes (default: one per CPU)')
+        parser.add_option('--dir', default='shards', metavar='PATH',
+                          help='directory of the shards (default: shards)')
+        parser.add_option('--no-merge', action='store_true',
+                          help='leave the outputs in the directories of the shards')
+
+    def process_options(self, args, opts):
+        ScrapyCommand.process_options(self, args, opts)
+        try:
+            opts.spargs = arglist_to_dict(opts.spargs)
+        except ValueError:
+            raise UsageError('Invalid -a value, use -a NAME=VALUE', print_help=False)
+
+    def _environment(self):
+        # Shards run in their own directories, and find the project through
+        # PYTHONPATH
+        pythonpath = os.environ.get('PYTHONPATH', '').split(os.pathsep)
+        cfg = closest_scrapy_cfg()
+        if cfg:
+            pythonpath.insert(0, os.path.dirname(cfg))
+        return dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in pythonpath if p))
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        spider_name = args[0]
+        self.crawler_process.spider_loader.load(spider_name)
+        shards = opts.shards or multiprocessing.cpu_count()
+
+        # A fresh frontier: shards would otherwise pick up where the
+        # previous crawl left off
+        frontier = os.path.abspath(os.path.join(opts.dir, 'frontier.db'))
+        if not os.path.isdir(opts.dir):
+            os.makedirs(opts.dir)
+        for path in glob.glob(frontier + '*'):
+            os.remove(path)
+        Frontier(frontier).close()
+
+        command = [sys.executable, '-m', 'scrapy.cmdline', 'crawl', spider_name]
+        for name, value in sorted(opts.spargs.items()):
+            command += ['-a', '{0}={1}'.format(name, value)]
+        for setting in opts.set:
+            command += ['-s', setting]
+        command += ['-s', 'SHARD_COUNT={0}'.format(shards), '-s', 'SHARD_FRONTIER=' + frontier,
+                    '-s', 'LOG_FILE=crawl.log']
+
+        directories = []
+        processes = []
+        env = self._environment()
+        start = time.time()
+        for index in range(shards):
+            directory = os.path.join(opts.dir, 'shard-{0:02d}'.format(index))
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+            os.makedirs(directory)
+            directories.append(directory)
+            processes.append(subprocess.Popen(
+                command + ['-s', 'SHARD_INDEX={0}'.format(index)], cwd=directory, env=env))
+        logger.info('Started %(shards)d shards in %(dir)s', {'shards': shards, 'dir': opts.dir})
+
+        failed = [index for index, process in enumerate(processes) if process.wait()]
+        logger.info('Shards finished in %(elapsed).1fs', {'elapsed': time.time() - start})
+        if failed:
+            logger.error('Shards %(failed)s failed, see their logs',
+                         {'failed': ', '.join(str(index) for index in failed)})
+            self.exitcode = 1
+        if opts.no_merge:
+            return
+
+        counts = {}
+        for what in MultiJsonLinesItemPipeline.save_types:
+            counts[what] = merge_outputs(directories, what, what + '.json')
+        logger.info('Merged the outputs of the shards: %(items)s',
+                    {'items': ', '.join('{0} {1}'.format(count, what)
+                                        for what, count in sorted(counts.items()))})
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+'''
+SQLite storage for the scraped items: one table per item type, with a
+child table per list field, updated in place when an item is scraped again.
+'''
+
+import collections
+import json
+import sqlite3
+
+from cosmebot.writers import BackgroundWriter
+
+
+# key: the columns identifying an item; id: the INTEGER PRIMARY KEY column
+# (the item's own id, or one assigned by SQLite) that child rows refer to;
+# children: list field => columns of its rows (a list of strings fills a
+# single column); split: field holding a list => one column per element
+Table = collections.namedtuple('Table', 'key id columns children split')
+
+TABLES = {
+    'product': Table(
+        key=('product_id',),
+        id='product_id',
+        columns=(('product_id', 'INTEGER PRIMARY KEY'), ('name', 'TEXT'), ('maker', 'TEXT'),
+                 ('brand', 'TEXT'), ('volume', 'TEXT'), ('price', 'TEXT'),
+                 ('sale_date', 'TEXT'), ('ingredients', 'TEXT'), ('rating', 'REAL'),
+                 ('point', 'REAL'), ('ranking', 'INTEGER'), ('ranking_category', 'TEXT'),
+                 ('review_count', 'INTEGER'), ('like_count', 'INTEGER'),
+                 ('have_count', 'INTEGER')),
+        children={
+            'description': (('text', 'TEXT'),),
+            'categories': (('category', 'TEXT'),),
+            'colors': (('name', 'TEXT'), ('img_link', 'TEXT'), ('link', 'TEXT')),
+            'image_urls': (('url', 'TEXT'),),
+        },
+        split={'ranking': ('ranking', 'ranking_category')},
+    ),
+    'review': Table(
+        key=('user_id', 'product_id', 'date'),
+        id='review_id',
+        columns=(('review_id', 'INTEGER PRIMARY KEY'), ('user_id', 'INTEGER'),
+                 ('user_age', 'INTEGER'), ('product_id', 'INTEGER'), ('rating', 'INTEGER'),
+                 ('date', 'TEXT')),
+        children={
+            'text': (('sentence', 'TEXT'),),
+            'product_type': (('product_type', 'TEXT'),),
+            'purchase_location': (('tag', 'TEXT'),),
+            'effects': (('tag', 'TEXT'),),
+            'colors': (('tag', 'TEXT'),),
+            'product_tags': (('tag', 'TEXT'),),
+            'related_words': (('tag', 'TEXT'),),
+        },
+        split={},
+    ),
+    'user': Table(
+        key=('user_id',),
+        id='user_id',
+        columns=(('user_id', 'INTEGER PRIMARY KEY'), ('name', 'TEXT'), ('age', 'INTEGER'),
+                 ('skin_type', 'TEXT'), ('hair_type', 'TEXT'), ('hair_volume', 'TEXT'),
+                 ('zodiac', 'TEXT'), ('blood_type', 'TEXT'), ('review_count', 'INTEGER'),
+                 ('verified', 'INTEGER'), ('qa_count', 'INTEGER'),
+                 ('favorite_user_count', 'INTEGER'), ('fan_count', 'INTEGER'),
+                 ('favorite_brand_count', 'INTEGER')),
+        children={},
+        split={},
+    ),
+    'brand': Table(
+        key=('brand_id',),
+        id='brand_id',
+        columns=(('brand_id', 'INTEGER PRIMARY KEY'), ('name', 'TEXT'), ('maker', 'TEXT'),
+                 ('product_count', 'INTEGER'), ('review_count', 'INTEGER'),
+                 ('favorite_count', 'INTEGER')),
+        children={},
+        split={},
+    ),
+    'tag': Table(
+        key=('tag_url',),
+        id='tag_id',
+        columns=(('tag_id', 'INTEGER PRIMARY KEY'), ('tag_url', 'TEXT'), ('name', 'TEXT'),
+                 ('rank', 'INTEGER')),
+        children={},
+        split={},
+    ),
+}
+
+
+def _scalar(value):
+    # Anything unexpected in a scalar column is kept, as JSON
+    if isinstance(value, (list, tuple, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+class ItemDatabase(object):
+    '''
+    SQLite database holding items, one row per item key.
+
+    An item scraped again updates the columns of the fields it has, and
+    replaces the child rows of its list fields. The database is in WAL
+    mode, so it can be queried while items are being written.
+    '''
+    def __init__(self, path):
+        # Written from a writer thread, closed from the reactor thread
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            for name, table in sorted(TABLES.items()):
+                self._create(name, table)
+
+    def _create(self, name, table):
+        self.connection.execute('CREATE TABLE IF NOT EXISTS {0} ({1})'.format(
+            name, ', '.join(' '.join(column) for column in table.columns)))
+        if table.key != (table.id,):
+            self.connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS {0}_key ON {0} ({1})'
+                                    .format(name, ', '.join(table.key)))
+        for field, columns in sorted(table.children.items()):
+            child = '{0}_{1}'.format(name, field)
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS {0} ({1} INTEGER, position INTEGER, {2})'
+                .format(child, table.id, ', '.join(' '.join(column) for column in columns)))
+            self.connection.execute('CREATE INDEX IF NOT EXISTS {0}_parent ON {0} ({1})'
+                                    .format(child, table.id))
+
+    def write(self, items):
+        '''
+        Stores a batch of (item type, item dict) tuples in one transaction.
+        '''
+        with self.connection:
+            cursor = self.connection.cursor()
+            for name, item in items:
+                self._upsert(cursor, name, TABLES[name], item)
+
+    def _upsert(self, cursor, name, table, item):
+        values = {}
+        for field, value in item.items():
+            if field in table.split:
+                for column, element in zip(table.split[field], value):
+                    values[column] = element
+            elif field not in table.children:
+                values[field] = _scalar(value)
+        columns = [column for column, _ in table.columns if column in values]
+
+        key = [values.get(column) for column in table.key]
+        row = cursor.execute('SELECT {0} FROM {1} WHERE {2}'.format(
+            table.id, name, ' AND '.join(column + ' IS ?' for column in table.key)),
+            key).fetchone()
+        if row is None:
+            cursor.execute('INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                name, ', '.join(columns), ', '.join('?' * len(columns))),
+                [values[column] for column in columns])
+            id = cursor.lastrowid
+        else:
+            id = row[0]
+            cursor.execute('UPDATE {0} SET {1} WHERE {2} = ?'.format(
+                name, ', '.join(column + ' = ?' for column in columns), table.id),
+                [values[column] for column in columns] + [id])
+
+        for field, child_columns in table.children.items():
+            if field not in item:
+                continue
+            child = '{0}_{1}'.format(name, field)
+            cursor.execute('DELETE FROM {0} WHERE {1} = ?'.format(child, table.id), (id,))
+            names = [column for column, _ in child_columns]
+            rows = []
+            for position, value in enumerate(item[field]):
+                if isinstance(value, dict):
+                    rows.append([id, position] + [_scalar(value.get(n)) for n in names])
+                else:
+                    rows.append([id, position, _scalar(value)])
+            cursor.executemany('INSERT INTO {0} ({1}, position, {2}) VALUES ({3})'.format(
+                child, table.id, ', '.join(names), ', '.join('?' * (len(names) + 2))), rows)
+
+    def close(self):
+        self.connection.close()
+
+
+class DatabaseWriter(BackgroundWriter):
+    '''
+    `BackgroundWriter` whose batches of (item type, item dict) tuples are
+    written to an `ItemDatabase`, one transaction per batch.
+    '''
+    def _write_batch(self, batch):
+        self.file.write(batch)
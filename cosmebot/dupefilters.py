@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+
+import six
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy.utils.job import job_dir
+from scrapy.utils.request import request_fingerprint
+
+
+class BloomFilter(object):
+    '''
+    Bloom filter over a bit array memory mapped from `path`, sized for
+    `capacity` keys at the given false positive rate. Memory use is fixed by
+    those two parameters, however many keys are added, and the file can be
+    reopened to continue with the same set.
+
+    Keys are hex digests (e.g. request fingerprints); the bit positions are
+    derived from them by double hashing.
+    '''
+    header = struct.Struct('<4sIQ')
+    magic = b'CBF1'
+
+    def __init__(self, path, capacity, error_rate):
+        nbits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.nbytes = (nbits + 7) // 8
+        self.nbits = self.nbytes * 8
+        self.nhashes = max(1, int(round(self.nbits / float(capacity) * math.log(2))))
+        self.path = path
+
+        size = self.header.size + self.nbytes
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if exists:
+            magic, nhashes, nbits = self.header.unpack(self.file.read(self.header.size))
+            if (magic, nhashes, nbits) != (self.magic, self.nhashes, self.nbits):
+                self.file.close()
+                raise ValueError('{0} was created with different capacity or error '
+                                 'rate settings'.format(path))
+        else:
+            self.file.write(self.header.pack(self.magic, self.nhashes, self.nbits))
+            self.file.truncate(size)
+        self.file.flush()
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def _positions(self, key):
+        h1 = int(key[:16], 16)
+        h2 = int(key[16:32], 16) | 1
+        for i in range(self.nhashes):
+            yield (h1 + i * h2) % self.nbits
+
+    def add(self, key):
+        '''
+        Adds `key` and returns whether it was (probably) already present.
+        '''
+        present = True
+        offset = self.header.size
+        for position in self._positions(key):
+            index = offset + (position >> 3)
+            mask = 1 << (position & 7)
+            byte = six.indexbytes(self.map, index)
+            if not byte & mask:
+                present = False
+                self.map[index:index + 1] = six.int2byte(byte | mask)
+        return present
+
+    def __contains__(self, key):
+        offset = self.header.size
+        for position in self._positions(key):
+            if not six.indexbytes(self.map, offset + (position >> 3)) & (1 << (position & 7)):
+                return False
+        return True
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class BloomDupeFilter(RFPDupeFilter):
+    '''
+    Request fingerprint dupefilter backed by a `BloomFilter`, so that memory
+    stays flat on crawls of millions of pages instead of growing with a set
+    of fingerprints.
+
+    The filter is sized with DUPEFILTER_CAPACITY (expected number of unique
+    requests) and DUPEFILTER_ERROR_RATE (probability that a new request is
+    mistaken for a seen one, and skipped). With a JOBDIR, the bit array is
+    kept in `requests.bloom` there, so resumed crawls keep their state;
+    otherwise a temporary file is used.
+    '''
+    def __init__(self, path=None, capacity=10000000, error_rate=0.0001, debug=False):
+        self.debug = debug
+        self.logdupes = True
+        self.logger = logging.getLogger(__name__)
+        self.file = None
+        self.temporary = path is None
+        if self.temporary:
+            fd, filter_path = tempfile.mkstemp(prefix='cosmebot-', suffix='.bloom')
+            os.close(fd)
+        else:
+            filter_path = os.path.join(path, 'requests.bloom')
+        self.filter = BloomFilter(filter_path, capacity, error_rate)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(job_dir(settings),
+                   settings.getint('DUPEFILTER_CAPACITY', 10000000),
+                   settings.getfloat('DUPEFILTER_ERROR_RATE', 0.0001),
+                   settings.getbool('DUPEFILTER_DEBUG'))
+
+    def request_seen(self, request):
+        return self.filter.add(request_fingerprint(request))
+
+    def close(self, reason):
+        self.filter.close()
+        if self.temporary:
+            os.remove(self.filter.path)
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+'''
+Downloading the color swatch images of products and finding their dominant
+colors.
+
+Images are stored once per content: under `full/<sha1 of body><ext>`, so
+that the same swatch served for several product variants, or under several
+URLs, is written once. A SQLite index maps each image URL to the digest of
+its content, and each digest to its stored path and dominant colors, so
+that URLs seen by previous crawls are neither downloaded nor analyzed
+again.
+
+Dominant colors are found by k-means clustering of the pixels of a
+thumbnail of the image, vectorized with NumPy, in a pool of worker
+processes.
+'''
+
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+import traceback
+from io import BytesIO
+
+import numpy
+from PIL import Image
+from scrapy.pipelines.files import FilesPipeline
+
+from cosmebot.workers import WorkerPool
+
+
+# ITU-R BT.601 luma, to order pixels for the initial centers
+LUMA = numpy.array([0.299, 0.587, 0.114], dtype=numpy.float32)
+
+
+def dominant_colors(image, count=4, iterations=20):
+    '''
+    Clusters the pixels of `image`, an (n, 3) array of RGB values, into at
+    most `count` colors. Returns them as {'rgb': '#rrggbb', 'share': ...}
+    dicts, most frequent first.
+    '''
+    pixels = numpy.asarray(image, dtype=numpy.float32).reshape(-1, 3)
+    count = min(count, len(pixels))
+    if not count:
+        return []
+    # Deterministic start: the pixels at evenly spaced luma quantiles
+    order = numpy.argsort(pixels.dot(LUMA), kind='mergesort')
+    centers = pixels[order[(2 * numpy.arange(count) + 1) * len(pixels) // (2 * count)]]
+
+    for _ in range(iterations):
+        # (n, k) squared distances, without a Python loop over pixels
+        distances = ((pixels[:, numpy.newaxis, :] - centers[numpy.newaxis, :, :]) ** 2).sum(axis=2)
+        labels = distances.argmin(axis=1)
+        sizes = numpy.bincount(labels, minlength=count)
+        sums = numpy.column_stack([numpy.bincount(labels, pixels[:, c], minlength=count)
+                                   for c in range(3)])
+        # Empty clusters keep their center
+        updated = numpy.where(sizes[:, numpy.newaxis] > 0,
+                              sums / numpy.maximum(sizes, 1)[:, numpy.newaxis], centers)
+        if numpy.abs(updated - centers).max() < 0.5:
+            centers = updated
+            break
+        centers = updated
+
+    distances = ((pixels[:, numpy.newaxis, :] - centers[numpy.newaxis, :, :]) ** 2).sum(axis=2)
+    sizes = numpy.bincount(distances.argmin(axis=1), minlength=count)
+    colors = []
+    for n in numpy.argsort(-sizes, kind='mergesort'):
+        if not sizes[n]:
+            continue
+        rgb = [int(v) for v in numpy.clip(numpy.round(centers[n]), 0, 255)]
+        colors.append({
+            'rgb': '#{0:02x}{1:02x}{2:02x}'.format(*rgb),
+            'share': round(float(sizes[n]) / len(pixels), 4),
+        })
+    return colors
+
+
+def image_colors(body, count, size=64):
+    '''
+    Worker function: decodes an image and returns (True, its dominant
+    colors), or (False, traceback).
+    '''
+    try:
+        image = Image.open(BytesIO(body)).convert('RGB')
+        image.thumbnail((size, size))
+        return True, dominant_colors(image, count)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+class SwatchIndex(object):
+    '''
+    SQLite index of the images stored: URL => content digest, and digest =>
+    (path, checksum, dominant colors).
+    '''
+    commit_every = 100
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS urls ('
+            ' url TEXT PRIMARY KEY, digest TEXT, fetched_at REAL)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS images ('
+            ' digest TEXT PRIMARY KEY, path TEXT, checksum TEXT, colors TEXT)')
+        self.pending = 0
+
+    @staticmethod
+    def _image(row):
+        path, checksum, colors = row[:3]
+        return path, checksum, json.loads(colors) if colors else None
+
+    def lookup(self, url):
+        '''
+        Returns (path, checksum, colors, fetched_at) for the image at `url`,
+        or None if it was not stored.
+        '''
+        row = self.connection.execute(
+            'SELECT path, checksum, colors, fetched_at FROM urls'
+            ' JOIN images ON images.digest = urls.digest'
+            ' WHERE url = ? AND colors IS NOT NULL', (url,)).fetchone()
+        if row is None:
+            return None
+        return self._image(row) + (row[3],)
+
+    def image(self, digest):
+        '''
+        Returns (path, checksum, colors) for the image of content `digest`,
+        or None if it was not stored.
+        '''
+        # Images without colors, whose analysis failed, are analyzed again
+        row = self.connection.execute('SELECT path, checksum, colors FROM images'
+                                      ' WHERE digest = ? AND colors IS NOT NULL',
+                                      (digest,)).fetchone()
+        return None if row is None else self._image(row)
+
+    def add_image(self, digest, path, checksum, colors):
+        self.connection.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)',
+                                (digest, path, checksum,
+                                 None if colors is None else json.dumps(colors)))
+        self._written()
+
+    def add_url(self, url, digest):
+        self.connection.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?)',
+                                (url, digest, time.time()))
+        self._written()
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class SwatchPipeline(FilesPipeline):
+    '''
+    Downloads the `image_urls` of products to SWATCHES_STORE, and adds the
+    dominant colors of each image to its entry in `colors`:
+
+        {"name": "01 ピンク", "img_link": "...",
+         "dominant_colors": [{"rgb": "#e8a0b4", "share": 0.62}, ...]}
+
+    URLs found in the index (SWATCHES_INDEX) are not downloaded again until
+    they are SWATCHES_EXPIRES days old, and downloads whose content is
+    already stored are neither written nor analyzed again. The index is
+    trusted: the store is not checked for the files it lists.
+
+    SWATCHES_COLORS dominant colors are found per image, in a pool of
+    SWATCHES_PROCESSES processes (by default, one per CPU), started with the
+    first image to analyze. Images whose analysis failed are not indexed, so
+    they are downloaded and analyzed again by the next crawl.
+    '''
+    DEFAULT_FILES_URLS_FIELD = 'image_urls'
+    DEFAULT_FILES_RESULT_FIELD = 'images'
+
+    def __init__(self, store_uri, settings):
+        super(SwatchPipeline, self).__init__(store_uri)
+        self.index_path = settings.get('SWATCHES_INDEX', 'swatches.db')
+        self.count = settings.getint('SWATCHES_COLORS', 4)
+        self.processes = settings.getint('SWATCHES_PROCESSES') or multiprocessing.cpu_count()
+        self.pool = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        cls.FILES_URLS_FIELD = cls.DEFAULT_FILES_URLS_FIELD
+        cls.FILES_RESULT_FIELD = cls.DEFAULT_FILES_RESULT_FIELD
+        cls.EXPIRES = settings.getint('SWATCHES_EXPIRES', 90)
+        return cls(settings.get('SWATCHES_STORE', './img'), settings)
+
+    def open_spider(self, spider):
+        super(SwatchPipeline, self).open_spider(spider)
+        self.index = SwatchIndex(self.index_path)
+
+    def close_spider(self, spider):
+        if self.pool is not None:
+            self.pool.close()
+        self.index.close()
+
+    def file_path(self, request, response=None, info=None):
+        # Only called with a response: stored paths come from the index
+        extension = os.path.splitext(request.url)[1]
+        return 'full/{0}{1}'.format(hashlib.sha1(response.body).hexdigest(), extension)
+
+    def media_to_download(self, request, info):
+        stored = self.index.lookup(request.url)
+        if stored is None:
+            return None
+        path, checksum, colors, fetched_at = stored
+        if time.time() - fetched_at > self.EXPIRES * 24 * 60 * 60:
+            return None
+        self.inc_stats(info.spider, 'uptodate')
+        return {'url': request.url, 'path': path, 'checksum': checksum, 'colors': colors}
+
+    def file_downloaded(self, response, request, info):
+        stored = self.index.image(hashlib.sha1(response.body).hexdigest())
+        if stored is not None:
+            self.inc_stats(info.spider, 'duplicate')
+            return stored[1]
+        return super(SwatchPipeline, self).file_downloaded(response, request, info)
+
+    def media_downloaded(self, response, request, info):
+        result = super(SwatchPipeline, self).media_downloaded(response, request, info)
+        digest = os.path.splitext(os.path.basename(result['path']))[0]
+        stored = self.index.image(digest)
+        if stored is not None:
+            self.index.add_url(request.url, digest)
+            result['path'], result['colors'] = stored[0], stored[2]
+            return result
+
+        if self.pool is None:
+            self.pool = WorkerPool(self.processes, self.processes * 4)
+        d = self.pool.run(image_colors, response.body, self.count)
+        d.addCallbacks(self._colors_found, self._colors_failed,
+                       callbackArgs=(result, digest), errbackArgs=(result, request, info))
+        return d
+
+    def _colors_failed(self, failure, result, request, info):
+        info.spider.logger.warning('Could not find the colors of %s: %s',
+                                   request.url, failure.getErrorMessage())
+        return result
+
+    def _colors_found(self, colors, result, digest):
+        self.index.add_image(digest, result['path'], result['checksum'], colors)
+        self.index.add_url(result['url'], digest)
+        result['colors'] = colors
+        return result
+
+    def item_completed(self, results, item, info):
+        # image_urls lists the swatches of the item's colors, in order
+        swatches = [color for color in item.get('colors') or []
+                    if isinstance(color, dict) and 'img_link' in color]
+        for color, (ok, result) in zip(swatches, results):
+            if ok and result.get('colors'):
+                color['dominant_colors'] = result['colors']
+        return super(SwatchPipeline, self).item_completed(results, item, info)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+'''
+Incremental recrawls.
+
+A `PageIndex` remembers, for every page followed through a crawl rule, its
+ETag, Last-Modified date, a hash of its body and the requests it led to.
+On the next run, `IncrementalMiddleware` turns requests for known pages
+into conditional GETs. A page that comes back `304 Not Modified`, or with
+the same body hash, is marked unchanged: the spider then skips its
+callback, so nothing is parsed or exported again, and only makes the
+requests recorded for it, those made by its callback included. Pages are
+indexed by the URL requested, so redirected pages are found again. Pages
+last fully fetched more than INCREMENTAL_MAX_AGE seconds ago are refetched
+unconditionally.
+
+Enable with INCREMENTAL_ENABLED; the index is kept in INCREMENTAL_INDEX.
+'''
+
+import hashlib
+import json
+import sqlite3
+import time
+import weakref
+import zlib
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Request
+
+
+class PageIndex(object):
+    '''
+    SQLite table of the pages seen by previous crawls, keyed by URL.
+    '''
+    commit_every = 1000
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            ' url TEXT PRIMARY KEY,'
+            ' etag TEXT,'
+            ' last_modified TEXT,'
+            ' digest TEXT,'
+            ' links BLOB,'
+            ' fetched_at REAL)')
+        self.pending = 0
+
+    def get(self, url):
+        row = self.connection.execute(
+            'SELECT etag, last_modified, digest, fetched_at FROM pages WHERE url = ?',
+            (url,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('etag', 'last_modified', 'digest', 'fetched_at'), row))
+
+    def links(self, url):
+        '''
+        Returns the (rule index, URL, link text) tuples recorded for `url`.
+        '''
+        row = self.connection.execute('SELECT links FROM pages WHERE url = ?',
+                                      (url,)).fetchone()
+        if row is None or row[0] is None:
+            return []
+        return [tuple(link) for link in json.loads(zlib.decompress(bytes(row[0])))]
+
+    def put(self, url, etag, last_modified, digest, links, fetched_at):
+        links = sqlite3.Binary(zlib.compress(json.dumps(links).encode('utf-8')))
+        self.connection.execute(
+            'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)',
+            (url, etag, last_modified, digest, links, fetched_at))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+_indexes = weakref.WeakKeyDictionary()
+
+
+def page_index(crawler):
+    '''
+    Returns the `PageIndex` shared by the incremental middlewares of
+    `crawler`, closed when the spider closes.
+    '''
+    if crawler not in _indexes:
+        index = PageIndex(crawler.settings.get('INCREMENTAL_INDEX', 'incremental.db'))
+        crawler.signals.connect(lambda spider: index.close(), signal=signals.spider_closed,
+                                weak=False)
+        _indexes[crawler] = index
+    return _indexes[crawler]
+
+
+def _header(response, name):
+    value = response.headers.get(name)
+    return value.decode('latin-1') if isinstance(value, bytes) else value
+
+
+class IncrementalMiddleware(object):
+    '''
+    Downloader middleware sending conditional requests for known pages and
+    marking unchanged ones with `meta['incremental_unchanged']`.
+    '''
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('INCREMENTAL_ENABLED'):
+            raise NotConfigured
+        self.index = page_index(crawler)
+        self.max_age = settings.getfloat('INCREMENTAL_MAX_AGE', 30 * 24 * 3600)
+        self.stats = crawler.stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_request(self, request, spider):
+        # Only pages followed through rules; start pages are always parsed
+        if 'rule' not in request.meta or 'incremental' in request.meta:
+            return
+        # Pages are indexed by the URL requested, which redirects (keeping
+        # the meta) don't change
+        request.meta['incremental_url'] = request.url
+        page = self.index.get(request.url)
+        request.meta['incremental'] = page
+        if page is None:
+            return
+        if self.max_age and time.time() - page['fetched_at'] > self.max_age:
+            # Stale: refetch and reparse it, as a new page
+            request.meta['incremental'] = None
+            return
+        if page['etag']:
+            request.headers['If-None-Match'] = page['etag']
+        if page['last_modified']:
+            request.headers['If-Modified-Since'] = page['last_modified']
+        request.meta['handle_httpstatus_list'] = \
+            list(request.meta.get('handle_httpstatus_list', ())) + [304]
+
+    def process_response(self, request, response, spider):
+        if 'incremental' not in request.meta:
+            return response
+        page = request.meta['incremental']
+        url = request.meta['incremental_url']
+
+        if response.status == 304 and page is not None:
+            request.meta['incremental_unchanged'] = True
+            request.meta['incremental_links'] = self.index.links(url)
+            self.stats.inc_value('incremental/not_modified', spider=spider)
+            return response
+        if response.status != 200:
+            return response
+
+        digest = hashlib.sha1(response.body).hexdigest()
+        if page is not None and page['digest'] == digest:
+            # Its links are replayed as for a 304, as the requests its
+            # callback made are not in the page's links
+            request.meta['incremental_unchanged'] = True
+            request.meta['incremental_links'] = self.index.links(url)
+            self.stats.inc_value('incremental/unchanged', spider=spider)
+        else:
+            self.stats.inc_value('incremental/changed' if page else 'incremental/new',
+                                 spider=spider)
+        request.meta['incremental_page'] = (_header(response, 'ETag'),
+                                            _header(response, 'Last-Modified'),
+                                            digest)
+        return response
+
+
+class IncrementalSpiderMiddleware(object):
+    '''
+    Spider middleware recording each fetched page in the index, along with
+    the rule requests it led to, once the spider is done with it.
+    '''
+    def __init__(self, crawler):
+        if not crawler.settings.getbool('INCREMENTAL_ENABLED'):
+            raise NotConfigured
+        self.index = page_index(crawler)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_spider_output(self, response, result, spider):
+        page = response.meta.get('incremental_page')
+        if page is None:
+            for r in result:
+                yield r
+            return
+
+        links = []
+        for r in result:
+            if isinstance(r, Request) and 'rule' in r.meta:
+                links.append((r.meta['rule'], r.url, r.meta.get('link_text', '')))
+            yield r
+        etag, last_modified, digest = page
+        self.index.put(response.meta['incremental_url'], etag, last_modified, digest, links, time.time())
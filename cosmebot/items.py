@@ -5,22 +5,50 @@
 # See documentation in:
 # http://doc.scrapy.org/en/latest/topics/items.html
 
+import six
 from scrapy import Item, Field
 
 
+# Values of the categorical fields, declared with `interned=True`, shared by
+# all compact items: they repeat across most reviews and users. Once
+# MAX_INTERNED values are shared, new ones are kept as they are, so that an
+# unexpectedly open-ended field can't grow the table without bound.
+_interned = {}
+MAX_INTERNED = 100000
+
+
+def intern_value(value):
+    '''
+    Returns the shared copy of a string equal to `value`, or a list of the
+    shared copies of the strings in a list.
+    '''
+    if isinstance(value, list):
+        return [intern_value(element) for element in value]
+    if isinstance(value, six.string_types):
+        # Keyed by type too, as u'a' == 'a' on Python 2
+        key = (type(value), value)
+        shared = _interned.get(key)
+        if shared is None:
+            if len(_interned) >= MAX_INTERNED:
+                return value
+            shared = _interned[key] = value
+        return shared
+    return value
+
+
 class Product(Item):
     product_id = Field()
     name = Field()
-    maker = Field()
-    brand = Field()
+    maker = Field(interned=True)
+    brand = Field(interned=True)
 
-    volume = Field()       # 容量
-    price = Field()        # 本体価格
-    description = Field()  # 商品説明
-    colors = Field()       # 色 / パターン
-    sale_date = Field()    # 発売日
-    categories = Field()
-    ingredients = Field()  # 関心の高い成分・特徴
+    volume = Field()                    # 容量
+    price = Field()                     # 本体価格
+    description = Field()               # 商品説明
+    colors = Field()                    # 色 / パターン
+    sale_date = Field()                 # 発売日
+    categories = Field(interned=True)
+    ingredients = Field(interned=True)  # 関心の高い成分・特徴
 
     image_urls = Field()
 
@@ -39,17 +67,17 @@ class Review(Item):
     product_id = Field()
     review_id = Field()
 
-    rating = Field()             # 1 - 7
+    rating = Field()                          # 1 - 7
     date = Field()
     text = Field()
 
-    product_type = Field()       # 現品, サンプル・テスター, 購入品, モニター・プレゼント
+    product_type = Field(interned=True)       # 現品, サンプル・テスター, 購入品, モニター・プレゼント
 
-    purchase_location = Field()  # 購入場所
-    effects = Field()            # 効果
-    colors = Field()             # 色
-    product_tags = Field()       # 商品情報
-    related_words = Field()      # 関連ワード
+    purchase_location = Field(interned=True)  # 購入場所
+    effects = Field(interned=True)            # 効果
+    colors = Field()                          # 色
+    product_tags = Field(interned=True)       # 商品情報
+    related_words = Field(interned=True)      # 関連ワード
 
 
 class User(Item):
@@ -57,11 +85,11 @@ class User(Item):
     name = Field()
 
     age = Field()
-    skin_type = Field()
-    hair_type = Field()
-    hair_volume = Field()
-    zodiac = Field()
-    blood_type = Field()
+    skin_type = Field(interned=True)
+    hair_type = Field(interned=True)
+    hair_volume = Field(interned=True)
+    zodiac = Field(interned=True)
+    blood_type = Field(interned=True)
 
     # interests = Field()
     # hobbies = Field()
@@ -78,7 +106,7 @@ class User(Item):
 class Brand(Item):
     brand_id = Field()
     name = Field()
-    maker = Field()
+    maker = Field(interned=True)
 
     product_count = Field()
     review_count = Field()
@@ -89,3 +117,105 @@ class Tag(Item):
     tag_url = Field()
     name = Field()
     rank = Field()
+
+
+class CompactItem(Item):
+    '''
+    Base of the compact item classes made by `compact`: field values are
+    kept in the slots of a per class record instead of a dict, and the
+    values of the fields declared with `interned=True` are interned.
+
+    Scrapy's item classes have no `__slots__`, so compact items still have
+    an instance `__dict__`; it is left unused.
+    '''
+    __slots__ = ('_values',)
+    _record = None
+
+    def __init__(self, *args, **kwargs):
+        self._values = self._record()
+        if args or kwargs:
+            for key, value in six.iteritems(dict(*args, **kwargs)):
+                self[key] = value
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            try:
+                return getattr(self._values, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        field = self.fields.get(key)
+        if field is None:
+            raise KeyError("%s does not support field: %s" %
+                           (self.__class__.__name__, key))
+        if field.get('interned'):
+            value = intern_value(value)
+        setattr(self._values, key, value)
+
+    def __delitem__(self, key):
+        if key in self.fields:
+            try:
+                return delattr(self._values, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [key for key in self._record.__slots__ if hasattr(self._values, key)]
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+
+def compact(cls):
+    '''
+    Returns the compact variant of the item class `cls`, e.g. `CompactReview`,
+    and makes it and its record class module attributes, so that their
+    instances can be pickled. Its `item_type` is that of `cls`, so that
+    pipelines treat its items the same way.
+    '''
+    name = 'Compact' + cls.__name__
+    record = type(name + 'Values', (object,),
+                  {'__module__': __name__, '__slots__': tuple(sorted(cls.fields))})
+    compact_cls = type(cls)(name, (CompactItem, cls),
+                            {'__module__': __name__, '__slots__': (), '_record': record,
+                             'item_type': cls.__name__.lower()})
+    globals()[name] = compact_cls
+    globals()[record.__name__] = record
+    return compact_cls
+
+
+# Item type (see cosmebot.pipelines.item_type) => class
+ITEM_CLASSES = dict((cls.__name__.lower(), cls)
+                    for cls in (Product, Review, User, Brand, Tag))
+COMPACT_ITEM_CLASSES = dict((what, compact(cls)) for what, cls in ITEM_CLASSES.items())
+
+
+def parse_fields(spec):
+    '''
+    Parses a field selection, e.g. 'review:user_id,product_id,rating;
+    product:product_id,name', into a dict of item type => frozenset of
+    field names. Raises ValueError for unknown item types and fields.
+    '''
+    fields = {}
+    for part in spec.split(';'):
+        if not part.strip():
+            continue
+        what, _, names = part.partition(':')
+        what = what.strip()
+        if what not in ITEM_CLASSES:
+            raise ValueError('Unknown item type: {0}'.format(what))
+        names = frozenset(name.strip() for name in names.split(',') if name.strip())
+        unknown = names - set(ITEM_CLASSES[what].fields)
+        if unknown:
+            raise ValueError('Unknown {0} fields: {1}'.format(what, ', '.join(sorted(unknown))))
+        fields[what] = names
+    return fields
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+from scrapy.linkextractors.lxmlhtml import LxmlLinkExtractor
+
+from cosmebot.urls import canonical_url
+
+
+class RoutingLinkExtractor(object):
+    '''
+    Extracts the links of a page once and routes each one to the first
+    `Rule` whose `allow` patterns match it.
+
+    This replaces running every rule's link extractor over the same page:
+    the `<a href>` set is walked once, and the allow patterns of all rules
+    are combined into a single compiled alternation, tried in rule order.
+    Only `LxmlLinkExtractor`s that differ in nothing but `allow` are
+    supported.
+
+    Routed links are rewritten to their canonical URL (see `cosmebot.urls`),
+    and links sharing a canonical URL are only returned once.
+    '''
+    def __init__(self, rules):
+        self.nrules = len(rules)
+        self.link_extractor = LxmlLinkExtractor(canonicalize=False)
+
+        alternatives = []
+        self._group_rules = {}
+        for n, rule in enumerate(rules):
+            self._check(rule.link_extractor)
+            for regex in rule.link_extractor.allow_res:
+                group = 'a{0}'.format(len(alternatives))
+                self._group_rules[group] = n
+                # `re.match` tries the alternatives left to right, so the
+                # leading `.*?` gives each pattern `re.search` semantics
+                # while keeping the first matching rule
+                alternatives.append('(?P<{0}>.*?(?:{1}))'.format(group, regex.pattern))
+        self.pattern = re.compile('|'.join(alternatives)) if alternatives else None
+
+    @staticmethod
+    def _check(link_extractor):
+        if not isinstance(link_extractor, LxmlLinkExtractor):
+            raise ValueError('Can only route rules using LxmlLinkExtractor')
+        if (link_extractor.deny_res or link_extractor.allow_domains or
+                link_extractor.deny_domains or link_extractor.restrict_xpaths):
+            raise ValueError('Can only route link extractors that set `allow`')
+
+    def rule_for(self, url):
+        '''
+        Returns the index of the first rule allowing `url`, or None.
+        '''
+        if self.pattern is None:
+            return None
+        match = self.pattern.match(url)
+        if match is None:
+            return None
+        return self._group_rules[match.lastgroup]
+
+    def route(self, response):
+        '''
+        Returns a list of (rule index, links) tuples, in rule order, for the
+        links found in `response`. Each link is assigned to a single rule.
+        '''
+        buckets = [[] for _ in range(self.nrules)]
+        for link in self.link_extractor.extract_links(response):
+            n = self.rule_for(link.url)
+            if n is not None:
+                buckets[n].append(link)
+
+        routes = []
+        for n, links in enumerate(buckets):
+            if links:
+                routes.append((n, self._canonicalize(links)))
+        return routes
+
+    def _canonicalize(self, links):
+        # Matching happens on the raw URL (the tag rules anchor on
+        # `#result`), canonicalization afterwards, as in LxmlLinkExtractor
+        seen = set()
+        canonical = []
+        for link in links:
+            link.url = canonical_url(link.url)
+            if link.url not in seen:
+                seen.add(link.url)
+                canonical.append(link)
+        return canonical
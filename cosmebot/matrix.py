@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+'''
+User x product rating matrix of the reviews, as NumPy arrays on disk.
+
+A matrix directory holds `.npy` files, to be opened with
+`numpy.load(path, mmap_mode='r')`:
+
+- `row.npy`, `col.npy` and `rating.npy`: the matrix in COO format, one
+  entry per review, in the order they were scraped: the row of the user,
+  the column of the product, and the rating (0 when missing or not a
+  number). A review scraped twice has two entries.
+- `user_age.npy` (-1 when missing) and `date.npy` (datetime64[D], NaT
+  when missing): the age of the user and the date of each review.
+- `user_ids.npy` and `product_ids.npy`: the user id of each row and the
+  product id of each column.
+- With CSR: `csr_indptr.npy`, `csr_indices.npy` and `csr_data.npy`, the
+  same matrix in CSR format (entries of a row in the order they were
+  scraped), and `csr_entries.npy`, the COO entry of each CSR entry, to
+  look up side arrays.
+- `matrix.json`: the shape of the matrix and its number of entries.
+
+For example, with SciPy:
+
+    data, row, col = [numpy.load('ratings/{0}.npy'.format(name), mmap_mode='r')
+                      for name in ('rating', 'row', 'col')]
+    matrix = scipy.sparse.coo_matrix((data, (row, col)))
+
+Entries are written as reviews arrive, in chunks, and turned into `.npy`
+files when the matrix is closed, so that memory only grows with the number
+of users and products, not of reviews. Use `RatingMatrixPipeline` to build
+the matrix during a crawl, or run this module over JSON lines outputs:
+
+    python -m cosmebot.matrix review.json -o ratings --csr
+'''
+
+import argparse
+import datetime
+import json
+import os
+import sys
+
+import numpy
+from numpy.lib.format import open_memmap
+from scrapy import signals
+from scrapy.xlib.pydispatch import dispatcher
+
+from cosmebot.pipelines import item_type
+from cosmebot.writers import read_lines
+
+
+# Per entry arrays: name => dtype
+COLUMNS = (
+    ('row', numpy.int32),
+    ('col', numpy.int32),
+    ('rating', numpy.int8),
+    ('user_age', numpy.int16),
+    ('date', 'datetime64[D]'),
+)
+
+EPOCH = datetime.date(1970, 1, 1)
+NAT = numpy.datetime64('NaT').astype(numpy.int64)
+
+
+def _days(date):
+    # '2016/01/23' => days since the epoch
+    try:
+        year, month, day = [int(part) for part in date.split('/')]
+        return (datetime.date(year, month, day) - EPOCH).days
+    except (AttributeError, TypeError, ValueError):
+        return NAT
+
+
+def _create(path, dtype, length):
+    # open_memmap can't map an empty file
+    if not length:
+        array = numpy.zeros(0, dtype)
+        numpy.save(path, array)
+        return array
+    return open_memmap(path, 'w+', dtype, (length,))
+
+
+class RatingMatrixWriter(object):
+    '''
+    Builds a rating matrix directory (see above) from the reviews given to
+    `add`; the arrays are written by `close`.
+    '''
+    chunk_size = 65536
+
+    def __init__(self, directory, csr=False):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.csr = csr
+        # Id => row or column index
+        self.users = {}
+        self.products = {}
+        self.count = 0
+        self.buffers = dict((name, []) for name, _ in COLUMNS)
+        self.files = dict((name, open(self._path(name, '.tmp'), 'wb')) for name, _ in COLUMNS)
+
+    def _path(self, name, suffix='.npy'):
+        return os.path.join(self.directory, name + suffix)
+
+    def add(self, review):
+        '''
+        Adds an entry for `review`, an item or dict; reviews without a user
+        or product id are skipped. Returns whether it was added.
+        '''
+        user_id = review.get('user_id')
+        product_id = review.get('product_id')
+        if user_id is None or product_id is None:
+            return False
+        rating = review.get('rating')
+        user_age = review.get('user_age')
+        buffers = self.buffers
+        buffers['row'].append(self.users.setdefault(user_id, len(self.users)))
+        buffers['col'].append(self.products.setdefault(product_id, len(self.products)))
+        buffers['rating'].append(rating if isinstance(rating, int) else 0)
+        buffers['user_age'].append(user_age if isinstance(user_age, int) else -1)
+        buffers['date'].append(_days(review.get('date')))
+        self.count += 1
+        if len(buffers['row']) >= self.chunk_size:
+            self._flush()
+        return True
+
+    def _flush(self):
+        # All the columns are converted before any is written, so that they
+        # keep the same length
+        arrays = [(name, numpy.array(self.buffers[name], dtype=numpy.int64).astype(dtype))
+                  for name, dtype in COLUMNS]
+        for name, array in arrays:
+            array.tofile(self.files[name])
+            del self.buffers[name][:]
+
+    def close(self):
+        self._flush()
+        for name, dtype in COLUMNS:
+            self.files[name].close()
+            array = _create(self._path(name), dtype, self.count)
+            with open(self._path(name, '.tmp'), 'rb') as f:
+                for start in range(0, self.count, self.chunk_size):
+                    chunk = numpy.fromfile(f, dtype, self.chunk_size)
+                    array[start:start + len(chunk)] = chunk
+            del array
+            os.remove(self._path(name, '.tmp'))
+
+        for name, ids in (('user_ids', self.users), ('product_ids', self.products)):
+            array = _create(self._path(name), numpy.int64, len(ids))
+            array[list(ids.values())] = list(ids.keys())
+            del array
+
+        if self.csr:
+            self._write_csr()
+        with open(self._path('matrix', '.json'), 'w') as f:
+            json.dump({'shape': [len(self.users), len(self.products)],
+                       'entries': self.count, 'csr': self.csr}, f)
+
+    def _write_csr(self):
+        rows, cols, ratings = [numpy.load(self._path(name), mmap_mode='r')
+                               for name in ('row', 'col', 'rating')]
+        chunks = [(start, min(start + self.chunk_size, self.count))
+                  for start in range(0, self.count, self.chunk_size)]
+
+        counts = numpy.zeros(len(self.users), numpy.int64)
+        for start, stop in chunks:
+            counts += numpy.bincount(rows[start:stop], minlength=len(self.users))
+        indptr = _create(self._path('csr_indptr'), numpy.int64, len(self.users) + 1)
+        indptr[0] = 0
+        numpy.cumsum(counts, out=indptr[1:])
+
+        indices = _create(self._path('csr_indices'), numpy.int32, self.count)
+        data = _create(self._path('csr_data'), numpy.int8, self.count)
+        entries = _create(self._path('csr_entries'), numpy.int64, self.count)
+        # Next free position in each row
+        position = numpy.array(indptr[:-1])
+        for start, stop in chunks:
+            order = numpy.argsort(rows[start:stop], kind='mergesort')
+            sorted_rows = numpy.asarray(rows[start:stop])[order]
+            first = numpy.ones(len(order), bool)
+            first[1:] = sorted_rows[1:] != sorted_rows[:-1]
+            starts = numpy.flatnonzero(first)
+            # Rank of each entry among the entries of its row in the chunk
+            rank = numpy.arange(len(order)) - starts[numpy.cumsum(first) - 1]
+            targets = position[sorted_rows] + rank
+            indices[targets] = numpy.asarray(cols[start:stop])[order]
+            data[targets] = numpy.asarray(ratings[start:stop])[order]
+            entries[targets] = start + order
+            position[sorted_rows[starts]] += numpy.diff(numpy.append(starts, len(order)))
+        del indptr, indices, data, entries
+
+
+class RatingMatrixPipeline(object):
+    '''
+    Writes the rating matrix of the reviews scraped to RATING_MATRIX_DIR,
+    also in CSR format with RATING_MATRIX_CSR. The arrays are complete
+    once the spider closed. Items pass through unchanged.
+    '''
+    def __init__(self, settings):
+        self.directory = settings.get('RATING_MATRIX_DIR', 'ratings')
+        self.csr = settings.getbool('RATING_MATRIX_CSR')
+
+        dispatcher.connect(self.spider_opened, signal=signals.spider_opened)
+        dispatcher.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def spider_opened(self, spider):
+        self.writer = RatingMatrixWriter(self.directory, self.csr)
+
+    def spider_closed(self, spider):
+        self.writer.close()
+
+    def process_item(self, item, spider):
+        if item_type(item) == 'review':
+            self.writer.add(item)
+        return item
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Builds the rating matrix of JSON lines review outputs.')
+    parser.add_argument('paths', nargs='*', default=['review.json'], metavar='path',
+                        help='review outputs, e.g. review.json or review-00000.json.gz')
+    parser.add_argument('-o', '--output', default='ratings',
+                        help='directory to write the matrix to')
+    parser.add_argument('--csr', action='store_true', help='also write it in CSR format')
+    args = parser.parse_args(argv)
+
+    writer = RatingMatrixWriter(args.output, args.csr)
+    skipped = 0
+    for path in args.paths:
+        for line in read_lines(path):
+            if line.strip() and not writer.add(json.loads(line.decode('utf-8'))):
+                skipped += 1
+    writer.close()
+    print('{0} entries, {1} users x {2} products in {3} ({4} reviews skipped)'
+          .format(writer.count, len(writer.users), len(writer.products), args.output,
+                  skipped))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
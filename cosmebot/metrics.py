@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+'''
+Crawl metrics, kept in the Scrapy stats collector under `metrics/`.
+
+Timings are histograms: for `observe(stats, 'parse_seconds',
+'parse_product', 0.012)`, the stats `metrics/parse_seconds/parse_product/`
+`count`, `sum` and `le_<bound>` (the number of observations in the bucket
+ending at <bound>) are updated. `MetricsExtension` adds item rates and
+queue depths as gauges, and periodically writes all the stats to a
+Prometheus text file and/or a JSON file for external monitoring.
+'''
+
+import json
+import os
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Metric name => label of its second key component, for the Prometheus output
+LABELS = {
+    'parse_seconds': 'callback',
+    'route_seconds': 'rule',
+    'export_seconds': 'item_type',
+    'items_per_second': 'item_type',
+    'queue_depth': 'queue',
+}
+
+
+def observe(stats, metric, label, seconds, spider=None):
+    '''
+    Adds an observation of `seconds` to the histogram `metric`/`label`.
+    '''
+    prefix = 'metrics/{0}/{1}/'.format(metric, label)
+    for bound in BUCKETS:
+        if seconds <= bound:
+            break
+    else:
+        bound = '+Inf'
+    stats.inc_value(prefix + 'le_{0}'.format(bound), spider=spider)
+    stats.inc_value(prefix + 'count', spider=spider)
+    stats.inc_value(prefix + 'sum', seconds, spider=spider)
+
+
+def timed(results, stats, metric, label, spider=None, elapsed=0.0):
+    '''
+    Iterates over `results`, e.g. the generator returned by a callback,
+    and observes the time spent producing them (plus `elapsed`) once they
+    are exhausted.
+    '''
+    iterator = iter(results)
+    while True:
+        start = time.time()
+        try:
+            result = next(iterator)
+        except StopIteration:
+            elapsed += time.time() - start
+            break
+        elapsed += time.time() - start
+        yield result
+    observe(stats, metric, label, elapsed, spider)
+
+
+def _write_atomically(path, data):
+    # Readers never see a partial file
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+def _number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def prometheus_text(stats, prefix='cosmebot'):
+    '''
+    Formats a stats dict in the Prometheus text exposition format:
+    histograms and gauges for `metrics/` stats, and every other numeric
+    stat as `<prefix>_stat{name="..."}`.
+    '''
+    histograms = {}
+    gauges = {}
+    lines = []
+    for key, value in sorted(stats.items()):
+        if not _number(value):
+            continue
+        parts = key.split('/')
+        if parts[0] == 'metrics' and len(parts) == 4:
+            histograms.setdefault((parts[1], parts[2]), {})[parts[3]] = value
+        elif parts[0] == 'metrics' and len(parts) == 3:
+            gauges.setdefault(parts[1], {})[parts[2]] = value
+        else:
+            lines.append('{0}_stat{{name="{1}"}} {2}'.format(prefix, key, value))
+
+    output = ['# TYPE {0}_stat gauge'.format(prefix)] + lines
+    for metric in sorted(set(metric for metric, _ in histograms)):
+        name = '{0}_{1}'.format(prefix, metric)
+        output.append('# TYPE {0} histogram'.format(name))
+        for (m, label), values in sorted(histograms.items()):
+            if m != metric:
+                continue
+            labels = '{0}="{1}"'.format(LABELS.get(metric, 'label'), label)
+            cumulative = 0
+            for bound in BUCKETS + ('+Inf',):
+                cumulative += values.get('le_{0}'.format(bound), 0)
+                output.append('{0}_bucket{{{1},le="{2}"}} {3}'
+                              .format(name, labels, bound, cumulative))
+            output.append('{0}_sum{{{1}}} {2}'.format(name, labels, values.get('sum', 0)))
+            output.append('{0}_count{{{1}}} {2}'.format(name, labels, values.get('count', 0)))
+    for metric, values in sorted(gauges.items()):
+        name = '{0}_{1}'.format(prefix, metric)
+        output.append('# TYPE {0} gauge'.format(name))
+        for label, value in sorted(values.items()):
+            output.append('{0}{{{1}="{2}"}} {3}'
+                          .format(name, LABELS.get(metric, 'label'), label, value))
+    return '\n'.join(output) + '\n'
+
+
+class MetricsExtension(object):
+    '''
+    Every METRICS_INTERVAL seconds, records items/s by item type and the
+    depth of the scheduler, downloader and scraper queues, then writes the
+    stats to METRICS_PROMETHEUS_FILE and/or METRICS_JSON_FILE.
+
+    Enable with METRICS_ENABLED, which also has the spider time callbacks
+    and link routing, and the JSON lines pipeline time its writes.
+    '''
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.interval = settings.getfloat('METRICS_INTERVAL', 10.0)
+        self.prometheus_path = settings.get('METRICS_PROMETHEUS_FILE')
+        self.json_path = settings.get('METRICS_JSON_FILE')
+        self.last_counts = {}
+
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        self.last_tick = time.time()
+        self.task = task.LoopingCall(self.tick)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.task.running:
+            self.task.stop()
+        self.tick()
+
+    def _queue_depths(self):
+        engine = self.crawler.engine
+        depths = {
+            'downloader': len(engine.downloader.active),
+            'scraper': len(engine.scraper.slot.active) if engine.scraper.slot else 0,
+        }
+        if engine.slot is not None:
+            depths['scheduler'] = len(engine.slot.scheduler)
+        return depths
+
+    def tick(self):
+        now = time.time()
+        elapsed = max(now - self.last_tick, 1e-6)
+        self.last_tick = now
+        # Counted by RoutingCrawlSpider, by item type
+        item_counts = getattr(self.spider, 'item_counts', {})
+        for what, count in item_counts.items():
+            rate = (count - self.last_counts.get(what, 0)) / elapsed
+            self.stats.set_value('metrics/items_per_second/{0}'.format(what), rate,
+                                 spider=self.spider)
+        self.last_counts = dict(item_counts)
+        for queue, depth in self._queue_depths().items():
+            self.stats.set_value('metrics/queue_depth/{0}'.format(queue), depth,
+                                 spider=self.spider)
+
+        stats = self.stats.get_stats(self.spider)
+        if self.prometheus_path:
+            _write_atomically(self.prometheus_path, prometheus_text(stats).encode('utf-8'))
+        if self.json_path:
+            data = {'time': now, 'spider': self.spider.name, 'stats': stats}
+            _write_atomically(self.json_path,
+                              json.dumps(data, sort_keys=True, default=str).encode('utf-8'))
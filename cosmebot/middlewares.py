@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+# Define here the downloader middlewares of the project
+#
+# See documentation in:
+# http://doc.scrapy.org/en/latest/topics/downloader-middleware.html
+
+import logging
+
+from scrapy.exceptions import NotConfigured, IgnoreRequest
+
+
+logger = logging.getLogger(__name__)
+
+
+class ThrottleController(object):
+    '''
+    Download delay and concurrency of one host, adjusted from what its
+    responses look like.
+
+    Successful responses feed an exponentially weighted average latency.
+    The delay moves halfway towards `latency / concurrency` on each of them
+    (the delay at which `concurrency` requests are in flight on average),
+    and concurrency is raised by one after `increase_after` successes in a
+    row, or lowered by one when latency climbs above twice the baseline:
+    the lowest latency seen, moved by `baseline_decay` towards the average
+    on each success, so that one unusually fast response (a cached page, a
+    304) doesn't hold concurrency down for good.
+    Errors (429, 5xx, timeouts) halve concurrency and double the delay,
+    honouring a Retry-After value. Both always stay within the floors and
+    ceilings given.
+    '''
+    backoff_delay = 1.0
+
+    def __init__(self, delay, concurrency, min_delay=0.25, max_delay=60.0,
+                 min_concurrency=1, max_concurrency=8, increase_after=20,
+                 smoothing=0.3, baseline_decay=0.05):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.increase_after = increase_after
+        self.smoothing = smoothing
+        self.baseline_decay = baseline_decay
+
+        self.delay = delay
+        self.concurrency = concurrency
+        self.latency = None
+        self.min_latency = None
+        self.successes = 0
+        self._clamp()
+
+    def _clamp(self):
+        self.delay = min(self.max_delay, max(self.min_delay, self.delay))
+        self.concurrency = min(self.max_concurrency,
+                               max(self.min_concurrency, self.concurrency))
+
+    def on_success(self, latency):
+        if self.latency is None:
+            self.latency = self.min_latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+            self.min_latency += self.baseline_decay * (self.latency - self.min_latency)
+            self.min_latency = min(self.min_latency, latency)
+
+        self.successes += 1
+        if self.latency > 2 * self.min_latency and self.concurrency > self.min_concurrency:
+            self.concurrency -= 1
+            self.successes = 0
+        elif self.successes >= self.increase_after:
+            self.concurrency += 1
+            self.successes = 0
+
+        target = self.latency / self.concurrency
+        self.delay = (self.delay + target) / 2.0
+        self._clamp()
+
+    def on_error(self, retry_after=None):
+        self.successes = 0
+        self.concurrency //= 2
+        self.delay = max(self.delay * 2, self.backoff_delay, retry_after or 0)
+        self._clamp()
+
+
+def _retry_after(response):
+    value = response.headers.get('Retry-After')
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveThrottleMiddleware(object):
+    '''
+    Keeps a `ThrottleController` per download slot, i.e. per host, so that
+    www.cosme.net and my.cosme.net are throttled on their own latency and
+    error profiles, and applies it to the slot's delay and concurrency.
+
+    Enable with ADAPTIVE_THROTTLE_ENABLED, instead of AutoThrottle. The
+    starting delay is DOWNLOAD_DELAY; the bounds are set with
+    ADAPTIVE_THROTTLE_MIN_DELAY / _MAX_DELAY and
+    ADAPTIVE_THROTTLE_MIN_CONCURRENCY / _MAX_CONCURRENCY.
+    '''
+    error_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_THROTTLE_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.debug = settings.getbool('ADAPTIVE_THROTTLE_DEBUG')
+        self.options = {
+            'min_delay': settings.getfloat('ADAPTIVE_THROTTLE_MIN_DELAY', 0.25),
+            'max_delay': settings.getfloat('ADAPTIVE_THROTTLE_MAX_DELAY', 60.0),
+            'min_concurrency': settings.getint('ADAPTIVE_THROTTLE_MIN_CONCURRENCY', 1),
+            'max_concurrency': settings.getint('ADAPTIVE_THROTTLE_MAX_CONCURRENCY', 8),
+            'increase_after': settings.getint('ADAPTIVE_THROTTLE_INCREASE_AFTER', 20),
+        }
+        self.controllers = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def _controller(self, request):
+        key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return key, None, None
+        if key not in self.controllers:
+            self.controllers[key] = ThrottleController(slot.delay, slot.concurrency,
+                                                       **self.options)
+        return key, slot, self.controllers[key]
+
+    def _apply(self, key, slot, controller, spider):
+        slot.delay = controller.delay
+        slot.concurrency = controller.concurrency
+        stats = self.crawler.stats
+        stats.set_value('throttle/{0}/delay'.format(key), controller.delay, spider=spider)
+        stats.set_value('throttle/{0}/concurrency'.format(key), controller.concurrency,
+                        spider=spider)
+        if self.debug:
+            logger.debug('Throttle %(slot)s: delay %(delay).2fs, concurrency %(concurrency)d,'
+                         ' latency %(latency).2fs',
+                         {'slot': key, 'delay': controller.delay,
+                          'concurrency': controller.concurrency,
+                          'latency': controller.latency or 0},
+                         extra={'spider': spider})
+
+    def process_response(self, request, response, spider):
+        key, slot, controller = self._controller(request)
+        if controller is None:
+            return response
+        if response.status in self.error_statuses:
+            controller.on_error(_retry_after(response))
+            self.crawler.stats.inc_value('throttle/{0}/errors'.format(key), spider=spider)
+        elif 'download_latency' in request.meta and 'cached' not in response.flags:
+            # Responses from the HTTP cache say nothing of the host
+            controller.on_success(request.meta['download_latency'])
+        else:
+            return response
+        self._apply(key, slot, controller, spider)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if isinstance(exception, IgnoreRequest):
+            return
+        key, slot, controller = self._controller(request)
+        if controller is None:
+            return
+        controller.on_error()
+        self.crawler.stats.inc_value('throttle/{0}/errors'.format(key), spider=spider)
+        self._apply(key, slot, controller, spider)
@@ -6,18 +6,29 @@
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
 import json
+import os
+import sqlite3
+import time
 
 from scrapy import signals
 from scrapy.exporters import BaseItemExporter
+from scrapy.utils.job import job_dir
 from scrapy.xlib.pydispatch import dispatcher
+from twisted.internet import task
+
+from cosmebot.database import TABLES, ItemDatabase, DatabaseWriter
+from cosmebot.metrics import observe
+from cosmebot.writers import (COMPRESSION_SUFFIXES, SegmentedFile, BackgroundWriter,
+                              repair_tail, resume_segments)
 
 
 def item_type(item):
     '''
     Converts an `Item` to its string representation.
-    Example: ReviewItem => review
+    Example: ReviewItem => review, and the compact CompactReview => review
     '''
-    return type(item).__name__.lower()
+    cls = type(item)
+    return getattr(cls, 'item_type', None) or cls.__name__.lower()
 
 
 class PrettyFloat(float):
@@ -68,15 +79,63 @@ class UnicodeJsonLinesItemExporter(BaseItemExporter):
 
 # Shamelessly copied from http://stackoverflow.com/q/12230332
 class MultiJsonLinesItemPipeline(object):
+    '''
+    Exports each item type to its own JSON lines file.
+
+    By default items are written to `<type>.json` as they arrive. With
+    JSONLINES_COMPRESSION ('gzip' or 'zstd') or JSONLINES_SEGMENT_SIZE set,
+    output goes to numbered segment files instead, e.g.
+    `review-00000.json.gz`. With JSONLINES_BACKGROUND enabled, lines are
+    batched and written from a thread; when too many batches are pending,
+    items wait before being exported, which holds back the crawl.
+
+    When the crawl runs with a JOBDIR, so that it can be resumed, existing
+    output is appended to instead of truncated: a partial line left at the
+    end of a file by an interrupted run is dropped first, and segmented
+    output continues with a new segment.
+    '''
     save_types = ['product', 'review', 'user', 'brand', 'tag']
 
-    def __init__(self):
+    def __init__(self, settings, stats=None):
+        self.background = settings.getbool('JSONLINES_BACKGROUND')
+        self.batch_size = settings.getint('JSONLINES_BATCH_SIZE', 1000)
+        self.max_batches = settings.getint('JSONLINES_MAX_PENDING_BATCHES', 16)
+        self.compression = settings.get('JSONLINES_COMPRESSION') or None
+        self.segment_size = settings.getint('JSONLINES_SEGMENT_SIZE')
+        self.resume = bool(job_dir(settings))
+        # Export times are recorded with METRICS_ENABLED
+        self.stats = stats if settings.getbool('METRICS_ENABLED') else None
+        if self.compression not in COMPRESSION_SUFFIXES:
+            raise ValueError('Unknown JSONLINES_COMPRESSION: {0}'.format(self.compression))
+
         dispatcher.connect(self.spider_opened, signal=signals.spider_opened)
         dispatcher.connect(self.spider_closed, signal=signals.spider_closed)
 
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler.stats)
+
+    def _open(self, name, spider):
+        if self.compression or self.segment_size:
+            suffix = '.json' + COMPRESSION_SUFFIXES[self.compression]
+            index = 0
+            if self.resume:
+                index = resume_segments(name, suffix, self.compression)
+            f = SegmentedFile(name, suffix, self.compression, self.segment_size, index)
+        elif self.resume and os.path.exists(name + '.json'):
+            dropped = repair_tail(name + '.json')
+            if dropped:
+                spider.logger.info('Dropped a partial line of %d bytes from %s.json',
+                                   dropped, name)
+            f = open(name + '.json', 'ab')
+        else:
+            f = open(name + '.json', 'w+b')
+        if self.background:
+            f = BackgroundWriter(f, self.batch_size, self.max_batches)
+        return f
+
     def spider_opened(self, spider):
-        self.files = dict((name, open(name + '.json', 'w+b'))
-                          for name in self.save_types)
+        self.files = dict((name, self._open(name, spider)) for name in self.save_types)
         self.exporters = dict((name, UnicodeJsonLinesItemExporter(self.files[name]))
                               for name in self.save_types)
         [e.start_exporting() for e in self.exporters.values()]
@@ -88,5 +147,174 @@ class MultiJsonLinesItemPipeline(object):
     def process_item(self, item, spider):
         what = item_type(item)
         if what in set(self.save_types):
+            f = self.files[what]
+            if self.background and f.full():
+                d = f.wait()
+                d.addCallback(lambda _: self.process_item(item, spider))
+                return d
+            self._export(what, item)
+        return item
+
+    def _export(self, what, item):
+        if self.stats is None:
             self.exporters[what].export_item(item)
+            return item
+        start = time.time()
+        self.exporters[what].export_item(item)
+        observe(self.stats, 'export_seconds', what, time.time() - start)
+        return item
+
+
+class ChangelogPipeline(object):
+    '''
+    Writes only what changed since the previous crawl to a changelog.
+
+    The last exported version of each product, brand and user is kept in a
+    SQLite state store (CHANGELOG_STATE), keyed by item type and primary
+    key. Items not seen before are written to CHANGELOG_FILE with all their
+    tracked fields, as an 'insert' record; items seen before as an 'update'
+    record holding only the tracked fields whose value changed, or not at
+    all if none did:
+
+        {"type":"product","key":"10084858","op":"update","time":1445526000,
+         "fields":{"rating":5.2,"review_count":1024}}
+
+    CHANGELOG_FIELDS restricts the fields tracked for a type, e.g.
+    {'product': ['rating', 'point', ...]}; by default all are. A field
+    missing from an item is not reported: the state keeps its last value.
+    Items pass through unchanged, for the pipelines that follow.
+
+    The changelog is flushed to disk before the state is committed, so that
+    after a crash the state never records changes missing from the
+    changelog (some may be written twice instead).
+    '''
+    primary_keys = {
+        'product': 'product_id',
+        'brand': 'brand_id',
+        'user': 'user_id',
+    }
+    commit_every = 1000
+
+    def __init__(self, settings):
+        self.state_path = settings.get('CHANGELOG_STATE', 'changelog.db')
+        self.path = settings.get('CHANGELOG_FILE', 'changelog.json')
+        self.fields = settings.getdict('CHANGELOG_FIELDS')
+        self.encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+        dispatcher.connect(self.spider_opened, signal=signals.spider_opened)
+        dispatcher.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def spider_opened(self, spider):
+        self.connection = sqlite3.connect(self.state_path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS state ('
+            ' type TEXT, key TEXT, fields TEXT, PRIMARY KEY (type, key))')
+        self.file = open(self.path, 'ab')
+        self.pending = 0
+
+    def spider_closed(self, spider):
+        self._commit()
+        self.connection.close()
+        self.file.close()
+
+    def _commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.connection.commit()
+        self.pending = 0
+
+    def _tracked(self, what, item):
+        # Round-tripped through JSON to compare with the stored version
+        names = self.fields.get(what) or item.keys()
+        return json.loads(json.dumps(dict((name, item[name]) for name in names
+                                          if name in item)))
+
+    def process_item(self, item, spider):
+        what = item_type(item)
+        key = item.get(self.primary_keys.get(what))
+        if key is None:
+            return item
+        key = unicode(key)
+
+        fields = self._tracked(what, item)
+        row = self.connection.execute('SELECT fields FROM state WHERE type = ? AND key = ?',
+                                      (what, key)).fetchone()
+        if row is None:
+            op, previous, changed = 'insert', {}, fields
+        else:
+            op, previous = 'update', json.loads(row[0])
+            changed = dict((name, value) for name, value in fields.iteritems()
+                           if previous.get(name) != value)
+            if not changed:
+                return item
+
+        previous.update(changed)
+        self.connection.execute('INSERT OR REPLACE INTO state VALUES (?, ?, ?)',
+                                (what, key, json.dumps(previous, sort_keys=True)))
+        record = {'type': what, 'key': key, 'op': op, 'time': int(time.time()),
+                  'fields': changed}
+        self.file.write(self.encoder.encode(convert_to_utf8(record)) + '\n')
+
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self._commit()
+        return item
+
+
+class SQLiteItemPipeline(object):
+    '''
+    Stores items in a SQLite database (SQLITE_PATH) instead of JSON lines:
+    one table per item type, keyed by product_id, user_id, brand_id,
+    (user_id, product_id, date) for reviews and tag_url for tags, so that an
+    item scraped several times is a single row. List fields go to child
+    tables, e.g. `product_categories`; see `cosmebot.database`.
+
+    Items are written from a thread, in transactions of SQLITE_BATCH_SIZE
+    items; items wait before being stored while SQLITE_MAX_PENDING_BATCHES
+    batches are pending. The database can be read while the crawl runs: a
+    partial batch is written every SQLITE_FLUSH_INTERVAL seconds, so items
+    show up within that time even when they come in slowly.
+    '''
+    def __init__(self, settings):
+        self.path = settings.get('SQLITE_PATH', 'cosmebot.db')
+        self.batch_size = settings.getint('SQLITE_BATCH_SIZE', 500)
+        self.max_batches = settings.getint('SQLITE_MAX_PENDING_BATCHES', 16)
+        self.flush_interval = settings.getfloat('SQLITE_FLUSH_INTERVAL', 5.0)
+        self.flush_task = None
+
+        dispatcher.connect(self.spider_opened, signal=signals.spider_opened)
+        dispatcher.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def spider_opened(self, spider):
+        self.writer = DatabaseWriter(ItemDatabase(self.path), self.batch_size,
+                                     self.max_batches)
+        if self.flush_interval > 0:
+            self.flush_task = task.LoopingCall(self.writer.flush)
+            self.flush_task.start(self.flush_interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.flush_task is not None and self.flush_task.running:
+            self.flush_task.stop()
+        self.writer.close()
+
+    def process_item(self, item, spider):
+        what = item_type(item)
+        if what in TABLES:
+            if self.writer.full():
+                d = self.writer.wait()
+                d.addCallback(lambda _: self.process_item(item, spider))
+                return d
+            self._store(what, item)
+        return item
+
+    def _store(self, what, item):
+        self.writer.write((what, dict(item)))
         return item
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+'''
+Registry of compiled XPath expressions used by the spider callbacks.
+
+`response.css()` translates its query to XPath and has lxml compile it on
+every call. Expressions obtained through `css()` and `xpath()` are
+translated and compiled once per process, and are evaluated directly on
+lxml elements, e.g. `css('p.name > span::text')(root(response))`.
+'''
+
+from lxml import etree
+from scrapy.selector.csstranslator import ScrapyHTMLTranslator
+
+
+_translator = ScrapyHTMLTranslator()
+_registry = {}
+_css_registry = {}
+
+
+def xpath(query):
+    '''
+    Returns the compiled `etree.XPath` for the XPath `query`.
+    '''
+    try:
+        return _registry[query]
+    except KeyError:
+        compiled = etree.XPath(query, smart_strings=False)
+        _registry[query] = compiled
+        return compiled
+
+
+def css(query):
+    '''
+    Returns the compiled `etree.XPath` for the CSS `query`. The `::text`
+    and `::attr(name)` pseudo-elements are supported, as in `Selector.css`.
+    '''
+    try:
+        return _css_registry[query]
+    except KeyError:
+        compiled = xpath(_translator.css_to_xpath(query))
+        _css_registry[query] = compiled
+        return compiled
+
+
+def root(response):
+    '''
+    Returns the root lxml element of `response`. The document is parsed
+    once and cached on the response's selector.
+    '''
+    selector = response.selector
+    try:
+        return selector.root
+    except AttributeError:
+        return selector._root
+
+
+def as_text(value):
+    '''
+    Returns `value` as unicode if it is a byte string: lxml returns `str`
+    for ASCII-only text and attributes on Python 2, without smart strings.
+    '''
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def extract(element, path):
+    '''
+    Returns the results of evaluating `path` on `element`, like
+    `SelectorList.extract`, text as unicode.
+    '''
+    return [as_text(value) for value in path(element)]
+
+
+def extract_first(element, path, default=None):
+    '''
+    Returns the first result of evaluating `path` on `element`, like
+    `SelectorList.extract_first`, text as unicode.
+    '''
+    result = path(element)
+    return as_text(result[0]) if result else default
@@ -13,6 +13,7 @@ BOT_NAME = 'cosmebot'
 
 SPIDER_MODULES = ['cosmebot.spiders']
 NEWSPIDER_MODULE = 'cosmebot.spiders'
+COMMANDS_MODULE = 'cosmebot.commands'
 
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
@@ -24,11 +25,24 @@ NEWSPIDER_MODULE = 'cosmebot.spiders'
 # Configure a delay for requests for the same website (default: 0)
 # See http://scrapy.readthedocs.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
-#DOWNLOAD_DELAY=3
+DOWNLOAD_DELAY=1.0
 # The download delay setting will honor only one of:
 #CONCURRENT_REQUESTS_PER_DOMAIN=16
 #CONCURRENT_REQUESTS_PER_IP=16
 
+# Parse responses (callbacks and link extraction) in worker processes
+# instead of the reactor thread, with at most PARSE_MAX_PENDING responses
+# handed to them at once (default: 4 per process). A response with no
+# result after PARSE_TIMEOUT seconds (its worker died or is stuck) fails.
+#PARSE_PROCESSES=4
+#PARSE_MAX_PENDING=16
+#PARSE_TIMEOUT=60
+
+# Build items with fixed slots instead of a dict per item, sharing a single
+# copy of repeated categorical values (review effects, user skin type, ...),
+# to lower memory use when many items are held by the pipelines
+#COMPACT_ITEMS=True
+
 # Disable cookies (enabled by default)
 #COOKIES_ENABLED=False
 
@@ -43,27 +57,40 @@ NEWSPIDER_MODULE = 'cosmebot.spiders'
 
 # Enable or disable spider middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
-#    'cosmebot.middlewares.MyCustomSpiderMiddleware': 543,
-#}
+SPIDER_MIDDLEWARES = {
+    # Sees the requests of a page before other middlewares filter them
+    'cosmebot.incremental.IncrementalSpiderMiddleware': 950,
+    # Forwards the requests of other shards, after they were recorded above
+    'cosmebot.sharding.ShardMiddleware': 930,
+}
 
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    'cosmebot.middlewares.MyCustomDownloaderMiddleware': 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    # Sees responses and errors right after download, before retries
+    'cosmebot.middlewares.AdaptiveThrottleMiddleware': 950,
+    # Below HttpCompressionMiddleware, so that it hashes decompressed bodies
+    'cosmebot.incremental.IncrementalMiddleware': 580,
+    'cosmebot.archive.ResponseArchiveMiddleware': 570,
+}
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
-#    'scrapy.telnet.TelnetConsole': None,
-#}
+EXTENSIONS = {
+    'cosmebot.metrics.MetricsExtension': 500,
+}
 
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
     'scrapy.pipelines.images.ImagesPipeline': 1,
+    # Instead of ImagesPipeline, to store swatches once and find their colors
+    #'cosmebot.images.SwatchPipeline': 1,
+    #'cosmebot.pipelines.ChangelogPipeline': 200,
+    #'cosmebot.pipelines.SQLiteItemPipeline': 300,
     'cosmebot.pipelines.MultiJsonLinesItemPipeline': 300,
+    #'cosmebot.stream.ItemStreamPipeline': 350,
+    #'cosmebot.matrix.RatingMatrixPipeline': 400,
 }
 
 # Enable and configure the AutoThrottle extension (disabled by default)
@@ -77,6 +104,33 @@ ITEM_PIPELINES = {
 # Enable showing throttling stats for every response received:
 #AUTOTHROTTLE_DEBUG=False
 
+# Alternatively, adapt delay and concurrency per host (www.cosme.net and
+# my.cosme.net separately) to latency and 429/5xx/timeout errors, starting
+# from DOWNLOAD_DELAY (see cosmebot.middlewares.AdaptiveThrottleMiddleware)
+#ADAPTIVE_THROTTLE_ENABLED=True
+#ADAPTIVE_THROTTLE_MIN_DELAY=0.25
+#ADAPTIVE_THROTTLE_MAX_DELAY=60
+#ADAPTIVE_THROTTLE_MIN_CONCURRENCY=1
+#ADAPTIVE_THROTTLE_MAX_CONCURRENCY=8
+#ADAPTIVE_THROTTLE_DEBUG=False
+
+# Record callback, link routing and export timings, item rates and queue
+# depths in the stats, and write them every METRICS_INTERVAL seconds to a
+# Prometheus text file and/or a JSON file (see cosmebot.metrics)
+#METRICS_ENABLED=True
+#METRICS_INTERVAL=10
+#METRICS_PROMETHEUS_FILE='/var/lib/node_exporter/textfile/cosmebot.prom'
+#METRICS_JSON_FILE='metrics.json'
+
+# Archive the HTML responses downloaded, compressed and deduplicated, so that
+# `scrapy reparse <spider>` can parse them again without crawling
+#ARCHIVE_ENABLED=True
+#ARCHIVE_PATH='archive.db'
+# Responses are written from a thread, in transactions of ARCHIVE_BATCH_SIZE;
+# a warning is logged when ARCHIVE_MAX_PENDING_BATCHES batches are pending
+#ARCHIVE_BATCH_SIZE=100
+#ARCHIVE_MAX_PENDING_BATCHES=16
+
 # Enable and configure HTTP caching (disabled by default)
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
 #HTTPCACHE_ENABLED=True
@@ -84,4 +138,131 @@ ITEM_PIPELINES = {
 #HTTPCACHE_DIR='httpcache'
 #HTTPCACHE_IGNORE_HTTP_CODES=[]
 #HTTPCACHE_STORAGE='scrapy.extensions.httpcache.FilesystemCacheStorage'
+
 IMAGES_STORE = './img'
+
+# Configure SwatchPipeline, which stores the color swatch images of products
+# once per distinct content, and adds the SWATCHES_COLORS dominant colors of
+# each to the product's `colors`, found in SWATCHES_PROCESSES processes
+# (default: one per CPU). URLs listed in SWATCHES_INDEX are only fetched
+# again after SWATCHES_EXPIRES days.
+#SWATCHES_STORE='./img'
+#SWATCHES_INDEX='swatches.db'
+#SWATCHES_COLORS=4
+#SWATCHES_PROCESSES=4
+#SWATCHES_EXPIRES=90
+
+# Request priority of the pages followed by each crawl rule, keyed by the
+# rule's callback ('follow' for rules without one): product pages first,
+# then review lists and users, pagination last
+RULE_PRIORITIES = {
+    'parse_product': 30,
+    'parse_reviews': 20,
+    'parse_user': 10,
+    'parse_brand': 10,
+    'parse_brand_products': -10,
+    'follow': -10,
+}
+# Stop following the pages of an item type once this many items of that
+# type were scraped (the spider closes when all its types are done)
+#ITEM_BUDGETS = {
+#    'product': 100000,
+#    'review': 1000000,
+#}
+
+# Only extract these fields of these item types (the others keep all their
+# fields), along with their key fields (product_id, user_id, brand_id,
+# tag_url, and user_id, product_id and date for reviews), which are always
+# kept; overridden by the `fields` spider argument, e.g.
+# -a fields='review:user_id,product_id,rating;product:product_id,rating'
+#ITEM_FIELDS = {
+#    'review': ['user_id', 'product_id', 'rating'],
+#}
+
+# Number of reviews per page of a user's review list, used to request all
+# the pages of a user's reviews from the review count on their page
+#REVIEW_LIST_PAGE_SIZE=10
+
+# Yield partial products (id, name, brand, rating, review count) from the
+# brand product listings, and don't fetch product pages, for a quick sweep
+# of the catalog. With LISTING_HARVEST_FETCH_PRODUCTS, product pages are
+# still fetched, and products are only taken from them, in full.
+#LISTING_HARVEST_ENABLED=True
+#LISTING_HARVEST_FETCH_PRODUCTS=False
+
+# Persist the scheduler and dupefilter state, so that a crawl stopped with
+# Ctrl-C or SIGTERM resumes where it left off when started again with the
+# same JOBDIR. The JSON lines exports are then appended to.
+# See http://doc.scrapy.org/en/latest/topics/jobs.html
+#JOBDIR='crawls/atcosme'
+
+# Keep seen request fingerprints in a memory mapped Bloom filter instead of
+# an in-memory set, so that memory stays flat on full crawls. Size it for
+# the expected number of unique requests; DUPEFILTER_ERROR_RATE is the
+# share of new requests wrongly dropped as duplicates.
+#DUPEFILTER_CLASS='cosmebot.dupefilters.BloomDupeFilter'
+#DUPEFILTER_CAPACITY=10000000
+#DUPEFILTER_ERROR_RATE=0.0001
+
+# Incremental recrawls: send conditional requests for the pages seen by
+# previous runs (kept in INCREMENTAL_INDEX), and only follow the links of
+# unchanged ones. Pages fetched more than INCREMENTAL_MAX_AGE seconds ago
+# are fetched and parsed again (0 to never force a refresh).
+#INCREMENTAL_ENABLED=True
+#INCREMENTAL_INDEX='incremental.db'
+#INCREMENTAL_MAX_AGE=2592000
+
+# Sharded crawls, set by `scrapy shard` for each of its processes (see
+# cosmebot.sharding): this process crawls shard SHARD_INDEX of SHARD_COUNT
+# and exchanges requests with the others through SHARD_FRONTIER, picking up
+# those forwarded to it every SHARD_POLL_INTERVAL seconds while fewer than
+# SHARD_MAX_QUEUED requests are scheduled.
+#SHARD_COUNT=4
+#SHARD_INDEX=0
+#SHARD_FRONTIER='frontier.db'
+#SHARD_POLL_INTERVAL=1.0
+#SHARD_MAX_QUEUED=1000
+
+# Configure the JSON lines exports of MultiJsonLinesItemPipeline
+# Write from a background thread, in batches of JSONLINES_BATCH_SIZE lines,
+# holding items back while JSONLINES_MAX_PENDING_BATCHES batches are pending
+#JSONLINES_BACKGROUND=True
+#JSONLINES_BATCH_SIZE=1000
+#JSONLINES_MAX_PENDING_BATCHES=16
+# Compress the output: 'gzip' or 'zstd' (requires the zstandard package)
+#JSONLINES_COMPRESSION='gzip'
+# Roll over to a new segment file every N bytes (before compression)
+#JSONLINES_SEGMENT_SIZE=1073741824
+
+# Configure ChangelogPipeline: the last version of each product, brand and
+# user is kept in CHANGELOG_STATE, and new ones and changed fields are
+# written to CHANGELOG_FILE. CHANGELOG_FIELDS limits the fields tracked.
+#CHANGELOG_STATE='changelog.db'
+#CHANGELOG_FILE='changelog.json'
+#CHANGELOG_FIELDS = {
+#    'product': ['rating', 'point', 'ranking', 'review_count', 'like_count',
+#                'have_count', 'price'],
+#}
+
+# Configure SQLiteItemPipeline, which stores items in a SQLite database,
+# one row per product, review, user, brand and tag, written from a thread
+# in transactions of SQLITE_BATCH_SIZE items, or of the items collected
+# every SQLITE_FLUSH_INTERVAL seconds if fewer
+#SQLITE_PATH='cosmebot.db'
+#SQLITE_BATCH_SIZE=500
+#SQLITE_MAX_PENDING_BATCHES=16
+#SQLITE_FLUSH_INTERVAL=5.0
+
+# Configure RatingMatrixPipeline, which writes the user x product rating
+# matrix of the reviews to RATING_MATRIX_DIR as NumPy arrays (COO, and CSR
+# with RATING_MATRIX_CSR), see cosmebot.matrix
+#RATING_MATRIX_DIR='ratings'
+#RATING_MATRIX_CSR=True
+
+# Configure ItemStreamPipeline, which streams items to the subscribers
+# connected to STREAM_LISTEN (a Twisted endpoint: 'unix:PATH' or
+# 'tcp:PORT:interface=HOST'), see cosmebot.stream. The crawl is held back
+# while a subscriber has STREAM_BUFFER_SIZE frames it did not read yet.
+#STREAM_LISTEN='unix:cosmebot.sock'
+#STREAM_BUFFER_SIZE=1000
+#STREAM_CLOSE_TIMEOUT=30
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+'''
+Sharded crawls: several `scrapy crawl` processes on one machine, each
+crawling its own part of the site.
+
+Pages are assigned to one of SHARD_COUNT shards by a stable hash of the
+entity they belong to, taken from their URL (`product_id/<n>`,
+`user_id/<n>` or `brand_id/<n>`; other pages are hashed by URL), so that
+all the pages of a product, user or brand are crawled by the same process.
+Each process runs with its SHARD_INDEX and `ShardMiddleware`: requests
+for pages of other shards are not crawled but forwarded to their shard
+through a `Frontier`, a SQLite database shared by the processes
+(SHARD_FRONTIER), from which every shard picks up the requests forwarded
+to it. Only shard 0 starts from the start requests.
+
+A shard closes once every shard is idle and no forwarded request is left,
+and writes its outputs in its own working directory. The `shard` command
+(`cosmebot.commands.shard`) starts the processes and merges their outputs.
+'''
+
+import re
+import sqlite3
+import zlib
+
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, NotConfigured
+from scrapy.http import Request
+from twisted.internet import task
+
+
+ENTITY_RE = re.compile(r'/(product_id|user_id|brand_id)/(\d+)')
+
+# Shard states
+BUSY, IDLE, CLOSED = 0, 1, 2
+
+
+def shard_key(url):
+    '''
+    'http://www.cosme.net/product/product_id/10084858/reviews' => 'product_id/10084858'
+    '''
+    match = ENTITY_RE.search(url)
+    return match.group(1) + '/' + match.group(2) if match else url
+
+
+def shard_of(url, shards):
+    '''
+    Returns the shard, out of `shards`, that crawls `url`; the same in
+    every process and on every run.
+    '''
+    key = shard_key(url)
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % shards
+
+
+class Frontier(object):
+    '''
+    SQLite queue of the requests forwarded between shards, and the state of
+    each shard. A URL is forwarded once per crawl, whichever shard found it.
+    '''
+    def __init__(self, path):
+        # Other shards hold the write lock while they forward or pick up
+        # requests, for short transactions only
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS frontier ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' shard INTEGER,'
+            ' rule INTEGER,'
+            ' url TEXT UNIQUE,'
+            ' link_text TEXT)')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS frontier_shard ON frontier (shard, id)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS shards ('
+            ' shard INTEGER PRIMARY KEY, cursor INTEGER, state INTEGER)')
+        self.connection.commit()
+        # Requests forwarded since the last flush: (shard, rule, URL, link text)
+        self.pending = []
+
+    def register(self, shard):
+        self.connection.execute('INSERT OR IGNORE INTO shards VALUES (?, 0, ?)', (shard, BUSY))
+        self.connection.execute('UPDATE shards SET state = ? WHERE shard = ?', (BUSY, shard))
+        self.connection.commit()
+
+    def forward(self, shard, rule, url, link_text):
+        self.pending.append((shard, rule, url, link_text))
+
+    def flush(self):
+        if self.pending:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO frontier (shard, rule, url, link_text)'
+                ' VALUES (?, ?, ?, ?)', self.pending)
+            self.connection.commit()
+            del self.pending[:]
+
+    def take(self, shard, limit):
+        '''
+        Returns up to `limit` (rule, URL, link text) tuples forwarded to
+        `shard` and not taken yet; the shard is then busy.
+        '''
+        (cursor,) = self.connection.execute('SELECT cursor FROM shards WHERE shard = ?',
+                                            (shard,)).fetchone()
+        rows = self.connection.execute(
+            'SELECT id, rule, url, link_text FROM frontier'
+            ' WHERE shard = ? AND id > ? ORDER BY id LIMIT ?', (shard, cursor, limit)).fetchall()
+        if rows:
+            self.connection.execute('UPDATE shards SET cursor = ?, state = ? WHERE shard = ?',
+                                    (rows[-1][0], BUSY, shard))
+            self.connection.commit()
+        return [row[1:] for row in rows]
+
+    def set_state(self, shard, state):
+        self.flush()
+        self.connection.execute('UPDATE shards SET state = ? WHERE shard = ?', (state, shard))
+        self.connection.commit()
+
+    def finished(self, shards):
+        '''
+        Whether all `shards` are idle or closed, with no request left for
+        the idle ones.
+        '''
+        done, left = self.connection.execute(
+            'SELECT (SELECT COUNT(*) FROM shards WHERE state != ?),'
+            ' EXISTS (SELECT 1 FROM shards JOIN frontier ON frontier.shard = shards.shard'
+            '         WHERE shards.state = ? AND frontier.id > shards.cursor)',
+            (BUSY, IDLE)).fetchone()
+        return done >= shards and not left
+
+    def lost(self):
+        '''
+        Number of requests forwarded to shards that closed before taking
+        them.
+        '''
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM shards JOIN frontier ON frontier.shard = shards.shard'
+            ' WHERE shards.state = ? AND frontier.id > shards.cursor', (CLOSED,)).fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+class ShardMiddleware(object):
+    '''
+    Spider middleware running a crawl as shard SHARD_INDEX of SHARD_COUNT
+    (see above). Requests followed through a crawl rule for pages of other
+    shards are forwarded to them, and the requests forwarded to this shard
+    are picked up every SHARD_POLL_INTERVAL seconds, while fewer than
+    SHARD_MAX_QUEUED requests are scheduled, so that the frontier stays on
+    disk.
+    '''
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.count = settings.getint('SHARD_COUNT')
+        if self.count < 2:
+            raise NotConfigured
+        self.index = settings.getint('SHARD_INDEX')
+        if not 0 <= self.index < self.count:
+            raise ValueError('SHARD_INDEX must be between 0 and {0}'.format(self.count - 1))
+        self.path = settings.get('SHARD_FRONTIER', 'frontier.db')
+        self.interval = settings.getfloat('SHARD_POLL_INTERVAL', 1.0)
+        self.max_queued = settings.getint('SHARD_MAX_QUEUED', 1000)
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.frontier = None
+        self.poll_task = None
+
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        self.frontier = Frontier(self.path)
+        self.frontier.register(self.index)
+        self.poll_task = task.LoopingCall(self._poll, spider)
+        self.poll_task.start(self.interval)
+
+    def spider_idle(self, spider):
+        if self._poll(spider):
+            raise DontCloseSpider
+        self.frontier.set_state(self.index, IDLE)
+        if not self.frontier.finished(self.count):
+            raise DontCloseSpider
+
+    def spider_closed(self, spider):
+        if self.poll_task.running:
+            self.poll_task.stop()
+        self.frontier.set_state(self.index, CLOSED)
+        lost = self.frontier.lost()
+        if lost:
+            spider.logger.warning('%d forwarded requests were not crawled, as their'
+                                  ' shards closed first', lost)
+        self.frontier.close()
+
+    def _poll(self, spider):
+        # Forwards the pending requests, and schedules those forwarded here
+        self.frontier.flush()
+        limit = self.max_queued - len(self.crawler.engine.slot.scheduler)
+        if limit <= 0:
+            return 0
+        links = self.frontier.take(self.index, limit)
+        for request in spider._replay_requests(links):
+            self.crawler.engine.crawl(request, spider)
+        self.stats.inc_value('shard/received', len(links), spider=spider)
+        return len(links)
+
+    def process_start_requests(self, start_requests, spider):
+        # Shards other than the first only crawl what is forwarded to them
+        if self.index == 0:
+            for request in start_requests:
+                yield request
+
+    def process_spider_output(self, response, result, spider):
+        for r in result:
+            if isinstance(r, Request) and 'rule' in r.meta:
+                shard = shard_of(r.url, self.count)
+                if shard != self.index:
+                    self.frontier.forward(shard, r.meta['rule'], r.url,
+                                          r.meta.get('link_text', ''))
+                    self.stats.inc_value('shard/forwarded', spider=spider)
+                    continue
+            yield r
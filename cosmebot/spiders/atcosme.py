@@ -1,11 +1,97 @@
 # -*- coding: utf-8 -*-
 
+import functools
+import math
 import re
+import time
+from collections import defaultdict
 
+from scrapy import signals
+from scrapy.http import HtmlResponse, Request
 from scrapy.linkextractors.lxmlhtml import LxmlLinkExtractor
 from scrapy.spiders import CrawlSpider, Rule
 
-from cosmebot.items import Product, Review, User, Brand, Tag
+from cosmebot.database import TABLES
+from cosmebot.items import ITEM_CLASSES, COMPACT_ITEM_CLASSES, parse_fields
+from cosmebot.linkextractors import RoutingLinkExtractor
+from cosmebot.metrics import observe, timed
+from cosmebot.pipelines import item_type
+from cosmebot.selectors import css, xpath, root, as_text, extract, extract_first
+from cosmebot.urls import canonical_url
+from cosmebot.workers import ParsePool
+
+
+# Compiled once at import time, see `cosmebot.selectors`
+
+# Shared
+TEXT = xpath('./text()')
+ALL_TEXT = xpath('.//text()')
+OWN_TEXT = css('::text')
+LINK_TEXT = xpath('./a/text()')
+LINK_TEXT_CSS = css('a::text')
+LINK_HREF = css('a::attr(href)')
+IMG_SRC = css('img::attr(src)')
+NUM_TEXT = css('span.num::text')
+SPAN_TEXT = css('span::text')
+
+# Review list
+REVIEW_SECS = css('div.review-sec')
+REVIEW_USER_AGE = css('dd >  ul > li.first::text')
+REVIEW_PRODUCT_LINK = css('p.item > a::attr(href)')
+REVIEW_RATING = css('p.reviewer-rating::text')
+REVIEW_MOBILE_DATE = css('p.mobile-date')
+REVIEW_MOBILE_DATE_TEXT = css('p.mobile-date::text')
+REVIEW_DATE = css('p.date::text')
+REVIEW_TEXT = css('p.read *::text')
+REVIEW_PRODUCT_TYPE = css('dl.item-status > dd > ul > li::text')
+REVIEW_TAG_LISTS = css('div.tag-list > dl')
+
+# Product
+PRODUCT_NAME = css('h2.item-name > *.pdct-name > a::text')
+PRODUCT_MAKER = css('dl.maker > dd > a::text')
+PRODUCT_BRAND = css('dl.brand-name > dd > a::text')
+PRODUCT_DESCRIPTION = css('dl.item-description > dd')
+PRODUCT_CATEGORIES = css('dl.item-category > dd > span')
+PRODUCT_RATING = xpath("//p[@itemprop='ratingValue']/text()")
+PRODUCT_POINT = css('p.point::text')
+PRODUCT_REVIEW_COUNT = css('ul.select-top li.review > a > span.num::text')
+PRODUCT_COUNTS = css('div.info-related > ul.rev-btn > li')
+PRODUCT_RATING_INFO = css('div.rating > ul.info-rating > li')
+INFO_TITLE = css('.info-ttl::text')
+INFO_RANKING = css('.info-ranking > span::text')
+INFO_CATEGORY = css('.info-ctg > a::text')
+INFO_DESCRIPTION = css('.info-desc::text')
+PRODUCT_COLORS = css('.color-ptn > dd ul > li')
+COLOR_NAME = css('.color-txt::text')
+
+# User
+USER_NAME = css('p.name > span::text')
+USER_REVIEW_COUNT = css('div#new-review > h3 > span.number::text')
+USER_VERIFIED = css('span.ico-cmn-auth')
+USER_PERSONAL = css('ul.personal > li')
+USER_ACTIVITIES = css('ul.activities > li')
+USER_BRAND_COUNT = css('div#brand > p.view-more > a::text')
+
+# Brand
+BRAND_NAME = css('div.title01 > h2::text')
+BRAND_MAKER = css('dd.maker > a::text')
+BRAND_COUNTS = tuple((key, css('dt.{0} + dd > a::text'.format(klass)))
+                     for key, klass in (('product_count', 'productNumber'),
+                                        ('review_count', 'reviewNumber'),
+                                        ('favorite_count', 'clipNumber')))
+
+# Brand product listing
+LISTING_ITEMS = css('div.product-list > ul > li.item')
+LISTING_NAME = css('h4.item-name > a::text')
+LISTING_LINK = css('h4.item-name > a::attr(href)')
+LISTING_BRAND = css('p.brand > a::text')
+LISTING_RATING = css('p.rating > span.rating-num::text')
+LISTING_REVIEW_COUNT = css('p.review-num span.num::text')
+LISTING_PRODUCT_ID = re.compile(r'product_id/(\d+)')
+
+# Tags
+TAG_LIST = css('div.tag-list > ul > li')
+TAG_PAGER_LINKS = css('div.pager > a::attr(href)')
 
 
 def convert_to_float_if_float(s):
@@ -22,15 +108,270 @@ def convert_to_int_if_int(s):
         return s
 
 
-class AtcosmeSpider(CrawlSpider):
+def _first_text(element):
+    '''
+    Equivalent of `./text()` + `extract_first()`, without XPath.
+    '''
+    if element.text:
+        return as_text(element.text)
+    for child in element:
+        if child.tail:
+            return as_text(child.tail)
+    return None
+
+
+def _first_descendant_text(element):
+    '''
+    Equivalent of `./descendant-or-self::*/text()` + `extract_first()`:
+    the first text node in document order, found by a depth-first walk
+    that stops as soon as it sees one.
+    '''
+    if element.text:
+        return as_text(element.text)
+    for child in element:
+        # Skip the content of comments and processing instructions, whose
+        # `tag` is not a string
+        if isinstance(child.tag, basestring):
+            text = _first_descendant_text(child)
+            if text is not None:
+                return text
+        if child.tail:
+            return as_text(child.tail)
+    return None
+
+
+class RoutingCrawlSpider(CrawlSpider):
+    '''
+    CrawlSpider that extracts the links of a response once and routes them
+    to their rules, instead of running every rule's link extractor over it.
+
+    Requests get the priority configured for their rule in RULE_PRIORITIES,
+    keyed by callback name ('follow' for rules without a callback). Once
+    ITEM_BUDGETS[item type] items of a type were scraped, rules whose
+    callback produces that type are closed (no longer followed), and the
+    spider closes when every type it produces has used up its budget.
+
+    With PARSE_PROCESSES set, callbacks and link extraction run in that many
+    worker processes (see `cosmebot.workers`), with at most
+    PARSE_MAX_PENDING responses sent to them at once, each failing after
+    PARSE_TIMEOUT seconds without a result.
+
+    With METRICS_ENABLED, the time taken by each callback and by routing the
+    links of each page (labelled with the page's rule) is recorded as
+    histograms in the stats, see `cosmebot.metrics`.
+
+    With COMPACT_ITEMS, callbacks build the compact item classes of
+    `cosmebot.items`, which use less memory.
+
+    The fields of the items can be restricted with the `fields` spider
+    argument, e.g. `-a fields=review:user_id,product_id,rating`, or with
+    ITEM_FIELDS, e.g. {'review': ['user_id', 'product_id', 'rating']}.
+    Item types not listed keep all their fields, and key fields (see
+    `cosmebot.database.TABLES`) are always kept. Callbacks skip the
+    extraction of the fields left out.
+    '''
+    # Item type produced by each callback, e.g. {'parse_user': 'user'}
+    callback_item_types = {}
+
+    rule_priorities = {}
+    item_budgets = {}
+    # Item type => class, compact ones with COMPACT_ITEMS
+    item_classes = ITEM_CLASSES
+    # Item type => fields to keep, for the types restricted
+    item_fields = {}
+    _pool = None
+    # Stats collector to record timings in, with METRICS_ENABLED
+    _metrics = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(RoutingCrawlSpider, cls).from_crawler(crawler, *args, **kwargs)
+        settings = crawler.settings
+        spider._configure(settings)
+        crawler.signals.connect(spider._item_scraped, signal=signals.item_scraped)
+        if settings.getbool('METRICS_ENABLED'):
+            spider._metrics = crawler.stats
+
+        processes = settings.getint('PARSE_PROCESSES')
+        if processes:
+            spider._pool = ParsePool(cls, kwargs, settings, processes,
+                                     settings.getint('PARSE_MAX_PENDING', processes * 4))
+            crawler.signals.connect(spider._close_pool, signal=signals.spider_closed)
+        return spider
+
+    def _configure(self, settings):
+        # Also called in parsing worker processes, which have no crawler
+        self.rule_priorities = settings.getdict('RULE_PRIORITIES')
+        self.item_budgets = settings.getdict('ITEM_BUDGETS')
+        if settings.getbool('COMPACT_ITEMS'):
+            self.item_classes = COMPACT_ITEM_CLASSES
+        # The `fields` spider argument wins over the setting
+        fields = getattr(self, 'fields', None)
+        if fields:
+            fields = parse_fields(fields)
+        else:
+            fields = settings.getdict('ITEM_FIELDS')
+        # Key fields are always kept, for the pipelines storing items by key
+        self.item_fields = dict((what, frozenset(names) | frozenset(TABLES[what].key))
+                                for what, names in fields.items())
+
+    def _wants(self, what):
+        '''
+        Returns a function telling whether any of the given fields of item
+        type `what` is kept, to skip extracting the others.
+        '''
+        selected = self.item_fields.get(what)
+        if selected is None:
+            return lambda *names: True
+        return lambda *names: not selected.isdisjoint(names)
+
+    def _project(self, item):
+        '''
+        Removes the fields left out by the field selection from `item`.
+        '''
+        selected = self.item_fields.get(item_type(item))
+        if selected is not None:
+            for name in list(item.keys()):
+                if name not in selected:
+                    del item[name]
+        return item
+
+    def _close_pool(self, spider):
+        self._pool.close()
+
+    def _compile_rules(self):
+        super(RoutingCrawlSpider, self)._compile_rules()
+        self._router = RoutingLinkExtractor(self._rules)
+        self._rule_keys = [rule.callback.__name__ if rule.callback else 'follow'
+                           for rule in self._rules]
+        self.item_counts = defaultdict(int)
+        self._exhausted = set()
+        self._closed_rules = set()
+
+    def _item_scraped(self, item, response, spider):
+        if spider is not self:
+            return
+        what = item_type(item)
+        self.item_counts[what] += 1
+        budget = self.item_budgets.get(what)
+        if budget is None or what in self._exhausted or self.item_counts[what] < budget:
+            return
+
+        self.logger.info('Item budget reached for %s (%d items)', what, budget)
+        self._exhausted.add(what)
+        self._close_rules(key for key, produced in self.callback_item_types.items()
+                          if produced == what)
+        if set(self.callback_item_types.values()) <= self._exhausted:
+            self.crawler.engine.close_spider(self, 'budget_exhausted')
+
+    def _close_rules(self, keys):
+        '''
+        Stops following the rules with the given keys (callback names).
+        '''
+        keys = set(keys)
+        self._closed_rules.update(n for n, key in enumerate(self._rule_keys) if key in keys)
+
+    def _request(self, n, url, link_text):
+        r = Request(url=url, callback=self._response_downloaded,
+                    priority=self.rule_priorities.get(self._rule_keys[n], 0))
+        r.meta.update(rule=n, link_text=link_text)
+        return self._rules[n].process_request(r)
+
+    def _parse_response(self, response, callback, cb_kwargs, follow=True):
+        if self._metrics is not None and callback:
+            callback = functools.partial(self._timed_callback, callback)
+        return super(RoutingCrawlSpider, self)._parse_response(response, callback,
+                                                               cb_kwargs, follow)
+
+    def _timed_callback(self, callback, response, **kwargs):
+        start = time.time()
+        results = callback(response, **kwargs) or ()
+        return timed(results, self._metrics, 'parse_seconds', callback.__name__, self,
+                     elapsed=time.time() - start)
+
+    def _rule_label(self, response):
+        n = response.meta.get('rule')
+        return 'start' if n is None else self._rule_keys[n]
+
+    def _requests_to_follow(self, response):
+        if not isinstance(response, HtmlResponse):
+            return
+        start = time.time()
+        routes = self._router.route(response)
+        if self._metrics is not None:
+            observe(self._metrics, 'route_seconds', self._rule_label(response),
+                    time.time() - start, self)
+        for n, links in routes:
+            if n in self._closed_rules:
+                continue
+            rule = self._rules[n]
+            if rule.process_links:
+                links = rule.process_links(links)
+            for link in links:
+                yield self._request(n, link.url, link.text)
+
+    def _requests_for_urls(self, urls):
+        # Requests for URLs built by a callback, routed like extracted links
+        for url in urls:
+            n = self._router.rule_for(url)
+            if n is not None and n not in self._closed_rules:
+                yield self._request(n, canonical_url(url), '')
+
+    def _replay_requests(self, links):
+        # (rule index, URL, link text) of requests recorded by the incremental
+        # index for an unmodified page, or sent back by a parsing worker
+        for n, url, link_text in links:
+            if n in self._closed_rules:
+                continue
+            yield self._request(n, url, link_text)
+
+    def _response_downloaded(self, response):
+        if not response.meta.get('incremental_unchanged'):
+            if self._pool is not None and isinstance(response, HtmlResponse):
+                return self._parse_in_pool(response)
+            return super(RoutingCrawlSpider, self)._response_downloaded(response)
+
+        # Unchanged since the last crawl (see cosmebot.incremental): its
+        # items were already exported, so only make the requests it led to
+        # then, those of its callback included
+        return self._replay_requests(response.meta.get('incremental_links', ()))
+
+    def _parse_in_pool(self, response):
+        n = response.meta['rule']
+        follow = self._rules[n].follow and self._follow_links
+        d = self._pool.parse(n, response, follow)
+        d.addCallback(self._pooled_results, response)
+        return d
+
+    def _pooled_results(self, result, response):
+        items, links, (parse_seconds, route_seconds) = result
+        if self._metrics is not None:
+            n = response.meta['rule']
+            observe(self._metrics, 'parse_seconds', self._rule_keys[n], parse_seconds, self)
+            if route_seconds is not None:
+                observe(self._metrics, 'route_seconds', self._rule_keys[n], route_seconds,
+                        self)
+        for what, fields in items:
+            yield self.item_classes[what](fields)
+        for request in self._replay_requests(links):
+            yield request
+
+
+class AtcosmeSpider(RoutingCrawlSpider):
     name = "atcosme"
     allowed_domains = ["cosme.net"]
-    download_delay = 1.0
 
     start_urls = (
         'http://www.cosme.net/',
     )
 
+    callback_item_types = {
+        'parse_product': 'product',
+        'parse_reviews': 'review',
+        'parse_user': 'user',
+        'parse_brand': 'brand',
+    }
+
     rules = (
         # Product
         # 'http://www.cosme.net/product/product_id/10084858/top'
@@ -66,47 +407,70 @@ class AtcosmeSpider(CrawlSpider):
         # http://www.cosme.net/brand/brand_id/493/products
         # http://www.cosme.net/brand/brand_id/493/products/page-5
         Rule(LxmlLinkExtractor(allow=(r'brand/brand_id/\d+/products(/page-\d+)?$',)),
-             follow=True),
+             follow=True, callback='parse_brand_products'),
     )
 
+    # Partial products from the brand product listings, see _configure()
+    listing_harvest = False
+    review_list_page_size = 10
+
+    def _configure(self, settings):
+        super(AtcosmeSpider, self)._configure(settings)
+        self.review_list_page_size = settings.getint('REVIEW_LIST_PAGE_SIZE', 10)
+        # Products come either from the listings or from their pages, so
+        # that each is scraped (and counted against its budget) once
+        self.listing_harvest = (settings.getbool('LISTING_HARVEST_ENABLED') and
+                                not settings.getbool('LISTING_HARVEST_FETCH_PRODUCTS'))
+        if self.listing_harvest:
+            self._close_rules(['parse_product'])
+            self.callback_item_types = dict(self.callback_item_types,
+                                            parse_brand_products='product')
+
     def parse_reviews(self, response):
-        divs = response.css('div.review-sec')
+        doc = root(response)
         user_id = int(re.findall(r'user_id/(\d+)', response.url)[0])
+        wants = self._wants('review')
 
-        for div in divs:
-            review = Review()
+        for div in REVIEW_SECS(doc):
+            review = self.item_classes['review']()
             review['user_id'] = user_id
 
-            user_age = div.css('dd >  ul > li.first::text').extract_first()
-            if user_age:
-                user_age = convert_to_int_if_int(user_age.replace(u'歳', ''))
-                review['user_age'] = user_age
-
-            product_link = div.css('p.item > a').xpath('@href').extract_first()
-            if product_link:
-                review['product_id'] = int(re.findall(r'product_id/(\d+)',
-                                           product_link)[0])
-
-            rating = div.css('p.reviewer-rating::text').extract_first()
-            if rating:
-                review['rating'] = convert_to_int_if_int(rating)
-
-            if div.css("p.mobile-date"):
-                date = div.css("p.mobile-date::text").extract_first()
-            else:
-                date = response.css("p.date::text").extract_first()
-            review['date'] = date
+            if wants('user_age'):
+                user_age = extract_first(div, REVIEW_USER_AGE)
+                if user_age:
+                    user_age = convert_to_int_if_int(user_age.replace(u'歳', ''))
+                    review['user_age'] = user_age
+
+            if wants('product_id'):
+                product_link = extract_first(div, REVIEW_PRODUCT_LINK)
+                if product_link:
+                    review['product_id'] = int(re.findall(r'product_id/(\d+)',
+                                               product_link)[0])
+
+            if wants('rating'):
+                rating = extract_first(div, REVIEW_RATING)
+                if rating:
+                    review['rating'] = convert_to_int_if_int(rating)
+
+            if wants('date'):
+                if REVIEW_MOBILE_DATE(div):
+                    date = extract_first(div, REVIEW_MOBILE_DATE_TEXT)
+                else:
+                    date = extract_first(doc, REVIEW_DATE)
+                review['date'] = date
 
-            # FIXME: remove newline from <a>
-            review['text'] = [sentence.strip() for sentence
-                              in div.css('p.read *::text').extract()
-                              if sentence.strip()]
-            review['product_type'] = div.css("dl.item-status > dd > ul > li::text") \
-                                        .extract()
+            if wants('text'):
+                # FIXME: remove newline from <a>
+                review['text'] = [sentence.strip() for sentence
+                                  in extract(div, REVIEW_TEXT)
+                                  if sentence.strip()]
+            if wants('product_type'):
+                review['product_type'] = extract(div, REVIEW_PRODUCT_TYPE)
 
-            self._parse_review_tag_list(div, review)
+            if wants(*self._tag_mappings.values()):
+                self._parse_review_tag_list(div, review)
 
-            yield review
+            yield self._project(review)
 
     _tag_mappings = {
         u'購入場所': 'purchase_location',
@@ -116,39 +480,35 @@ class AtcosmeSpider(CrawlSpider):
         u'関連ワード': 'related_words',
     }
 
-    def _parse_review_tag_list(self, response, review):
-        def _group_dds(tags):
-            dt = None
-            dds = []
-            for tag in tags:
-                if tag.extract().startswith('<dt>'):
-                    if dt and dds:
-                        yield dt, dds
-                    dt = tag
-                    dds = []
-                elif tag.extract().startswith('<dd>'):
-                    dds.append(tag)
-            if dt and dds:
-                yield dt, dds
-
-        children = response.css('div.tag-list > dl > dt,div.tag-list > dl > dd')
-        for dt, dds in _group_dds(children):
-            key = dt.xpath('./text()').extract_first()
-            values = [dd.xpath('./descendant-or-self::*/text()').extract_first()
-                      for dd in dds]
-            if key in self._tag_mappings:
-                review[self._tag_mappings[key]] = values
-
-    def _parse_product_colors(self, response, product):
-        lis = response.css('.color-ptn > dd ul > li')
+    def _parse_review_tag_list(self, div, review):
+        # Single pass over the <dt>/<dd> children of the tag lists: a <dt>
+        # starts a group and the <dd>s following it are its values
+        key = None
+        values = []
+        for dl in REVIEW_TAG_LISTS(div):
+            for child in dl:
+                if child.tag == 'dt':
+                    self._set_review_tags(review, key, values)
+                    key = _first_text(child)
+                    values = []
+                elif child.tag == 'dd':
+                    values.append(_first_descendant_text(child))
+        self._set_review_tags(review, key, values)
+
+    def _set_review_tags(self, review, key, values):
+        if values and key in self._tag_mappings:
+            review[self._tag_mappings[key]] = values
+
+    def _parse_product_colors(self, doc, product, wants):
+        lis = PRODUCT_COLORS(doc)
         colors = []
         for li in lis:
-            name = li.css('.color-txt::text').extract_first()
+            name = extract_first(li, COLOR_NAME)
             if not name:
-                name = li.css('::text').extract_first()
+                name = extract_first(li, OWN_TEXT)
 
-            img_link = li.css('img::attr(src)').extract_first()
-            link = li.css('a::attr(href)').extract_first()
+            img_link = extract_first(li, IMG_SRC)
+            link = extract_first(li, LINK_HREF)
 
             color = {}
             if name:
@@ -165,67 +525,79 @@ class AtcosmeSpider(CrawlSpider):
             product['colors'] = colors
 
             # Hack: replace size of image (for color detection purposes)
-            product['image_urls'] = [color['img_link'].replace('_m.jpg', '_xl.jpg')
-                                     for color in colors if 'img_link' in color]
+            if wants('image_urls'):
+                product['image_urls'] = [color['img_link'].replace('_m.jpg', '_xl.jpg')
+                                         for color in colors if 'img_link' in color]
 
     def parse_product(self, response):
-        product = Product()
+        doc = root(response)
+        product = self.item_classes['product']()
+        wants = self._wants('product')
 
         product['product_id'] = int(re.findall(r'product/product_id/(\d+)/top',
                                     response.url)[0])
-        product['name'] = response.css('h2.item-name > *.pdct-name > a::text') \
-                                  .extract_first()
-
-        product['maker'] = response.css('dl.maker > dd > a::text').extract_first()
-        product['brand'] = response.css('dl.brand-name > dd > a::text').extract_first()
-
-        product['description'] = [
-            sentence.strip() for sentence
-            in response.css('dl.item-description > dd').xpath('.//text()').extract()
-            if sentence.strip()
-        ]
-
-        category_spans = response.css('dl.item-category > dd > span')
-        product['categories'] = [
-            u' '.join([categ.strip() for categ in category])
-            for category in [category_span.xpath('.//text()').extract()
-                             for category_span in category_spans]
-        ]
-
-        rating = response.xpath("//p[@itemprop='ratingValue']/text()").extract_first()
-        product['rating'] = convert_to_float_if_float(rating)
-
-        point = response.css('p.point::text').extract()
-        if point:
-            product['point'] = convert_to_float_if_float(point[0].replace('pt', ''))
-
-        self._parse_product_rating(response, product)
-
-        review_count = response.css('ul.select-top li.review > a > span.num::text') \
-                               .extract()
-        if review_count:
-            review_count = review_count[0].replace('(', '').replace(')', '')
-            product['review_count'] = convert_to_int_if_int(review_count)
-
-        self._parse_product_counts(response, product)
-        self._parse_product_colors(response, product)
-
-        yield product
+        if wants('name'):
+            product['name'] = extract_first(doc, PRODUCT_NAME)
+
+        if wants('maker'):
+            product['maker'] = extract_first(doc, PRODUCT_MAKER)
+        if wants('brand'):
+            product['brand'] = extract_first(doc, PRODUCT_BRAND)
+
+        if wants('description'):
+            product['description'] = [
+                sentence.strip() for dd in PRODUCT_DESCRIPTION(doc)
+                for sentence in extract(dd, ALL_TEXT)
+                if sentence.strip()
+            ]
+
+        if wants('categories'):
+            category_spans = PRODUCT_CATEGORIES(doc)
+            product['categories'] = [
+                u' '.join([categ.strip() for categ in category])
+                for category in [ALL_TEXT(category_span)
+                                 for category_span in category_spans]
+            ]
+
+        if wants('rating'):
+            rating = extract_first(doc, PRODUCT_RATING)
+            product['rating'] = convert_to_float_if_float(rating)
+
+        if wants('point'):
+            point = extract(doc, PRODUCT_POINT)
+            if point:
+                product['point'] = convert_to_float_if_float(point[0].replace('pt', ''))
+
+        if wants('ranking', 'volume', 'price', 'sale_date'):
+            self._parse_product_rating(doc, product)
+
+        if wants('review_count'):
+            review_count = extract(doc, PRODUCT_REVIEW_COUNT)
+            if review_count:
+                review_count = review_count[0].replace('(', '').replace(')', '')
+                product['review_count'] = convert_to_int_if_int(review_count)
+
+        if wants(*self._product_count_mapping.values()):
+            self._parse_product_counts(doc, product)
+        if wants('colors', 'image_urls'):
+            self._parse_product_colors(doc, product, wants)
+
+        yield self._project(product)
 
     _product_count_mapping = {
         u'Like': 'like_count',
         u'Have': 'have_count',
     }
 
-    def _parse_product_counts(self, response, product):
-        lis = response.css('div.info-related > ul.rev-btn > li')
+    def _parse_product_counts(self, doc, product):
+        lis = PRODUCT_COUNTS(doc)
         for li in lis:
-            text = u' '.join(li.xpath('.//text()').extract())
+            text = u' '.join(ALL_TEXT(li))
 
             for key in self._product_count_mapping:
                 if key not in text:
                     continue
-                count = li.css('span.num::text').extract()
+                count = extract(li, NUM_TEXT)
                 if count:
                     mapped_key = self._product_count_mapping[key]
                     product[mapped_key] = convert_to_int_if_int(count[0])
@@ -236,16 +608,16 @@ class AtcosmeSpider(CrawlSpider):
         u'発売日': 'sale_date',
     }
 
-    def _parse_product_rating(self, response, product):
-        lis = response.css('div.rating > ul.info-rating > li')
+    def _parse_product_rating(self, doc, product):
+        lis = PRODUCT_RATING_INFO(doc)
         for li in lis:
-            key = li.css('.info-ttl::text').extract_first()
+            key = extract_first(li, INFO_TITLE)
             if key not in self._product_rating_mapping:
                 continue
 
             if key == u'ランキング':
-                ranking = li.css('.info-ranking > span::text').extract()
-                category = li.css('.info-ctg > a::text').extract()
+                ranking = extract(li, INFO_RANKING)
+                category = extract(li, INFO_CATEGORY)
 
                 value = []
                 if ranking:
@@ -253,7 +625,7 @@ class AtcosmeSpider(CrawlSpider):
                 if category:
                     value.append(category[0])
             else:
-                value = li.css('.info-desc::text').extract_first()
+                value = extract_first(li, INFO_DESCRIPTION)
 
             if key == u'容量・本体価格':
                 if u'・' in value:
@@ -269,26 +641,44 @@ class AtcosmeSpider(CrawlSpider):
                 product[self._product_rating_mapping[key]] = value
 
     def parse_user(self, response):
-        user = User()
+        doc = root(response)
+        user = self.item_classes['user']()
+
+        wants = self._wants('user')
 
-        user['user_id'] = int(re.findall(r'user_id/(\d+)', response.url)[0])
-        user['name'] = response.css('p.name > span::text').extract_first()
+        # Both also needed below, whatever the field selection
+        user_id = user['user_id'] = int(re.findall(r'user_id/(\d+)', response.url)[0])
+        review_count = extract_first(doc, USER_REVIEW_COUNT).replace(u'件', '')
+        review_count = user['review_count'] = convert_to_int_if_int(review_count)
 
-        review_count = response.css('div#new-review > h3 > span.number::text') \
-                               .extract_first().replace(u'件', '')
-        user['review_count'] = convert_to_int_if_int(review_count)
+        if wants('name'):
+            user['name'] = extract_first(doc, USER_NAME)
 
-        user['verified'] = bool(response.css('span.ico-cmn-auth'))
+        if wants('verified'):
+            user['verified'] = bool(USER_VERIFIED(doc))
 
-        self._parse_user_personal(response, user)
-        self._parse_user_activities(response, user)
+        if wants('age', *self._personal_mappings.values()):
+            self._parse_user_personal(doc, user)
+        if wants(*self._user_activity_mapping.values()):
+            self._parse_user_activities(doc, user)
 
-        brand_count = response.css('div#brand > p.view-more > a::text').extract()
-        if brand_count:
-            count = re.findall('\d+', brand_count[0])
-            user['favorite_brand_count'] = convert_to_int_if_int(count[0])
+        if wants('favorite_brand_count'):
+            brand_count = USER_BRAND_COUNT(doc)
+            if brand_count:
+                count = re.findall('\d+', brand_count[0])
+                user['favorite_brand_count'] = convert_to_int_if_int(count[0])
 
-        yield user
+        yield self._project(user)
+
+        # Request every page of the user's reviews at once, rather than
+        # discovering them one page at a time
+        if isinstance(review_count, int):
+            pages = int(math.ceil(float(review_count) / self.review_list_page_size))
+            urls = [response.urljoin(
+                '/open/entry/reviewlist/list/page/{0}/srt/0/sad/0/dst/1/user_id/{1}'
+                .format(page, user_id)) for page in range(1, pages + 1)]
+            for request in self._requests_for_urls(urls):
+                yield request
 
     _personal_mappings = {
         u'肌質': 'skin_type',
@@ -298,15 +688,15 @@ class AtcosmeSpider(CrawlSpider):
         u'血液型': 'blood_type',
     }
 
-    def _parse_user_personal(self, response, user):
-        for li in response.css('ul.personal > li'):
-            values = li.xpath('./text()').extract()
+    def _parse_user_personal(self, doc, user):
+        for li in USER_PERSONAL(doc):
+            values = extract(li, TEXT)
             key = values[0]
 
             # HACK: the html structure sucks, so we have to resort to counting
             if len(values) == 1:
                 # Contained <a>
-                value = li.xpath('./a/text()').extract_first()
+                value = extract_first(li, LINK_TEXT)
             else:
                 # Did not contain <a>
                 value = values[1]
@@ -323,40 +713,81 @@ class AtcosmeSpider(CrawlSpider):
         u'Fan数': 'fan_count',
     }
 
-    def _parse_user_activities(self, response, user):
-        lis = response.css('ul.activities > li')
+    def _parse_user_activities(self, doc, user):
+        lis = USER_ACTIVITIES(doc)
         for li in lis:
-            text = u' '.join(li.xpath('.//text()').extract())
+            text = u' '.join(ALL_TEXT(li))
             for key in self._user_activity_mapping:
                 if key not in text:
                     continue
-                count = li.css('span::text').extract()
+                count = extract(li, SPAN_TEXT)
                 if count:
                     mapped_key = self._user_activity_mapping[key]
                     user[mapped_key] = convert_to_int_if_int(count[0])
 
     def parse_brand(self, response):
-        brand = Brand()
+        doc = root(response)
+        brand = self.item_classes['brand']()
+
+        wants = self._wants('brand')
 
         brand['brand_id'] = int(re.findall(r'brand/brand_id/(\d+)/top',
                                 response.url)[0])
-        brand['name'] = response.css('div.title01 > h2::text').extract_first()
-        brand['maker'] = response.css('dd.maker > a::text').extract_first()
+        if wants('name'):
+            brand['name'] = extract_first(doc, BRAND_NAME)
+        if wants('maker'):
+            brand['maker'] = extract_first(doc, BRAND_MAKER)
 
-        for key, klass in (('product_count', 'productNumber'),
-                           ('review_count', 'reviewNumber'),
-                           ('favorite_count', 'clipNumber')):
-            count = response.css('dt.{0} + dd > a::text'.format(klass)).extract_first()
+        for key, path in BRAND_COUNTS:
+            if not wants(key):
+                continue
+            count = extract_first(doc, path)
             if count:
                 count = count.replace(u'件', '').replace(u'人', '')
                 brand[key] = convert_to_int_if_int(count)
-        yield brand
-
-
-class AtcosmeTagSpider(CrawlSpider):
+        yield self._project(brand)
+
+    def parse_brand_products(self, response):
+        '''
+        Yields the products listed on a brand's product listing page, with
+        the fields the listing shows: product_id, name, brand, rating and
+        review_count. Only with LISTING_HARVEST_ENABLED, in which case
+        product pages are not fetched, unless LISTING_HARVEST_FETCH_PRODUCTS
+        is set; the listing is otherwise only followed.
+        '''
+        if not self.listing_harvest:
+            return
+
+        wants = self._wants('product')
+        for li in LISTING_ITEMS(root(response)):
+            match = LISTING_PRODUCT_ID.search(extract_first(li, LISTING_LINK) or '')
+            if not match:
+                continue
+            product = self.item_classes['product']()
+            product['product_id'] = int(match.group(1))
+            if wants('name'):
+                product['name'] = extract_first(li, LISTING_NAME)
+            if wants('brand'):
+                product['brand'] = extract_first(li, LISTING_BRAND)
+
+            if wants('rating'):
+                rating = extract_first(li, LISTING_RATING)
+                if rating:
+                    product['rating'] = convert_to_float_if_float(rating)
+            if wants('review_count'):
+                review_count = extract_first(li, LISTING_REVIEW_COUNT)
+                if review_count:
+                    product['review_count'] = convert_to_int_if_int(review_count)
+            yield self._project(product)
+
+
+class AtcosmeTagSpider(RoutingCrawlSpider):
     name = "atcosme-tag"
     allowed_domains = ["cosme.net"]
-    download_delay = 1.0
+
+    callback_item_types = {
+        'parse_tags': 'tag',
+    }
 
     def __init__(self, tag_type='access', *a, **kw):
 
@@ -369,8 +800,9 @@ class AtcosmeTagSpider(CrawlSpider):
         else:
             raise Exception("Invalid tag_type: {}".format(tag_type))
         start_url = 'http://www.cosme.net/tags/search/{0}#result'.format(tag_index)
+        self.page_url = 'http://www.cosme.net/tags/page/{{0}}/search/{0}#result'.format(tag_index)
 
-        self.start_urls = (start_url,)
+        self.start_urls = (canonical_url(start_url),)
 
         self.rules = (
             # Pagination
@@ -392,12 +824,24 @@ class AtcosmeTagSpider(CrawlSpider):
         else:
             current_page = int(re.findall(r'page/(\d+)', response.url)[0])
 
-        lis = response.css('div.tag-list > ul > li')
+        lis = TAG_LIST(root(response))
         for i, li in enumerate(lis):
-            tag = Tag()
+            tag = self.item_classes['tag']()
 
-            tag['name'] = li.css('a::text').extract_first()
-            tag['tag_url'] = li.css('a::attr(href)').extract_first()
+            tag['name'] = extract_first(li, LINK_TEXT_CSS)
+            tag['tag_url'] = extract_first(li, LINK_HREF)
             tag['rank'] = current_page * 40 + i
 
-            yield tag
+            yield self._project(tag)
+
+        # The pager shows a window of pages around the current one, not the
+        # last page. Request every page up to the end of the window at once
+        # (the dupefilter drops those already requested); parsing the pages
+        # at its end moves it further, so that requests chain from the
+        # highest page seen until the last page
+        pages = [int(page) for link in TAG_PAGER_LINKS(root(response))
+                 for page in re.findall(r'page/(\d+)', link)]
+        if pages:
+            urls = [self.page_url.format(page) for page in range(1, max(pages) + 1)]
+            for request in self._requests_for_urls(urls):
+                yield request
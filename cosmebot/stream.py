@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+'''
+Streaming scraped items to subscribers over a local socket, as they are
+scraped.
+
+`ItemStreamPipeline` listens on STREAM_LISTEN, a Twisted endpoint string:
+`unix:cosmebot.sock` (the default) or e.g. `tcp:8765:interface=127.0.0.1`.
+A subscriber connects and sends one line listing the item types it wants,
+separated by commas (`review,product\\n`), or an empty line for all of
+them. It then receives one frame per item: a 4-byte big-endian length,
+followed by that many bytes of UTF-8 JSON,
+
+    {"type":"review","item":{"review_id":...,"rating":5,...}}
+
+until the crawl ends and the connection is closed. Items scraped before a
+subscriber sent its line are not sent to it.
+
+Each subscriber has a buffer of up to STREAM_BUFFER_SIZE frames that the
+socket could not take yet. When a subscriber's buffer is full, items wait
+before being published, which holds back the crawl until it catches up,
+instead of buffering without bound.
+
+`subscribe` reads a stream, and this module can be run to print one as
+JSON lines:
+
+    python -m cosmebot.stream unix:cosmebot.sock review
+'''
+
+import argparse
+import json
+import socket
+import struct
+import sys
+from collections import deque
+
+from twisted.internet import defer, endpoints, protocol, reactor
+from twisted.protocols.basic import LineOnlyReceiver
+
+from cosmebot.pipelines import convert_to_utf8, item_type
+
+
+HEADER = struct.Struct('>I')
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def frame(what, item):
+    '''
+    Encodes `item`, of type `what`, as a length-prefixed frame.
+    '''
+    payload = _encoder.encode(convert_to_utf8({'type': what, 'item': dict(item)}))
+    if not isinstance(payload, bytes):
+        payload = payload.encode('utf-8')
+    return HEADER.pack(len(payload)) + payload
+
+
+class Subscriber(LineOnlyReceiver):
+    '''
+    Connection of a subscriber: reads its line of item types, then sends
+    it the frames published for them. Frames that the transport does not
+    take while it is paused are kept in `buffer`.
+    '''
+    delimiter = b'\n'
+
+    def __init__(self):
+        self.types = None
+        self.buffer = deque()
+        self.paused = False
+        self._waiters = []
+        self.closed = defer.Deferred()
+
+    def connectionMade(self):
+        self.factory.connections.add(self)
+        # The transport pauses us when its own write buffer is full
+        self.transport.registerProducer(self, True)
+
+    def lineReceived(self, line):
+        if self.types is not None:
+            return
+        line = line.decode('utf-8').strip()
+        self.types = frozenset(what.strip() for what in line.split(',') if what.strip())
+        self.factory.subscribers.add(self)
+
+    def wants(self, what):
+        return not self.types or what in self.types
+
+    def send(self, data):
+        if self.paused or self.buffer:
+            self.buffer.append(data)
+        else:
+            self.transport.write(data)
+
+    def full(self):
+        return len(self.buffer) >= self.factory.buffer_size
+
+    def wait(self):
+        d = defer.Deferred()
+        self._waiters.append(d)
+        if not self.full():
+            self._wake()
+        return d
+
+    def _wake(self):
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        while self.buffer and not self.paused:
+            self.transport.write(self.buffer.popleft())
+        if not self.full():
+            self._wake()
+
+    def stopProducing(self):
+        self.buffer.clear()
+
+    def finish(self):
+        # Sends the buffered frames and closes the connection
+        while self.buffer:
+            self.transport.write(self.buffer.popleft())
+        self.transport.unregisterProducer()
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.factory.connections.discard(self)
+        self.factory.subscribers.discard(self)
+        self.buffer.clear()
+        # A subscriber that went away no longer holds back the crawl
+        self._wake()
+        self.closed.callback(None)
+
+
+class SubscriberFactory(protocol.Factory):
+    '''
+    Keeps the open `connections`, and among them the `subscribers`, which
+    sent their line of item types.
+    '''
+    protocol = Subscriber
+
+    def __init__(self, buffer_size):
+        self.buffer_size = buffer_size
+        self.connections = set()
+        self.subscribers = set()
+
+
+class ItemStreamPipeline(object):
+    '''
+    Publishes each item to the subscribers of its type (see above). Items
+    pass through unchanged, once all the subscribers they go to have room
+    in their buffer. All connections are closed when the spider closes,
+    or aborted after STREAM_CLOSE_TIMEOUT seconds if they don't read what
+    is left.
+    '''
+    def __init__(self, settings):
+        self.listen = settings.get('STREAM_LISTEN', 'unix:cosmebot.sock')
+        self.factory = SubscriberFactory(settings.getint('STREAM_BUFFER_SIZE', 1000))
+        self.close_timeout = settings.getfloat('STREAM_CLOSE_TIMEOUT', 30)
+        self.port = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def open_spider(self, spider):
+        endpoint = endpoints.serverFromString(reactor, self.listen)
+        d = endpoint.listen(self.factory)
+
+        def listening(port):
+            self.port = port
+            spider.logger.info('Streaming items on %s', self.listen)
+        return d.addCallback(listening)
+
+    def close_spider(self, spider):
+        # Connections that didn't send their line yet are closed too
+        connections = list(self.factory.connections)
+        d = defer.DeferredList([c.closed for c in connections])
+        for connection in connections:
+            connection.finish()
+        timeout = reactor.callLater(self.close_timeout, self._abort, connections)
+
+        def closed(_):
+            if timeout.active():
+                timeout.cancel()
+            return self.port.stopListening()
+        return d.addCallback(closed)
+
+    @staticmethod
+    def _abort(connections):
+        for connection in connections:
+            connection.transport.abortConnection()
+
+    def process_item(self, item, spider):
+        what = item_type(item)
+        subscribers = [s for s in self.factory.subscribers if s.wants(what)]
+        full = [s for s in subscribers if s.full()]
+        if full:
+            d = defer.DeferredList([s.wait() for s in full])
+            d.addCallback(lambda _: self.process_item(item, spider))
+            return d
+        if subscribers:
+            data = frame(what, item)
+            for subscriber in subscribers:
+                subscriber.send(data)
+        return item
+
+
+def _connect(listen):
+    # Client side of a STREAM_LISTEN endpoint string: 'unix:PATH[:...]' or
+    # 'tcp:PORT[:interface=HOST]'
+    kind, _, rest = listen.partition(':')
+    positional = {'unix': 'address', 'tcp': 'port'}.get(kind)
+    if positional is None:
+        raise ValueError('Unsupported STREAM_LISTEN: {0}'.format(listen))
+    options = dict(part.split('=', 1) if '=' in part else (positional, part)
+                   for part in rest.split(':'))
+    if kind == 'unix':
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(options['address'])
+        return sock
+    return socket.create_connection((options.get('interface', '127.0.0.1'),
+                                     int(options['port'])))
+
+
+def _read(f, size):
+    data = f.read(size)
+    if len(data) < size:
+        raise EOFError
+    return data
+
+
+def subscribe(listen, types=()):
+    '''
+    Connects to the pipeline listening on `listen` (as STREAM_LISTEN) and
+    yields the (item type, item dict) it streams for `types` (all types if
+    empty), until the crawl ends.
+    '''
+    sock = _connect(listen)
+    try:
+        sock.sendall(','.join(types).encode('utf-8') + b'\n')
+        f = sock.makefile('rb')
+        while True:
+            try:
+                (size,) = HEADER.unpack(_read(f, HEADER.size))
+                message = json.loads(_read(f, size).decode('utf-8'))
+            except EOFError:
+                return
+            yield message['type'], message['item']
+    finally:
+        sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Prints the items streamed by ItemStreamPipeline as JSON lines.')
+    parser.add_argument('listen', nargs='?', default='unix:cosmebot.sock',
+                        help='STREAM_LISTEN of the crawl')
+    parser.add_argument('types', nargs='*', help='item types (default: all)')
+    args = parser.parse_args(argv)
+
+    for what, item in subscribe(args.listen, args.types):
+        line = json.dumps({'type': what, 'item': item}, ensure_ascii=False)
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8')
+        getattr(sys.stdout, 'buffer', sys.stdout).write(line + b'\n')
+        sys.stdout.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+'''
+Canonical URLs for the cosme.net pages followed by the spiders.
+
+Several URL shapes accepted by the crawl rules serve the same page. They
+are all mapped to one canonical URL, which is used as the request URL, so
+that the dupefilter sees a single fingerprint per page.
+'''
+
+import re
+
+from scrapy.utils.url import canonicalize_url
+
+
+_rewrites = (
+    # First page of a user's reviews
+    # 'http://my.cosme.net/open/entry/reviewlist/list/page/1/srt/0/sad/0/dst/1/user_id/1016654'
+    # => 'http://my.cosme.net/open_entry_reviewlist/list/user_id/1016654/dst/1'
+    (re.compile(r'^(https?://[^/]+/)open/entry/reviewlist/list/page/1/srt/0/sad/0/dst/1'
+                r'/user_id/(\d+)(?:[/?].*)?$'),
+     r'\1open_entry_reviewlist/list/user_id/\2/dst/1'),
+    (re.compile(r'^(https?://[^/]+/open/entry/reviewlist/list/page/\d+/srt/0/sad/0/dst/1'
+                r'/user_id/\d+)(?:[/?].*)?$'),
+     r'\1'),
+
+    # Product, with anything following `/top` dropped
+    # 'http://www.cosme.net/product/product_id/10084858/top?rid=1'
+    # => 'http://www.cosme.net/product/product_id/10084858/top'
+    (re.compile(r'^(https?://[^/]+/product/product_id/\d+/top)(?:[/?].*)?$'),
+     r'\1'),
+
+    # First page of paginated listings
+    # 'http://www.cosme.net/product/product_id/10095736/beautists/page/1'
+    # => 'http://www.cosme.net/product/product_id/10095736/beautists'
+    (re.compile(r'^(https?://[^/]+/product/product_id/\d+/beautists)/page/1$'),
+     r'\1'),
+    # 'http://www.cosme.net/brand/brand_id/493/products/page-1'
+    # => 'http://www.cosme.net/brand/brand_id/493/products'
+    (re.compile(r'^(https?://[^/]+/brand/brand_id/\d+/products)/page-1$'),
+     r'\1'),
+)
+
+
+def canonical_url(url):
+    '''
+    Returns the canonical form of `url`: Scrapy's canonicalization (sorted
+    query arguments, no `#result` or other fragment), then the first
+    matching rewrite above.
+    '''
+    url = canonicalize_url(url)
+    for pattern, replacement in _rewrites:
+        canonical, n = pattern.subn(replacement, url)
+        if n:
+            return canonical
+    return url
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+'''
+Running spider callbacks in worker processes.
+
+Each worker process builds its own instance of the spider, without a
+crawler, and runs the callback of the crawl rule that requested a response
+on it. Items are sent back as (item type, dict) tuples, and turned back into
+items with `make_item`.
+'''
+
+import multiprocessing
+import signal
+import time
+import traceback
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.item import BaseItem
+from scrapy.utils.misc import arg_to_iter
+from twisted.internet import defer, reactor
+
+from cosmebot.archive import START_RULE, ResponseArchive
+from cosmebot.items import ITEM_CLASSES
+from cosmebot.pipelines import item_type
+
+
+_spider = None
+_archive = None
+
+
+def make_item(what, fields):
+    return ITEM_CLASSES[what](fields)
+
+
+def init_worker(spidercls, spider_kwargs, settings, archive_path=None):
+    '''
+    Pool initializer: builds and configures the spider, and opens the
+    archive to parse.
+    '''
+    global _spider, _archive
+    _spider = spidercls(**spider_kwargs)
+    _spider._configure(settings)
+    if archive_path:
+        _archive = ResponseArchive(archive_path, readonly=True)
+
+
+def run_callback(rule, response):
+    '''
+    Runs the callback of rule `rule` on `response` and returns the items it
+    produced, as (item type, dict) tuples, along with the other results.
+    '''
+    callback = _spider._rules[rule].callback
+    if callback is None:
+        return [], []
+    items, others = [], []
+    for result in arg_to_iter(callback(response, **_spider._rules[rule].cb_kwargs)):
+        if isinstance(result, BaseItem):
+            items.append((item_type(result), dict(result)))
+        else:
+            others.append(result)
+    return items, others
+
+
+def reparse(id):
+    '''
+    Parses the archived response `id` (see `ResponseArchive.ids`), with
+    `parse_start_url` for a start page.
+    '''
+    rule, response = _archive.get(id)
+    if rule == START_RULE:
+        return [(item_type(result), dict(result))
+                for result in arg_to_iter(_spider.parse_start_url(response))
+                if isinstance(result, BaseItem)]
+    items, _ = run_callback(rule, response)
+    return items
+
+
+class WorkerError(Exception):
+    '''
+    A callback failed in a worker process; holds the worker's traceback.
+    '''
+
+
+def parse(rule, url, headers, body, follow):
+    '''
+    Parses a downloaded response: returns its items, the (rule index, URL,
+    link text) of the requests to follow from it, both those returned by
+    the callback and the links routed to the spider's rules, and the time
+    taken by the callback and by routing (None if links were not followed).
+    '''
+    try:
+        start = time.time()
+        response = HtmlResponse(url, headers=headers, body=body,
+                                request=Request(url, meta={'rule': rule}))
+        items, others = run_callback(rule, response)
+        links = [(r.meta['rule'], r.url, r.meta.get('link_text', ''))
+                 for r in others if isinstance(r, Request) and 'rule' in r.meta]
+        parse_seconds = time.time() - start
+
+        route_seconds = None
+        if follow:
+            start = time.time()
+            for n, routed in _spider._router.route(response):
+                if _spider._rules[n].process_links:
+                    routed = _spider._rules[n].process_links(routed)
+                links.extend((n, link.url, link.text) for link in routed)
+            route_seconds = time.time() - start
+        return True, (items, links, (parse_seconds, route_seconds))
+    except Exception:
+        # Pool.apply_async has no error callback on Python 2
+        return False, traceback.format_exc()
+
+
+def init_process(initializer=None, initargs=()):
+    '''
+    Pool initializer running `initializer(*initargs)` in the worker.
+    '''
+    # Forked from Scrapy, whose handlers shut down gracefully: let the pool
+    # terminate its workers, and leave Ctrl-C to the parent
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+class WorkerPool(object):
+    '''
+    Pool of `processes` worker processes running functions that return
+    (True, result), or (False, traceback) when they fail.
+
+    `run` returns a Deferred firing, on the reactor thread, with the result,
+    or failing with a `WorkerError`, also when there is no result after
+    `timeout` seconds: the pool replaces a worker that died, but the call
+    it was running never returns. At most `max_pending` calls are sent to
+    the workers at once; the others wait in the main process.
+    '''
+    def __init__(self, processes, max_pending, initializer=None, initargs=(), timeout=60):
+        self.pool = multiprocessing.Pool(processes, init_process, (initializer, initargs))
+        self.semaphore = defer.DeferredSemaphore(max_pending)
+        self.timeout = timeout
+        self.timed_out = 0
+
+    def run(self, func, *args):
+        return self.semaphore.run(self._submit, func, args)
+
+    def _submit(self, func, args):
+        d = defer.Deferred()
+        call = reactor.callLater(self.timeout, self._expired, d)
+        self.pool.apply_async(
+            func, args, callback=lambda result: reactor.callFromThread(self._done, d, call, result))
+        return d
+
+    @staticmethod
+    def _done(d, call, result):
+        if d.called:
+            # Too late, already failed by _expired
+            return
+        call.cancel()
+        ok, value = result
+        if ok:
+            d.callback(value)
+        else:
+            d.errback(WorkerError(value))
+
+    def _expired(self, d):
+        self.timed_out += 1
+        d.errback(WorkerError('No result after {0} seconds, the worker died or is stuck'
+                              .format(self.timeout)))
+
+    def close(self):
+        # Workers may still be running the calls that timed out
+        if self.timed_out:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+
+
+class ParsePool(WorkerPool):
+    '''
+    Pool of worker processes parsing responses for a spider: `parse`
+    returns a Deferred firing with the result of `parse` above.
+    '''
+    def __init__(self, spidercls, spider_kwargs, settings, processes, max_pending):
+        super(ParsePool, self).__init__(processes, max_pending, init_worker,
+                                        (spidercls, spider_kwargs, settings),
+                                        settings.getfloat('PARSE_TIMEOUT', 60))
+
+    def parse(self, rule, response, follow):
+        content_type = response.headers.get('Content-Type')
+        headers = {'Content-Type': content_type} if content_type else {}
+        return self.run(parse, rule, response.url, headers, response.body, follow)
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+'''
+File-like objects used by the JSON lines exporters: compressed and
+size-capped segment files, and a writer that moves disk I/O off the
+reactor thread.
+'''
+
+import glob
+import gzip
+import os
+import struct
+import threading
+import zlib
+
+from six.moves import queue
+from twisted.internet import defer, reactor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSION_SUFFIXES = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+class ZstdFile(object):
+    '''
+    Minimal write-only zstd file, closing the frame on `close()`.
+    '''
+    def __init__(self, path, mode='wb'):
+        if zstandard is None:
+            raise ImportError('zstd compression requires the zstandard package')
+        self.raw = open(path, mode)
+        self.writer = zstandard.ZstdCompressor().stream_writer(self.raw)
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.flush(zstandard.FLUSH_FRAME)
+        self.raw.close()
+
+
+def open_compressed(path, compression=None, mode='wb'):
+    '''
+    Opens `path` for writing, compressed with `compression`
+    (None, 'gzip' or 'zstd').
+    '''
+    if compression is None:
+        return open(path, mode)
+    elif compression == 'gzip':
+        return gzip.open(path, mode)
+    elif compression == 'zstd':
+        return ZstdFile(path, mode)
+    raise ValueError('Unknown compression: {0}'.format(compression))
+
+
+def repair_tail(path, chunk_size=65536):
+    '''
+    Truncates `path` after its last newline, dropping the partially written
+    line an interrupted run may have left. Only the tail of the file is
+    read. Returns the number of bytes dropped.
+    '''
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        end = position = f.tell()
+        keep = 0
+        while position > 0:
+            start = max(0, position - chunk_size)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b'\n')
+            if newline != -1:
+                keep = start + newline + 1
+                break
+            position = start
+        if keep != end:
+            f.truncate(keep)
+        return end - keep
+
+
+def _decompress(path, compression, chunk_size=65536):
+    '''
+    Returns a tuple of (chunks, complete): an iterator over whatever can be
+    decompressed from `path`, and a callable telling, once the iterator is
+    exhausted, whether the stream ended properly.
+    '''
+    if compression == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstd compression requires the zstandard package')
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        raise ValueError('Unknown compression: {0}'.format(compression))
+    state = {'crc': 0, 'size': 0, 'error': False}
+
+    def chunks():
+        with open(path, 'rb') as f:
+            while True:
+                raw = f.read(chunk_size)
+                if not raw:
+                    break
+                try:
+                    chunk = decompressor.decompress(raw)
+                except Exception:
+                    state['error'] = True
+                    break
+                state['crc'] = zlib.crc32(chunk, state['crc']) & 0xffffffff
+                state['size'] += len(chunk)
+                if chunk:
+                    yield chunk
+
+    def complete():
+        if state['error']:
+            return False
+        if compression == 'zstd':
+            return getattr(decompressor, 'eof', True)
+        # A gzip member ends with the CRC32 and size of its content
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < 8:
+                return False
+            f.seek(-8, os.SEEK_END)
+            crc, size = struct.unpack('<II', f.read(8))
+        return crc == state['crc'] and size == state['size'] & 0xffffffff
+
+    return chunks(), complete
+
+
+def repair_compressed(path, compression):
+    '''
+    Compressed counterpart of `repair_tail`. A compressed file cut short
+    can't be truncated in place, so when the stream is incomplete or ends
+    in a partial line, its complete lines are copied to a new file that
+    replaces it. Returns the number of readable bytes dropped.
+    '''
+    last = b''
+    chunks, complete = _decompress(path, compression)
+    for chunk in chunks:
+        last = chunk
+    if complete() and (not last or last.endswith(b'\n')):
+        return 0
+
+    tmp_path = path + '.repair'
+    out = open_compressed(tmp_path, compression)
+    pending = b''
+    for chunk in _decompress(path, compression)[0]:
+        pending += chunk
+        newline = pending.rfind(b'\n')
+        if newline != -1:
+            out.write(pending[:newline + 1])
+            pending = pending[newline + 1:]
+    out.close()
+    os.rename(tmp_path, path)
+    return len(pending)
+
+
+def read_lines(path):
+    '''
+    Iterates over the lines of a JSON lines output, decompressing it
+    according to its suffix (`.gz` or `.zst`).
+    '''
+    compression = None
+    for name, suffix in COMPRESSION_SUFFIXES.items():
+        if suffix and path.endswith(suffix):
+            compression = name
+    if compression is None:
+        with open(path, 'rb') as f:
+            for line in f:
+                yield line
+        return
+
+    chunks, _ = _decompress(path, compression)
+    tail = b''
+    for chunk in chunks:
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if tail:
+        yield tail
+
+
+def resume_segments(base, suffix, compression=None):
+    '''
+    Repairs the last segment written by a previous run, and returns the
+    index the next segment should use.
+    '''
+    pattern = '{0}-[0-9][0-9][0-9][0-9][0-9]{1}'.format(base, suffix)
+    segments = sorted(glob.glob(pattern))
+    if not segments:
+        return 0
+    last = segments[-1]
+    if compression is None:
+        repair_tail(last)
+    else:
+        repair_compressed(last, compression)
+    return int(last[len(base) + 1:len(base) + 6]) + 1
+
+
+class SegmentedFile(object):
+    '''
+    Writes to `<base>-00000<suffix>`, `<base>-00001<suffix>`, ... and starts
+    a new segment once `segment_size` uncompressed bytes went into the
+    current one (0 means a single segment). Writes are never split, so
+    every segment holds whole lines.
+    '''
+    def __init__(self, base, suffix, compression=None, segment_size=0, index=0):
+        self.base = base
+        self.suffix = suffix
+        self.compression = compression
+        self.segment_size = segment_size
+        self.index = index
+        self.file = None
+        self.written = 0
+        self._open_segment()
+
+    def path(self, index):
+        return '{0}-{1:05d}{2}'.format(self.base, index, self.suffix)
+
+    def _open_segment(self):
+        self.file = open_compressed(self.path(self.index), self.compression)
+        self.written = 0
+
+    def write(self, data):
+        if self.segment_size and self.written and \
+                self.written + len(data) > self.segment_size:
+            self.file.close()
+            self.index += 1
+            self._open_segment()
+        self.file.write(data)
+        self.written += len(data)
+
+    def close(self):
+        self.file.close()
+
+
+class BackgroundWriter(object):
+    '''
+    Collects writes into batches and hands them to a thread that writes
+    them to `file`, so that disk stalls don't block the reactor.
+
+    Writes never block: batches are queued for the thread whatever their
+    number. `full()` tells when `max_batches` batches are pending, and
+    `wait()` returns a Deferred that fires on the reactor thread once there
+    is room again, so callers can apply backpressure instead of buffering
+    without bound. As all the waiters wake up at once, callers check
+    `full()` again before writing.
+    '''
+    def __init__(self, file, batch_size=1000, max_batches=16):
+        self.file = file
+        self.batch_size = batch_size
+        self.batch = []
+        self.max_batches = max_batches
+        self.queue = queue.Queue()
+        self.error = None
+        self._waiters = []
+        self._thread = threading.Thread(target=self._drain)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, data):
+        self._raise_error()
+        self.batch.append(data)
+        if len(self.batch) >= self.batch_size:
+            self._flush_batch()
+
+    def flush(self):
+        '''
+        Hands the batch collected so far to the writer thread, even if it
+        isn't full.
+        '''
+        self._raise_error()
+        self._flush_batch()
+
+    def _flush_batch(self):
+        if self.batch:
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def full(self):
+        return self.queue.qsize() >= self.max_batches
+
+    def wait(self):
+        d = defer.Deferred()
+        self._waiters.append(d)
+        # The writer thread may have made room before the waiter was added
+        if not self.full():
+            self._wake()
+        return d
+
+    def _wake(self):
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def _drain(self):
+        while True:
+            batch = self.queue.get()
+            if self._waiters:
+                reactor.callFromThread(self._wake)
+            if batch is None:
+                break
+            if self.error is not None:
+                # Keep consuming, so that the reactor thread never blocks
+                continue
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                self.error = e
+
+    def _write_batch(self, batch):
+        self.file.write(b''.join(batch))
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        '''
+        Writes the pending batches and closes the underlying file.
+        '''
+        self._flush_batch()
+        self.queue.put(None)
+        self._thread.join()
+        self.file.close()
+        self._raise_error()